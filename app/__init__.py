@@ -1,2 +1,8 @@
-# import utils
-from .utils import *
+# The utils are loaded on first access (app.<name>), importing selenium only when it is needed
+def __getattr__(name):
+    from . import utils
+
+    try:
+        return getattr(utils, name)
+    except AttributeError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
@@ -0,0 +1,79 @@
+import os
+import numpy as np
+from collections import defaultdict
+
+"""
+Features of the chunks for the re-ranking of the retrieval results (see app.serving.rerank).
+
+They are computed once, when the vector store is built, and stored next to the FAISS index, so
+they are published and downloaded with it. All of the arrays are indexed by the position of the
+chunk in the FAISS index:
+
+- norms: the L2 norms of the embeddings, for the cosine similarities of the MMR re-ranking
+- chunk_idx: the position of the chunk within its file
+- previous, next: the positions of the preceding and the following chunk of the same file, -1 if
+  the neighbour is not in the index (first or last chunk, or a skipped duplicate)
+"""
+
+RERANK_FEATURES_NAME = "rerank_features.npz"
+
+
+def compute_rerank_features(vectors, file_ids, chunk_idxs):
+    """
+    Computes the re-ranking features.
+
+    Args:
+        vectors (numpy.ndarray): The embeddings, in the order of the index.
+        file_ids (list): The file_id of every chunk.
+        chunk_idxs (list): The chunk_idx of every chunk.
+
+    Returns:
+        dict: The feature arrays.
+    """
+    n_chunks = len(file_ids)
+    chunk_idxs = np.asarray(chunk_idxs, dtype=np.int32)
+    previous = np.full(n_chunks, -1, dtype=np.int64)
+    following = np.full(n_chunks, -1, dtype=np.int64)
+    positions_by_file = defaultdict(list)
+    for position, file_id in enumerate(file_ids):
+        positions_by_file[file_id].append(position)
+    for positions in positions_by_file.values():
+        positions.sort(key=lambda position: chunk_idxs[position])
+        for first, second in zip(positions, positions[1:]):
+            if chunk_idxs[second] == chunk_idxs[first] + 1:
+                following[first] = second
+                previous[second] = first
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return {
+        "norms": np.sqrt(np.einsum("ij,ij->i", vectors, vectors)),
+        "chunk_idx": chunk_idxs,
+        "previous": previous,
+        "next": following,
+    }
+
+
+def write_rerank_features(db, vector_db_path):
+    """Computes the features of the chunks of the langchain FAISS store and saves them."""
+    n_chunks = db.index.ntotal
+    metadatas = [
+        db.docstore.search(db.index_to_docstore_id[position]).metadata
+        for position in range(n_chunks)
+    ]
+    features = compute_rerank_features(
+        db.index.reconstruct_n(0, n_chunks),
+        [metadata.get("file_id") for metadata in metadatas],
+        [metadata.get("chunk_idx", -1) for metadata in metadatas],
+    )
+    path = os.path.join(vector_db_path, RERANK_FEATURES_NAME)
+    with open(path + ".part", "wb") as f:
+        np.savez(f, **features)
+    os.replace(path + ".part", path)
+
+
+def load_rerank_features(directory):
+    """Loads the features saved in the directory. None, if there are none."""
+    path = os.path.join(directory, RERANK_FEATURES_NAME)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as features:
+        return {name: features[name] for name in features.files}
@@ -1,16 +1,16 @@
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
-from dotenv import load_dotenv, find_dotenv
 import os
 import openai
 from tqdm import tqdm
-import json
 import backoff
 import pandas as pd
 from openai import OpenAI
-
-_ = load_dotenv(find_dotenv())  # read local .env file
-openai.api_key = os.getenv("OPENAI_API_KEY")
+from langchain_core.documents import Document
+from app.parser.chunk_dataset import iter_chunk_batches, batch_to_documents
+from app.parser.dedup import get_chunk_id, REFERENCE_COLUMNS
+from app.database.rerank_features import write_rerank_features
+from app.metrics import metrics
 
 
 class VectorStore:
@@ -20,6 +20,8 @@ class VectorStore:
     Args:
         file_chunks_data_dir (str): The directory path where the chunked data is stored.
         vector_db_path (str): The directory path where the vector database will be stored.
+        deduplicator (Deduplicator, optional): The index of the near-duplicate chunks. The
+            duplicates are not embedded again, their references are added to the first copy.
 
     """
 
@@ -29,6 +31,7 @@ class VectorStore:
         file_chunks_data_dir,
         vector_db_path,
         embedding_model="text-embedding-3-large",
+        deduplicator=None,
     ) -> None:
         self.embedding_model = embedding_model
         self.embeddings = OpenAIEmbeddings(model=self.embedding_model)
@@ -37,6 +40,8 @@ class VectorStore:
         self.metadata_dir = metadata_dir
         self.downloaded_data_path = os.path.join(self.metadata_dir, "downloaded_data_index.csv")
         self.db = None
+        self.canonical_ids = deduplicator.get_canonical_ids() if deduplicator else {}
+        self.references = deduplicator.get_references() if deduplicator else {}
 
         # Add the "in_vector_db" flag to the downloaded data
         self.downloaded_data = pd.read_csv(self.downloaded_data_path)
@@ -64,11 +69,10 @@ class VectorStore:
                 continue
             else:
                 file_path = row["file_chunks_path"]
-                file_metadata_path = file_path.rsplit(".", 1)[0] + ".metadata"
 
                 # Add to the vector DB and update the downloaded_data to show it' sin the DB
                 try:
-                    self.add_file_to_vector_store(file_path, file_metadata_path)
+                    self.add_file_to_vector_store(file_path)
                     self.downloaded_data.loc[idx, "in_vector_db"] = True
                     self.downloaded_data.to_csv(self.downloaded_data_path, index=False)
                 except Exception as e:
@@ -78,44 +82,75 @@ class VectorStore:
                     self.db.save_local(self.vector_db_path)
         # Save the vector store locally
         self.db.save_local(self.vector_db_path)  # Save on every iteration in case of crash
+        # Published with the index, for the re-ranking of the retrieval service
+        with metrics.timer("rerank_features"):
+            write_rerank_features(self.db, self.vector_db_path)
         return
 
-    def add_file_to_vector_store(self, data_path, metadata_path):
+    def add_file_to_vector_store(self, data_path):
         """
-        Adds a file to the vector store by extracting text chunks and their metadata.
+        Adds a file to the vector store by streaming its text chunks and their metadata. The
+        chunks of the file are added to the store at once, after all of them are embedded, so a
+        failed file leaves no chunks in the store and is added again on the next run.
 
         Args:
-            data_path (str): The path of the file containing the text chunks.
-            metadata_path (str): The path of the file containing the metadata.
+            data_path (str): The path of the Parquet file containing the chunks.
 
         Returns:
             None
 
         """
-        with open(data_path, "r") as f:
-            texts = json.load(f)
-        with open(metadata_path, "r") as f:
-            metadatas = json.load(f)
+        kept = []
+        kept_ids = set()
+        for batch in iter_chunk_batches([data_path]):
+            texts, metadatas = batch_to_documents(batch)
+            ids = [get_chunk_id(row["file_id"], row["chunk_idx"]) for row in metadatas]
+
+            # Skip the duplicates of the chunks already in the store, only add their references
+            for text, metadata, chunk_id in zip(texts, metadatas, ids):
+                canonical_id = self.canonical_ids.get(chunk_id, chunk_id)
+                canonical = self.db.docstore.search(canonical_id) if self.db is not None else None
+                if isinstance(canonical, Document):
+                    if canonical_id in self.references:
+                        canonical.metadata["references"] = self.references[canonical_id]
+                    continue
+                elif canonical_id in kept_ids:
+                    continue  # The first copy is in the same file
+                # A duplicate whose first copy is not in the store yet (its file comes later or
+                # failed) is stored under the id of the first copy, so the first copy is skipped
+                # when its file is added and the text is stored once
+                metadata["references"] = self.references.get(canonical_id) or [
+                    {column: metadata.get(column) for column in REFERENCE_COLUMNS}
+                ]
+                kept.append((text, metadata, canonical_id))
+                kept_ids.add(canonical_id)
+        if not kept:
+            return
+        texts, metadatas, ids = map(list, zip(*kept))
 
         # Embed the documents manually to be able to control the rate limit of OpenAI
         embeddings = self.embed_texts(texts)
-        text_embedding_pairs = zip(texts, embeddings)
+        text_embedding_pairs = list(zip(texts, embeddings))
 
         if self.db is None:
             self.db = FAISS.from_embeddings(
-                text_embedding_pairs, self.embeddings, metadatas=metadatas
+                text_embedding_pairs, self.embeddings, metadatas=metadatas, ids=ids
             )
         else:
-            self.db.add_texts(texts, metadatas=metadatas)
+            self.db.add_embeddings(text_embedding_pairs, metadatas=metadatas, ids=ids)
 
+    @metrics.timed("embed_texts")
     def embed_texts(self, texts):
         client = OpenAI()
+        metrics.count("embed_texts.texts", len(texts))
         embeddings = []
         batch_size = 10
 
         @backoff.on_exception(backoff.expo, openai.RateLimitError)
         def get_embeddings_with_backoff(texts, model="text-embedding-3-large"):
-            response = client.embeddings.create(input=texts, model=model)
+            with metrics.timer("embed_texts.request"):
+                response = client.embeddings.create(input=texts, model=model)
+            metrics.count("embed_texts.tokens", response.usage.total_tokens)
             embeddings = [None] * len(texts)
             for choice in response.data:
                 embeddings[choice.index] = choice.embedding
@@ -0,0 +1,193 @@
+import os
+import re
+import math
+import json
+import time
+import random
+import datetime
+import functools
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+"""
+Timers, counters and histograms of the pipeline, and the report of a run.
+
+The metrics are named after the instrumented operation, e.g. "download_file.seconds" (histogram of
+the durations), "download_file.bytes" and "embed_texts.tokens" (counters). The report has the
+count, sum, p50, p95 and max of every histogram and the total of every counter, and is written as
+JSON and optionally as a Prometheus textfile (for the node exporter textfile collector).
+
+The pipeline keeps every value of a histogram for its one-shot report. A long-running process
+(the retrieval service) sets max_samples, so the percentiles of its histograms are computed over a
+uniform sample of that size (reservoir sampling), while the count, sum and max stay exact.
+"""
+
+PROMETHEUS_PREFIX = "taxgpt"
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of the sorted values."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(fraction * len(sorted_values)) - 1, 0)]
+
+
+class Histogram:
+    """
+    The values of a histogram.
+
+    Args:
+        max_samples (int, optional): The number of values kept for the percentiles. All of the
+            values are kept if None.
+    """
+
+    def __init__(self, max_samples=None):
+        self.max_samples = max_samples
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+        self.samples = []
+
+    def add(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = value if self.max is None else max(self.max, value)
+        if self.max_samples is None or len(self.samples) < self.max_samples:
+            self.samples.append(value)
+        else:
+            # Every value is kept with the probability max_samples / count
+            position = random.randrange(self.count)
+            if position < self.max_samples:
+                self.samples[position] = value
+
+
+class Metrics:
+    """
+    Thread-safe registry of the counters and histograms of a run.
+
+    Args:
+        max_samples (int, optional): The number of values kept per histogram, see Histogram.
+    """
+
+    def __init__(self, max_samples=None):
+        self._lock = threading.Lock()
+        self.max_samples = max_samples
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = datetime.datetime.utcnow().isoformat()
+            self.counters = defaultdict(float)
+            self.histograms = defaultdict(lambda: Histogram(self.max_samples))
+
+    def set_max_samples(self, max_samples):
+        """Bounds the values kept per histogram, for the long-running processes."""
+        with self._lock:
+            self.max_samples = max_samples
+            for name, histogram in self.histograms.items():
+                bounded = Histogram(max_samples)
+                for value in histogram.samples:
+                    bounded.add(value)
+                bounded.count, bounded.sum, bounded.max = (
+                    histogram.count,
+                    histogram.sum,
+                    histogram.max,
+                )
+                self.histograms[name] = bounded
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name, value):
+        with self._lock:
+            self.histograms[name].add(value)
+
+    @contextmanager
+    def timer(self, name):
+        """Records the duration of the block in the histogram <name>.seconds (also on errors)."""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.count(f"{name}.errors")
+            raise
+        finally:
+            self.observe(f"{name}.seconds", time.perf_counter() - start)
+
+    def timed(self, name):
+        """Decorator recording the duration of every call of the function, see timer."""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def report(self):
+        """Returns the summary of all of the metrics."""
+        with self._lock:
+            histograms = {
+                name: (histogram.count, histogram.sum, histogram.max, sorted(histogram.samples))
+                for name, histogram in self.histograms.items()
+            }
+            counters = dict(self.counters)
+        return {
+            "started": self.started,
+            "finished": datetime.datetime.utcnow().isoformat(),
+            "histograms": {
+                name: {
+                    "count": count,
+                    "sum": total,
+                    "p50": percentile(samples, 0.5),
+                    "p95": percentile(samples, 0.95),
+                    "max": maximum,
+                }
+                for name, (count, total, maximum, samples) in sorted(histograms.items())
+            },
+            "counters": dict(sorted(counters.items())),
+        }
+
+    def write_report(self, report_path, prometheus_path=None):
+        """Writes the report as JSON and, optionally, as a Prometheus textfile."""
+        report = self.report()
+        os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+        if prometheus_path is not None:
+            # Write and rename, the textfile collector must never read a partial file
+            with open(prometheus_path + ".part", "w") as f:
+                f.write(to_prometheus(report))
+            os.replace(prometheus_path + ".part", prometheus_path)
+        return report
+
+
+def _prometheus_name(name):
+    return f"{PROMETHEUS_PREFIX}_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def to_prometheus(report):
+    """Formats the report in the Prometheus text exposition format."""
+    lines = []
+    for name, summary in report["histograms"].items():
+        metric = _prometheus_name(name)
+        lines.append(f"# TYPE {metric} summary")
+        for key, quantile in [("p50", "0.5"), ("p95", "0.95")]:
+            if summary[key] is not None:
+                lines.append(f'{metric}{{quantile="{quantile}"}} {summary[key]}')
+        lines.append(f"{metric}_sum {summary['sum']}")
+        lines.append(f"{metric}_count {summary['count']}")
+    for name, value in report["counters"].items():
+        metric = _prometheus_name(name) + "_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+
+# The metrics of the current process
+metrics = Metrics()
@@ -0,0 +1,106 @@
+import os
+import re
+import hashlib
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+"""
+Columnar dataset of the file chunks.
+
+Every converted file is written as one Parquet file, partitioned by the tax area
+(<file_chunks_data_dir>/area=<area>/<file_name>.parquet). The chunk level columns (text, index,
+number of tokens, content hash and the article path) are stored per chunk, while the file level
+metadata is dictionary encoded, so it is stored once per file instead of repeated for every chunk.
+The downstream stages stream the dataset in record batches.
+"""
+
+CHUNK_COLUMNS = ["text", "chunk_idx", "n_tokens", "content_hash", "article_path"]
+FILE_METADATA_COLUMNS = [
+    "file_id",
+    "date_downloaded",
+    "area_name",
+    "reference_name",
+    "details_section",
+    "details_href_name",
+    "raw_filepath",
+]
+CHUNK_SCHEMA = pa.schema(
+    [
+        ("text", pa.string()),
+        ("chunk_idx", pa.int32()),
+        ("n_tokens", pa.int32()),
+        ("content_hash", pa.string()),
+        ("article_path", pa.dictionary(pa.int32(), pa.string())),
+    ]
+    + [(column, pa.dictionary(pa.int32(), pa.string())) for column in FILE_METADATA_COLUMNS]
+)
+BATCH_SIZE = 1024
+
+
+def get_content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def get_chunk_file_path(file_chunks_data_dir, area_name, file_name):
+    """Returns the path of the Parquet file of the chunks, within the partition of the area."""
+    area = re.sub(r"[^\w-]+", "_", str(area_name)).strip("_") or "unknown"
+    return os.path.join(file_chunks_data_dir, f"area={area}", file_name + ".parquet")
+
+
+def write_file_chunks(save_path, chunks, chunks_metadata, file_metadata):
+    """
+    Writes the chunks of a file and their metadata into a Parquet file.
+
+    Args:
+        save_path (str): The path of the Parquet file.
+        chunks (list): The chunk texts.
+        chunks_metadata (list): The chunk level metadata (chunk_idx, n_tokens, article_path).
+        file_metadata (dict): The file level metadata, the same for all chunks.
+    """
+    columns = {
+        "text": chunks,
+        "chunk_idx": [
+            metadata.get("chunk_idx", idx) for idx, metadata in enumerate(chunks_metadata)
+        ],
+        "n_tokens": [metadata.get("n_tokens") for metadata in chunks_metadata],
+        "content_hash": [get_content_hash(chunk) for chunk in chunks],
+        "article_path": [metadata.get("article_path") for metadata in chunks_metadata],
+    }
+    for column in FILE_METADATA_COLUMNS:
+        value = file_metadata.get(column)
+        # The file metadata comes from the pandas rows, where the missing values are NaN
+        columns[column] = [None if pd.isna(value) else str(value)] * len(chunks)
+
+    table = pa.Table.from_pydict(columns, schema=CHUNK_SCHEMA)
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    # Hidden temporary file, so it is never read as a part of the dataset
+    part_path = os.path.join(os.path.dirname(save_path), "." + os.path.basename(save_path))
+    pq.write_table(table, part_path)
+    os.replace(part_path, save_path)
+
+
+def iter_chunk_batches(paths, batch_size=BATCH_SIZE, columns=None):
+    """
+    Streams the chunks of the given Parquet files (or of the whole dataset directory) in record
+    batches, without loading the dataset into memory.
+
+    Yields:
+        pyarrow.RecordBatch: The next batch of at most batch_size chunks.
+    """
+    dataset = ds.dataset(paths, schema=CHUNK_SCHEMA, format="parquet")
+    yield from dataset.to_batches(columns=columns, batch_size=batch_size)
+
+
+def batch_to_documents(batch):
+    """
+    Converts a record batch into the texts and the metadata dicts of the chunks, as expected by
+    the vector store.
+
+    Returns:
+        tuple: The list of the texts and the list of the metadata dicts.
+    """
+    rows = batch.to_pylist()
+    texts = [row.pop("text") for row in rows]
+    return texts, rows
@@ -0,0 +1,324 @@
+import os
+import re
+import zlib
+import hashlib
+import logging
+import numpy as np
+import pandas as pd
+from collections import defaultdict
+from app.parser.chunk_dataset import iter_chunk_batches
+
+"""
+Detection of the near-duplicate documents and chunks, before they are embedded.
+
+The same law is published under many references (several tax areas, the consolidated versions on
+PISRS and uradni-list, ...). Every chunk gets a MinHash signature of its word shingles, and the
+signatures are indexed with LSH (locality sensitive hashing), so the near-duplicates are found
+without comparing all pairs. The duplicates of a chunk are embedded once: the first copy is kept
+and carries the references of all its copies in the metadata.
+
+The consolidated versions of a law differ from each other in a few amounts, dates or years, well
+above the similarity threshold. The near-duplicates are therefore only collapsed if they are the
+same article (article_path) and have the same numbers, other chunks are only collapsed if their
+text is exactly the same.
+"""
+
+DEDUP_INDEX_NAME = "dedup_index.parquet"
+REFERENCE_COLUMNS = ["file_id", "area_name", "reference_name", "details_href_name"]
+
+NUM_PERM = 128
+LSH_BANDS = 16  # 16 bands of 8 rows, candidates start at a similarity of ~0.7
+SHINGLE_SIZE = 5
+MERSENNE_PRIME = (1 << 31) - 1
+NUMBER_RE = re.compile(r"\d+(?:[.,]\d+)*")
+INDEX_COLUMNS = [
+    "chunk_id",
+    "chunk_idx",
+    "content_hash",
+    "signature",
+    "dedup_key",
+    "duplicate_of",
+    "document_duplicate_of",
+    "chunks_path",
+    "chunks_mtime",
+]
+
+
+def get_chunk_id(file_id, chunk_idx):
+    return f"{file_id}:{int(chunk_idx)}"
+
+
+class MinHasher:
+    """Computes the MinHash signatures of the texts, from their word shingles."""
+
+    def __init__(self, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=1):
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, MERSENNE_PRIME, size=(num_perm, 1), dtype=np.uint64)
+        self.b = rng.integers(0, MERSENNE_PRIME, size=(num_perm, 1), dtype=np.uint64)
+        self.shingle_size = shingle_size
+
+    def shingles(self, text):
+        words = re.findall(r"\w+", text.lower())
+        if len(words) <= self.shingle_size:
+            return {" ".join(words)}
+        return {
+            " ".join(words[i : i + self.shingle_size])  # noqa: E203
+            for i in range(len(words) - self.shingle_size + 1)
+        }
+
+    def signature(self, text):
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode()) & MERSENNE_PRIME for shingle in self.shingles(text)),
+            dtype=np.uint64,
+        )
+        return ((self.a * hashes + self.b) % MERSENNE_PRIME).min(axis=1).astype(np.uint32)
+
+
+def get_dedup_key(text, article_path):
+    """
+    Returns the key that the near-duplicates of the chunk must share: its article and its
+    numbers (the amounts, dates and years), in order.
+    """
+    numbers = " ".join(NUMBER_RE.findall(text))
+    key = f"{article_path or ''}\x00{numbers}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def estimate_similarity(signature, other_signature):
+    """Estimates the Jaccard similarity of the shingles from the MinHash signatures."""
+    return float(np.mean(signature == other_signature))
+
+
+class MinHashLSH:
+    """Index of the MinHash signatures, returning the candidate near-duplicates of a signature."""
+
+    def __init__(self, bands=LSH_BANDS):
+        self.bands = bands
+        self.tables = [defaultdict(list) for _ in range(bands)]
+
+    def _band_keys(self, signature):
+        return [band.tobytes() for band in np.array_split(signature, self.bands)]
+
+    def insert(self, key, signature):
+        for table, band_key in zip(self.tables, self._band_keys(signature)):
+            table[band_key].append(key)
+
+    def query(self, signature):
+        # Ordered set, the candidates are returned in the order of insertion of their first band
+        candidates = {}
+        for table, band_key in zip(self.tables, self._band_keys(signature)):
+            for key in table.get(band_key, []):
+                candidates.setdefault(key, None)
+        return list(candidates)
+
+
+class Deduplicator:
+    """
+    Finds the near-duplicate documents and chunks of the chunk dataset.
+
+    The index (dedup_index.parquet in the metadata directory) has a row for every chunk with its
+    signature and, for the duplicates, the id of the first copy of the chunk (duplicate_of) and
+    of the first copy of the whole document (document_duplicate_of). The index is updated
+    incrementally, only the new and the re-chunked files are compared against the already indexed
+    chunks. The entries of a re-chunked file are evicted first, with the entries of the files
+    that are duplicates of it, which are indexed again as well.
+
+    Args:
+        metadata_dir (str): The directory with the downloaded_data_index.csv and the index.
+        threshold (float): The minimum estimated Jaccard similarity of the duplicates.
+    """
+
+    def __init__(self, metadata_dir, threshold=0.85, num_perm=NUM_PERM, bands=LSH_BANDS):
+        self.metadata_dir = metadata_dir
+        self.index_path = os.path.join(metadata_dir, DEDUP_INDEX_NAME)
+        self.threshold = threshold
+        self.hasher = MinHasher(num_perm=num_perm)
+        self.bands = bands
+        self.index = self._load_index()
+
+    def _load_index(self):
+        if os.path.exists(self.index_path):
+            return pd.read_parquet(self.index_path)
+        return pd.DataFrame(columns=INDEX_COLUMNS + REFERENCE_COLUMNS)
+
+    def _get_indexed_chunk_files(self):
+        """Returns the chunk file path and modification time of every indexed file."""
+        if "chunks_path" not in self.index.columns:
+            return {}  # Index of an older version, all of the files are indexed again
+        files = self.index.drop_duplicates("file_id")
+        return {
+            str(file_id): (path, mtime)
+            for file_id, path, mtime in zip(
+                files["file_id"], files["chunks_path"], files["chunks_mtime"]
+            )
+        }
+
+    def evict(self, file_ids):
+        """
+        Removes the entries of the files from the index, and of the files whose chunks or
+        document are duplicates of them (their canonical ids would be stale).
+
+        Returns:
+            set: The ids of all of the evicted files.
+        """
+        evicted = set(file_ids)
+        file_id_column = self.index["file_id"].astype(str)
+        while True:
+            evicted_chunk_ids = set(self.index.loc[file_id_column.isin(evicted), "chunk_id"])
+            dependents = self.index["duplicate_of"].isin(evicted_chunk_ids) | self.index[
+                "document_duplicate_of"
+            ].astype(str).isin(evicted)
+            new_evicted = set(file_id_column[dependents]) - evicted
+            if not new_evicted:
+                break
+            evicted |= new_evicted
+        self.index = self.index[~file_id_column.isin(evicted)].reset_index(drop=True)
+        return evicted
+
+    def update(self):
+        """
+        Adds the chunks of the newly chunked (or re-chunked) files to the index and finds their
+        duplicates.
+        """
+        downloaded_data = pd.read_csv(os.path.join(self.metadata_dir, "downloaded_data_index.csv"))
+        chunk_files = {
+            str(file_id): (path, os.path.getmtime(path))
+            for file_id, path in zip(
+                downloaded_data["file_id"], downloaded_data["file_chunks_path"]
+            )
+            if pd.notna(path) and str(path).endswith(".parquet") and os.path.exists(path)
+        }
+        indexed_files = self._get_indexed_chunk_files()
+        changed_files = {
+            file_id
+            for file_id, chunk_file in chunk_files.items()
+            if indexed_files.get(file_id) != chunk_file
+        }
+        evicted_files = set()
+        if not self.index.empty:
+            evicted_files = self.evict(changed_files & set(self.index["file_id"].astype(str)))
+        if evicted_files:
+            logging.info(f"Evicted {len(evicted_files)} re-chunked files from the dedup index")
+        files_to_index = [
+            file_id
+            for file_id in chunk_files
+            if file_id in changed_files or file_id in evicted_files
+        ]
+        if not files_to_index:
+            if evicted_files:
+                self.save()
+            return self.index
+
+        chunk_lsh, document_lsh = MinHashLSH(self.bands), MinHashLSH(self.bands)
+        signatures, document_signatures = {}, {}
+        dedup_keys = {}
+        by_content_hash = {}
+        for row in self.index.itertuples():
+            signature = np.asarray(row.signature, dtype=np.uint32)
+            signatures[row.chunk_id] = signature
+            dedup_keys[row.chunk_id] = getattr(row, "dedup_key", None)
+            if pd.isna(row.duplicate_of):
+                chunk_lsh.insert(row.chunk_id, signature)
+                by_content_hash.setdefault(row.content_hash, row.chunk_id)
+            document_signatures[row.file_id] = np.minimum(
+                document_signatures.get(row.file_id, signature), signature
+            )
+        duplicate_documents = set(
+            self.index.loc[self.index["document_duplicate_of"].notna(), "file_id"]
+        )
+        for file_id, signature in document_signatures.items():
+            if file_id not in duplicate_documents:
+                document_lsh.insert(file_id, signature)
+
+        new_rows = []
+        for file_id in files_to_index:
+            path, mtime = chunk_files[file_id]
+            file_rows = []
+            for batch in iter_chunk_batches(
+                [path],
+                columns=["text", "chunk_idx", "content_hash", "article_path"] + REFERENCE_COLUMNS,
+            ):
+                for row in batch.to_pylist():
+                    text = row.pop("text")
+                    row["chunk_id"] = get_chunk_id(row["file_id"], row["chunk_idx"])
+                    row["signature"] = self.hasher.signature(text)
+                    row["dedup_key"] = get_dedup_key(text, row.pop("article_path"))
+                    row["chunks_path"] = path
+                    row["chunks_mtime"] = mtime
+                    file_rows.append(row)
+            if not file_rows:
+                continue
+
+            # Near-duplicate documents: the signature of the union of the shingles is the
+            # elementwise minimum of the chunk signatures
+            document_signature = np.minimum.reduce([row["signature"] for row in file_rows])
+            document_duplicate_of = self._find_duplicate(
+                document_signature, document_lsh, document_signatures
+            )
+            file_id = file_rows[0]["file_id"]
+            if document_duplicate_of is None:
+                document_lsh.insert(file_id, document_signature)
+            document_signatures[file_id] = document_signature
+
+            for row in file_rows:
+                duplicate_of = by_content_hash.get(row["content_hash"]) or self._find_duplicate(
+                    row["signature"], chunk_lsh, signatures, dedup_keys, row["dedup_key"]
+                )
+                if duplicate_of is None:
+                    chunk_lsh.insert(row["chunk_id"], row["signature"])
+                    by_content_hash[row["content_hash"]] = row["chunk_id"]
+                signatures[row["chunk_id"]] = row["signature"]
+                dedup_keys[row["chunk_id"]] = row["dedup_key"]
+                row["duplicate_of"] = duplicate_of
+                row["document_duplicate_of"] = document_duplicate_of
+                new_rows.append(row)
+
+        if not new_rows:
+            self.save()
+            return self.index
+        new_index = pd.DataFrame(new_rows)
+        n_duplicates = new_index["duplicate_of"].notna().sum()
+        n_duplicate_documents = new_index.drop_duplicates("file_id")["document_duplicate_of"]
+        logging.info(
+            f"Deduplicated {len(files_to_index)} files: {n_duplicates} of {len(new_index)} chunks "
+            f"and {n_duplicate_documents.notna().sum()} documents are near-duplicates"
+        )
+        self.index = pd.concat([self.index, new_index], ignore_index=True)
+        self.save()
+        return self.index
+
+    def _find_duplicate(self, signature, lsh, signatures, dedup_keys=None, dedup_key=None):
+        for candidate in lsh.query(signature):
+            if dedup_keys is not None and dedup_keys.get(candidate) != dedup_key:
+                continue  # Another article, or another version of the article
+            if estimate_similarity(signature, signatures[candidate]) >= self.threshold:
+                return candidate
+        return None
+
+    def save(self):
+        index = self.index.copy()
+        index["signature"] = index["signature"].map(lambda sig: np.asarray(sig).tolist())
+        index.to_parquet(self.index_path + ".part", index=False)
+        os.replace(self.index_path + ".part", self.index_path)
+
+    def get_canonical_ids(self):
+        """Returns the mapping of the chunk ids to the id of their first copy."""
+        return {
+            chunk_id: duplicate_of if pd.notna(duplicate_of) else chunk_id
+            for chunk_id, duplicate_of in zip(self.index["chunk_id"], self.index["duplicate_of"])
+        }
+
+    def get_references(self):
+        """
+        Returns the mapping of the id of the first copy of a chunk to the references (file_id,
+        area, reference and file name) of all of its copies.
+        """
+        references = defaultdict(list)
+        for row in self.index.itertuples():
+            canonical_id = row.duplicate_of if pd.notna(row.duplicate_of) else row.chunk_id
+            if any(ref["file_id"] == row.file_id for ref in references[canonical_id]):
+                continue  # Repeated text within the same file
+            references[canonical_id].append(
+                {column: getattr(row, column) for column in REFERENCE_COLUMNS}
+            )
+        return references
@@ -0,0 +1,218 @@
+import re
+
+"""
+Structure-aware chunking of the Slovenian legal texts.
+
+The markdown produced by the FileProcessor is parsed into a hierarchy of units:
+law -> poglavje (chapter, part or section heading) -> člen (article) -> odstavek (paragraph) and
+tables. The chunks are packed from whole units up to the token budget: several short articles of
+the same chapter go into one chunk, a long article is split between its paragraphs and only a
+paragraph (or table) that alone exceeds the budget is split into overlapping token windows.
+"""
+
+# e.g. "I. SPLOŠNE DOLOČBE", "1. poglavje", "DRUGI DEL", "3. oddelek: Davčna osnova"
+CHAPTER_RE = re.compile(
+    r"^(?:[IVXLC]+\.\s+[A-ZČŠŽĆĐ][^a-zčšžćđ]{2,}"
+    r"|(?:\d+|[IVXLC]+)\.?\s*(?:[Pp]oglavje|[Dd]el|[Oo]ddelek|[Pp]ododdelek)\b.*"
+    r"|[A-ZČŠŽ]+\s+(?:DEL|POGLAVJE|ODDELEK)\b.*)$"
+)
+# e.g. "1. člen", "15.a člen", "**23. člen**"
+ARTICLE_RE = re.compile(r"^(\d+\.?\s*[a-z]?\.?\s*člen)\b", re.IGNORECASE)
+MARKDOWN_HEADING_RE = re.compile(r"^#{1,6}\s+")
+LAW_TITLE_RE = re.compile(r"^#\s+")
+PATH_SEPARATOR = " > "
+
+
+def _clean_heading(line):
+    # Remove the markdown decorations, e.g. "## **1. člen**" -> "1. člen"
+    line = MARKDOWN_HEADING_RE.sub("", line.strip())
+    return line.strip("*_ ").strip()
+
+
+class _Article:
+    def __init__(self, law, chapter, label, heading=None):
+        self.law = law
+        self.chapter = chapter
+        self.label = label
+        self.blocks = [heading] if heading else []  # odstavki and tables
+        self.n_headings = len(self.blocks)  # The leading blocks that are headings
+
+    @property
+    def path(self):
+        return PATH_SEPARATOR.join(part for part in [self.law, self.chapter, self.label] if part)
+
+
+def parse_legal_markdown(text):
+    """
+    Parses the markdown text into the articles (or sections, for the non-legal documents), each
+    with its blocks (paragraphs and tables).
+
+    Returns:
+        list: The _Article objects in the order of the document.
+    """
+    articles = [_Article(None, None, None)]
+    law = None
+    chapter = None
+    paragraph_lines = []
+    table_lines = []
+
+    def flush():
+        if paragraph_lines:
+            articles[-1].blocks.append("\n".join(paragraph_lines).strip())
+            paragraph_lines.clear()
+        if table_lines:
+            articles[-1].blocks.append("\n".join(table_lines).strip())
+            table_lines.clear()
+
+    for line in text.splitlines():
+        stripped = line.strip()
+        heading = _clean_heading(line)
+        if stripped.startswith("|"):
+            if paragraph_lines:
+                flush()
+            table_lines.append(line)
+            continue
+        elif table_lines:
+            flush()
+
+        if not stripped:
+            flush()
+        elif ARTICLE_RE.match(heading) and len(heading) < 40:
+            flush()
+            articles.append(_Article(law, chapter, heading, stripped))
+        elif LAW_TITLE_RE.match(stripped):
+            flush()
+            law, chapter = heading[:200], None
+            articles.append(_Article(law, None, None, stripped))
+        elif CHAPTER_RE.match(heading) or MARKDOWN_HEADING_RE.match(stripped):
+            flush()
+            if articles[-1].label is None and len(articles[-1].blocks) == 1 and chapter:
+                # Nested headings without text in between, e.g. "II. DEL" and "1. poglavje"
+                chapter = f"{chapter}{PATH_SEPARATOR}{heading[:200]}"
+            else:
+                chapter = heading[:200]
+            articles.append(_Article(law, chapter, None, stripped))
+        else:
+            paragraph_lines.append(line)
+    flush()
+
+    articles = [article for article in articles if article.blocks]
+    for article, next_article in zip(articles, articles[1:]):
+        # Move the headings without their own text to the next article
+        if article.label is None and len(article.blocks) == article.n_headings:
+            next_article.blocks[:0] = article.blocks
+            next_article.n_headings += article.n_headings
+            article.blocks = []
+    articles = [article for article in articles if article.blocks]
+    for article in articles:
+        # Keep the headings and the title of the article, e.g. "(vsebina zakona)", together with
+        # the first paragraph, also when the article is split
+        n_merged = article.n_headings + 1
+        title = article.blocks[article.n_headings] if len(article.blocks) > n_merged else ""
+        if title.startswith("(") and title.endswith(")") and len(title) < 200:
+            n_merged += 1
+        article.blocks[:n_merged] = ["\n\n".join(article.blocks[:n_merged])]
+    return articles
+
+
+def split_token_windows(enc, text, max_tokens, overlap_tokens):
+    """
+    Splits the text into overlapping windows of max_tokens tokens. The windows are cut from the
+    original text at the character offsets of the tokens, instead of decoding every window.
+
+    Returns:
+        list: The (window_text, n_tokens) tuples.
+    """
+    tokens = enc.encode(text)
+    if len(tokens) <= max_tokens:
+        return [(text, len(tokens))] if tokens else []
+    decoded, offsets = enc.decode_with_offsets(tokens)
+    offsets.append(len(decoded))
+
+    windows = []
+    for i in range(0, len(tokens), max_tokens - overlap_tokens):
+        end = min(i + max_tokens, len(tokens))
+        windows.append((decoded[offsets[i] : offsets[end]], end - i))  # noqa: E203
+        if end == len(tokens):
+            break
+    return windows
+
+
+class LegalTextChunker:
+    """
+    Packs the structural units of a (legal) markdown document into chunks.
+
+    Args:
+        encoder (tiktoken.Encoding): The encoder used to count the tokens.
+        max_tokens (int): The token budget of a chunk.
+        overlap_tokens (int): The overlap of the windows, when a single unit has to be split.
+    """
+
+    def __init__(self, encoder, max_tokens=2048, overlap_tokens=512):
+        self.encoder = encoder
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+
+    def chunk(self, text):
+        """
+        Chunks the text.
+
+        Returns:
+            tuple: The list of the chunk texts and the list of the chunk metadata (chunk_idx,
+                article_path and n_tokens).
+        """
+        chunks = []  # (text, article_path, n_tokens)
+        current = []  # (block, tokens, article)
+
+        def flush():
+            if current:
+                chunks.append(self._join(current))
+                current.clear()
+
+        for article in parse_legal_markdown(text):
+            blocks = [(block, len(self.encoder.encode(block)), article) for block in article.blocks]
+            article_tokens = sum(tokens for _, tokens, _ in blocks)
+            current_tokens = sum(tokens for _, tokens, _ in current)
+
+            # Keep the chunks within one chapter and the articles whole, if possible
+            if current and (
+                (current[-1][2].law, current[-1][2].chapter) != (article.law, article.chapter)
+                or current_tokens + article_tokens > self.max_tokens
+            ):
+                flush()
+                current_tokens = 0
+            if article_tokens <= self.max_tokens:
+                current.extend(blocks)
+                continue
+
+            # The article is too long, split it between its blocks
+            for block, tokens, _ in blocks:
+                if current and current_tokens + tokens > self.max_tokens:
+                    flush()
+                    current_tokens = 0
+                if tokens <= self.max_tokens:
+                    current.append((block, tokens, article))
+                    current_tokens += tokens
+                    continue
+                # A single block over the budget, split it into overlapping windows
+                for window_text, window_tokens in split_token_windows(
+                    self.encoder, block, self.max_tokens, self.overlap_tokens
+                ):
+                    chunks.append((window_text, article.path, window_tokens))
+        flush()
+
+        chunk_texts = [chunk_text for chunk_text, _, _ in chunks]
+        chunk_metadata = [
+            {"chunk_idx": idx, "article_path": article_path, "n_tokens": n_tokens}
+            for idx, (_, article_path, n_tokens) in enumerate(chunks)
+        ]
+        return chunk_texts, chunk_metadata
+
+    def _join(self, blocks):
+        text = "\n\n".join(block for block, _, _ in blocks)
+        n_tokens = sum(tokens for _, tokens, _ in blocks)
+        first, last = blocks[0][2], blocks[-1][2]
+        if first is last or first.label is None or last.label is None:
+            return text, last.path if first.label is None else first.path, n_tokens
+        # Several articles of the same chapter, e.g. "ZDoh-2 > I. DEL > 1. člen - 5. člen"
+        return text, f"{first.path} - {last.label}", n_tokens
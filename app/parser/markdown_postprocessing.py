@@ -0,0 +1,115 @@
+import re
+
+"""
+In-memory post-processing of the converted markdown.
+
+The converters return the markdown text, which goes once through a chain of normalizers (each a
+function text -> text) before the single write to the disk. A normalizer may return None, to
+discard the whole document (e.g. when the conversion produced no text).
+"""
+
+IMAGE_DATA_RE = re.compile(r"!\[image\]\(([^)]+)\)")
+# Noise of the FURS pages, e.g. the image credits "Foto: Bigstock"
+BOILERPLATE_RES = [
+    re.compile(r"^[ \t]*[*_]*(?:foto|vir|slika)?:?[ \t]*bigstock\b.*$", re.I | re.M),
+]
+TABLE_ROW_RE = re.compile(r"^[ \t]*\|.*\|[ \t]*$")
+TABLE_SEPARATOR_RE = re.compile(r"^[ \t]*\|(?:[ \t]*:?-+:?[ \t]*\|)+[ \t]*$")
+# The cells are separated by the unescaped pipes, "\|" is a pipe within a cell
+CELL_SEPARATOR_RE = re.compile(r"(?<!\\)\|")
+
+
+def strip_image_data(text):
+    # In the markdown text, there can be images like this: ![image](encoded image)
+    # We remove the image data, i.e. the full ![image](encoded image), and keep the text only
+    return IMAGE_DATA_RE.sub("", text)
+
+
+def remove_boilerplate(text):
+    for boilerplate_re in BOILERPLATE_RES:
+        text = boilerplate_re.sub("", text)
+    return text
+
+
+def normalize_whitespace(text):
+    text = text.replace("\r\n", "\n").replace("\r", "\n").replace("\xa0", " ")
+    text = re.sub(r"[ \t]+$", "", text, flags=re.M)
+    text = re.sub(r"\n{3,}", "\n\n", text)
+    return text.strip() + "\n"
+
+
+def normalize_row(line):
+    cells = [
+        re.sub(r"\s+", " ", cell).strip()
+        for cell in CELL_SEPARATOR_RE.split(line.strip()[1:-1])
+    ]
+    return "| " + " | ".join(cells) + " |"
+
+
+def normalize_tables(text):
+    """
+    Trims the padding of the table cells and separates the tables from the text. Only the rows of
+    the tables (a header row, followed by a |---| separator row) outside of the code blocks are
+    changed, not the other lines that start and end with a |.
+    """
+    lines = text.split("\n")
+    output = []
+    in_code = False
+    i = 0
+    while i < len(lines):
+        if lines[i].lstrip().startswith("```"):
+            in_code = not in_code
+        if in_code or not (
+            TABLE_ROW_RE.match(lines[i])
+            and i + 1 < len(lines)
+            and TABLE_SEPARATOR_RE.match(lines[i + 1])
+        ):
+            output.append(lines[i])
+            i += 1
+            continue
+        end = i + 2
+        while end < len(lines) and TABLE_ROW_RE.match(lines[end]):
+            end += 1
+        if output and output[-1] != "":
+            output.append("")
+        output.extend(normalize_row(line) for line in lines[i:end])
+        if end < len(lines) and lines[end] != "":
+            output.append("")
+        i = end
+    return "\n".join(output)
+
+
+def validate_not_empty(text):
+    # If the converted document is actually empty, it is discarded
+    if not text.strip():
+        return None
+    return text
+
+
+DEFAULT_NORMALIZERS = [
+    strip_image_data,
+    remove_boilerplate,
+    normalize_whitespace,
+    normalize_tables,
+    validate_not_empty,
+]
+
+
+class MarkdownPostProcessor:
+    """
+    Runs the chain of normalizers over the converted markdown.
+
+    Args:
+        normalizers (list, optional): The functions text -> text (or None to discard the text),
+            applied in order. Defaults to DEFAULT_NORMALIZERS.
+    """
+
+    def __init__(self, normalizers=None):
+        self.normalizers = list(DEFAULT_NORMALIZERS if normalizers is None else normalizers)
+
+    def __call__(self, text):
+        for normalizer in self.normalizers:
+            if text is None:
+                return None
+            text = normalizer(text)
+        return text
@@ -1,29 +1,61 @@
 from dotenv import load_dotenv
 import pandas as pd
 import os
-import json
 import tiktoken
-import re
 import html2text
+import time
+import tempfile
 import subprocess
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from tabulate import tabulate
 from app.utils import suppress_logging, restore_logging
-from marker.convert import convert_single_pdf
-from marker.models import load_all_models
+from app.metrics import metrics
+from app.parser.legal_chunker import LegalTextChunker, split_token_windows
+from app.parser.chunk_dataset import get_chunk_file_path, write_file_chunks
+from app.parser.markdown_postprocessing import MarkdownPostProcessor
+
+
+# The marker models are loaded once per process and shared by all of the FileProcessors (the
+# convert stages of the sources run concurrently). The PDFs are converted one at a time
+PDF_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def get_pdf_models():
+    # marker loads torch and the models, only import it once a PDF is converted
+    from marker.models import load_all_models
+
+    return load_all_models()
 
 
 class FileProcessor:
-    def __init__(self, converted_data_dir, metadata_dir):
+    def __init__(self, converted_data_dir, metadata_dir, postprocessor=None):
         self.converted_data_dir = converted_data_dir
         self.metadata_dir = metadata_dir
-        self.downloaded_data = pd.read_csv(os.path.join(metadata_dir, "downloaded_data_index.csv"))
-        self.model_list = None
+        # processed_filepath is read as float if none of the files is converted yet (e.g. of a
+        # new source)
+        self.downloaded_data = pd.read_csv(
+            os.path.join(metadata_dir, "downloaded_data_index.csv"),
+            dtype={"processed_filepath": object},
+        )
+        # Chain of the normalizers run over the converted text, before it is written
+        self.postprocessor = postprocessor or MarkdownPostProcessor()
+
+    def convert_all_files(self, workers=None):
+        """
+        Converts the downloaded files that are not converted yet.
+
+        Args:
+            workers (int, optional): The number of threads converting the files. The PDFs are
+                converted one at a time in any case.
+        """
+        files_to_convert = []
+        for idx, row in self.downloaded_data.iterrows():
 
-    def convert_all_files(self):
-        for idx, row in tqdm(self.downloaded_data.iterrows(), total=self.downloaded_data.shape[0]):
-
-            file_type = row["file_type"]
             original_path = row["downloaded_path"]
             converted_path = row["processed_filepath"]
             file_name = os.path.splitext(os.path.basename(original_path))[0]
@@ -37,131 +69,161 @@ class FileProcessor:
                     os.path.join(self.metadata_dir, "downloaded_data_index.csv"), index=False
                 )
                 continue
+            files_to_convert.append((idx, row["file_type"], original_path, expected_save_path))
+
+        with ThreadPoolExecutor(max_workers=workers or 1) as executor:
+            futures = {
+                executor.submit(self.convert_file, *file_args[1:]): file_args[0]
+                for file_args in files_to_convert
+            }
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                idx = futures[future]
+                saved_path, _ = future.result()
+                if saved_path is False:
+                    continue  # File type not supported
+
+                print("Converted file.")
+                self.downloaded_data.at[idx, "processed_filepath"] = saved_path
+                self.downloaded_data.to_csv(
+                    os.path.join(self.metadata_dir, "downloaded_data_index.csv"), index=False
+                )
 
-            try:
-                if file_type == "pdf":
-                    if self.model_list is None:
-                        self.model_list = load_all_models()
-                    saved_path = FileProcessor.convert_pdf_to_md(
-                        original_path, file_name, self.converted_data_dir, self.model_list
-                    )
-                elif file_type == "html":
-                    saved_path = FileProcessor.convert_html_to_md(
-                        original_path, file_name, self.converted_data_dir
-                    )
-                elif file_type == "docx":
-                    saved_path = FileProcessor.convert_docx_to_md(
-                        original_path, file_name, self.converted_data_dir
-                    )
-                elif file_type == "doc":
-                    saved_path = FileProcessor.convert_doc_to_md(
-                        original_path, file_name, self.converted_data_dir
-                    )
-                elif file_type == "xlsx":
-                    saved_path = FileProcessor.convert_xlsx_to_md(
-                        original_path, file_name, self.converted_data_dir
-                    )
-                else:
-                    print(f"File type not supported for parsing. File: {original_path}")
-                    continue
-
-                # Post processing steps: remove image data, espace special characters, validate conversion # noqa: E501
-                FileProcessor.md_remove_image_data(saved_path)
-                saved_path = FileProcessor.md_conversion_validate(saved_path)
-
-            except Exception as e:
-                print(f"File {original_path} could not be converted to md. Error: {e}")
-                saved_path = None
-
-            print("Converted file.")
-            self.downloaded_data.at[idx, "processed_filepath"] = saved_path
-            self.downloaded_data.to_csv(
-                os.path.join(self.metadata_dir, "downloaded_data_index.csv"), index=False
-            )
-
-    @staticmethod
-    def md_remove_image_data(path):
-        # In the markdown text, there can be images like this:
-        # ![image](encoded image)
-        # We want to remove the image data, i.e. the full ![image](encoded image), and return the text only # noqa: E501
-        with open(path, "r") as f:
-            text = f.read()
-            text = re.sub(r"!\[image\]\(([^)]+)\)", "", text)
-        with open(path, "w") as f:
+    def convert_file(self, file_type, original_path, save_path):
+        """
+        Converts the file to markdown, post-processes the text in memory and writes it once.
+
+        Returns:
+            tuple: The path of the markdown file and its text, so it can be chunked right away.
+                (None, None) if the conversion failed or produced no text, (False, None) if the
+                file type is not supported.
+        """
+        try:
+            if file_type == "pdf":
+                with PDF_LOCK:
+                    text = FileProcessor.convert_pdf_to_md(original_path, get_pdf_models())
+            elif file_type == "html":
+                text = FileProcessor.convert_html_to_md(original_path)
+            elif file_type == "docx":
+                text = FileProcessor.convert_docx_to_md(original_path)
+            elif file_type == "doc":
+                text = FileProcessor.convert_doc_to_md(original_path)
+            elif file_type == "xlsx":
+                text = FileProcessor.convert_xlsx_to_md(original_path)
+            else:
+                print(f"File type not supported for parsing. File: {original_path}")
+                return False, None
+
+            metrics.count(f"convert.{file_type}.bytes", os.path.getsize(original_path))
+
+            # Post processing steps: remove image data, boilerplate and extra whitespace,
+            # normalize the tables, validate conversion
+            with metrics.timer("postprocess_markdown"):
+                text = self.postprocessor(text)
+        except Exception as e:
+            print(f"File {original_path} could not be converted to md. Error: {e}")
+            return None, None
+
+        if text is None:
+            return None, None
+        with open(save_path, "w", encoding="utf-8") as f:
             f.write(text)
+        return save_path, text
 
     @staticmethod
-    def md_conversion_validate(path):
-        # If the markdown file is actually empty, then we need to remove the file
-        # and change the downlaoded_data information to None
-        with open(path, "r") as f:
-            text = f.read()
-            if len(text) == 0:
-                os.remove(path)
-                return None
-        return path
-
-    @staticmethod
-    def convert_pdf_to_md(path, file_name, converted_data_dir, models_list):
+    @metrics.timed("convert_pdf_to_md")
+    def convert_pdf_to_md(path, models_list):
+        from marker.convert import convert_single_pdf
 
         # Suppress the many logging messages when calling this function
         previous_level = suppress_logging()
         full_text, out_meta = convert_single_pdf(path, models_list, parallel_factor=1)
         restore_logging(previous_level)
-
-        save_path = os.path.join(converted_data_dir, file_name + ".md")
-        with open(save_path, "w+", encoding="utf-8") as f:
-            f.write(full_text)
-        return save_path
+        return full_text
 
     @staticmethod
-    def convert_html_to_md(path, file_name, converted_data_dir):
+    @metrics.timed("convert_html_to_md")
+    def convert_html_to_md(path):
         h = html2text.HTML2Text()
         h.ignore_links = True
         h.ignore_images = True
-        save_path = os.path.join(converted_data_dir, file_name + ".md")
 
         with open(path, "r") as fin:
-            markdown_content = h.handle(fin.read())
-            with open(save_path, "w") as fout:
-                fout.write(markdown_content)
+            return h.handle(fin.read())
 
-        return save_path
+    @staticmethod
+    @metrics.timed("convert_docx_to_md")
+    def convert_docx_to_md(path):
+        result = subprocess.run(
+            ["pandoc", "-f", "docx", "-t", "markdown", path],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        return result.stdout
 
     @staticmethod
-    def convert_docx_to_md(path, file_name, converted_data_dir):
-        save_path = os.path.join(converted_data_dir, file_name + ".md")
-        command = f"pandoc -f docx -t markdown -o {save_path} {path}"
-        subprocess.run(command, shell=True)
-        return save_path
+    @metrics.timed("convert_doc_to_md")
+    def convert_doc_to_md(path):
+        # Convert .doc to .docx using LibreOffice, into a temporary directory
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            subprocess.run(
+                ["soffice", "--headless", "--convert-to", "docx", path, "--outdir", tmp_dir],
+                capture_output=True,
+                check=True,
+            )
+            file_name = os.path.splitext(os.path.basename(path))[0]
+
+            # Now convert the .docx to .md using pandoc
+            return FileProcessor.convert_docx_to_md(os.path.join(tmp_dir, file_name + ".docx"))
 
     @staticmethod
-    def convert_doc_to_md(path, file_name, converted_data_dir):
-        # Convert .doc to .docx using LibreOffice
-        temp_docx_path = os.path.join(converted_data_dir, file_name + ".docx")
-        convert_command = f"soffice --convert-to docx {path} --outdir {converted_data_dir}"
-        subprocess.run(convert_command, shell=True)
+    @metrics.timed("convert_xlsx_to_md")
+    def convert_xlsx_to_md(path):
+        df = pd.read_excel(path)
+        return tabulate(df, headers="keys", tablefmt="pipe", showindex=False)
 
-        # Now convert the .docx to .md using pandoc
-        save_path = os.path.join(converted_data_dir, file_name + ".md")
-        pandoc_command = f"pandoc -f docx -t markdown -o {save_path} {temp_docx_path}"
-        subprocess.run(pandoc_command, shell=True)
 
-        # Optionally, remove the temporary .docx file if no longer needed
-        os.remove(temp_docx_path)
+@functools.lru_cache(maxsize=None)
+def get_encoder(embedding_model):
+    """Returns the tokenizer of the model. Loaded once per process."""
+    return tiktoken.encoding_for_model(embedding_model)
 
-        return save_path
 
-    @staticmethod
-    def convert_xlsx_to_md(path, file_name, converted_data_dir):
-        df = pd.read_excel(path)
-        markdown_content = tabulate(df, headers="keys", tablefmt="pipe", showindex=False)
-        save_path = os.path.join(converted_data_dir, file_name + ".md")
+def chunk_text_file(file_path, embedding_model, max_tokens, overlap_tokens, chunking):
+    """Chunks a converted (markdown) file, see chunk_text."""
+    with open(file_path, "r") as file:
+        text = file.read()
+    return chunk_text(text, embedding_model, max_tokens, overlap_tokens, chunking)
+
+
+def chunk_text(text, embedding_model, max_tokens, overlap_tokens, chunking):
+    """
+    Chunks the converted (markdown) text.
 
-        with open(save_path, "w") as file:
-            file.write(markdown_content)
+    Returns:
+        tuple: The list of the chunk texts and the list of the chunk metadata.
+    """
+    enc = get_encoder(embedding_model)
+    if chunking == "structure":
+        chunker = LegalTextChunker(enc, max_tokens, overlap_tokens)
+        return chunker.chunk(text)
 
-        return save_path
+    windows = split_token_windows(enc, text, max_tokens, overlap_tokens)
+    chunks = [chunk_text for chunk_text, _ in windows]
+    chunk_metadata = [
+        {"chunk_idx": idx, "n_tokens": n_tokens} for idx, (_, n_tokens) in enumerate(windows)
+    ]
+    return chunks, chunk_metadata
+
+
+def _chunk_and_save_file(processed_path, chunks_save_path, file_metadata, chunking_args):
+    # Runs in the worker processes of TextProcessor.chunk_all_files. The metrics of the worker
+    # processes are lost, so the duration and the number of tokens are returned instead
+    start = time.perf_counter()
+    chunks, chunks_metadata = chunk_text_file(processed_path, *chunking_args)
+    write_file_chunks(chunks_save_path, chunks, chunks_metadata, file_metadata)
+    n_tokens = sum(metadata.get("n_tokens") or 0 for metadata in chunks_metadata)
+    return len(chunks), n_tokens, time.perf_counter() - start
 
 
 class TextProcessor:
@@ -173,6 +235,8 @@ class TextProcessor:
         embedding_model="text-embedding-3-large",
         max_tokens=2048,
         overlap_tokens=512,
+        chunking="structure",
+        workers=None,
     ):
 
         self.converted_data_dir = converted_data_dir
@@ -182,6 +246,10 @@ class TextProcessor:
         self.embedding_model = embedding_model
         self.max_tokens = max_tokens
         self.overlap_tokens = overlap_tokens
+        # "structure": split along the articles and paragraphs, "fixed": fixed size token windows
+        self.chunking = chunking
+        # Number of processes chunking the files, defaults to the number of CPUs
+        self.workers = workers or os.cpu_count()
         os.makedirs(self.file_chunks_data_dir, exist_ok=True)
 
         # Add a column to the downloaded data, if it does not yet exist:
@@ -189,7 +257,8 @@ class TextProcessor:
             self.downloaded_data["file_chunks_path"] = pd.Series(dtype="string")
 
     def chunk_all_files(self):
-        for idx, row in tqdm(self.downloaded_data.iterrows()):
+        files_to_chunk = []
+        for idx, row in self.downloaded_data.iterrows():
             processed_path = row["processed_filepath"]  # input path
             file_chunks_path = row["file_chunks_path"]  # output path
 
@@ -199,59 +268,63 @@ class TextProcessor:
 
             # Expected output path based on input path
             file_name = os.path.splitext(os.path.basename(processed_path))[0]
-            chunk_text_save_path = os.path.join(self.file_chunks_data_dir, file_name + ".txt")
-            chunk_metadata_save_path = os.path.join(
-                self.file_chunks_data_dir, file_name + ".metadata"
+            chunks_save_path = get_chunk_file_path(
+                self.file_chunks_data_dir, row["area"], file_name
             )
-            # Check conditions
-            if not pd.isna(file_chunks_path) and os.path.exists(file_chunks_path):
+            # Check conditions. The chunks in the old JSON format (.txt) are chunked again
+            if file_chunks_path == chunks_save_path and os.path.exists(file_chunks_path):
                 continue  # Skip, output already exists
-            elif pd.isna(file_chunks_path) and os.path.exists(chunk_text_save_path):
+            elif os.path.exists(chunks_save_path):
                 # Expected output exists, but not logged. Add to reference data and skip
-                self.downloaded_data.at[idx, "file_chunks_path"] = chunk_text_save_path
-                self.downloaded_data.to_csv(
-                    os.path.join(self.metadata_dir, "downloaded_data_index.csv"), index=False
-                )
+                self.downloaded_data.at[idx, "file_chunks_path"] = chunks_save_path
                 continue
             else:
-
-                # Chunk the file
-                chunks, chunks_metadata = self.chunk_file(processed_path)
-
                 # Create the file level metadata (i.e. description of tax area,
                 #  when was the file parsed, etc.)
                 file_metadata = self.create_file_metadata(row)
-                for chunk_metadata in chunks_metadata:
-                    chunk_metadata.update(file_metadata)
-
-                # Save the chunks and their metadata
-                with open(chunk_text_save_path, "w", encoding="utf-8") as f:
-                    f.write(json.dumps(chunks, ensure_ascii=False))
-                with open(chunk_metadata_save_path, "w", encoding="utf-8") as f:
-                    f.write(json.dumps(chunks_metadata, ensure_ascii=False))
-
-                self.downloaded_data.at[idx, "file_chunks_path"] = chunk_text_save_path
-                self.downloaded_data.to_csv(
-                    os.path.join(self.metadata_dir, "downloaded_data_index.csv"), index=False
-                )
-
+                files_to_chunk.append((idx, processed_path, chunks_save_path, file_metadata))
+
+        # Chunk the files in parallel, every worker process loads the tokenizer once. The workers
+        # are spawned, not forked: the conversion may have loaded the marker models (and their
+        # threads) into this process, which must not be copied into the workers
+        chunking_args = (self.embedding_model, self.max_tokens, self.overlap_tokens, self.chunking)
+        with ProcessPoolExecutor(
+            max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+        ) as executor:
+            futures = {
+                executor.submit(_chunk_and_save_file, *file_args[1:], chunking_args): file_args
+                for file_args in files_to_chunk
+            }
+            for i, future in enumerate(tqdm(as_completed(futures), total=len(futures))):
+                idx, processed_path, chunks_save_path, _ = futures[future]
+                try:
+                    n_chunks, n_tokens, seconds = future.result()
+                except Exception as e:
+                    print(f"File {processed_path} could not be chunked. Error: {e}")
+                    metrics.count("chunk_file.errors")
+                    continue
+                metrics.observe("chunk_file.seconds", seconds)
+                metrics.count("chunk_file.chunks", n_chunks)
+                metrics.count("chunk_file.tokens", n_tokens)
+                self.downloaded_data.at[idx, "file_chunks_path"] = chunks_save_path
+                if i % 100 == 0:
+                    self.save_downloaded_data()
+        self.save_downloaded_data()
+
+    def save_downloaded_data(self):
+        self.downloaded_data.to_csv(
+            os.path.join(self.metadata_dir, "downloaded_data_index.csv"), index=False
+        )
+
+    @metrics.timed("chunk_file")
     def chunk_file(self, file_path):
-        with open(file_path, "r") as file:
-            text = file.read()
-
-        enc = tiktoken.encoding_for_model(self.embedding_model)
-        tokens = enc.encode(text)
-        chunks = []
-        for i in range(0, len(tokens), self.max_tokens - self.overlap_tokens):
-            chunk_text = enc.decode(tokens[i : min(i + self.max_tokens, len(tokens))])  # noqa E203
-            chunks.append(chunk_text)
-
-        # Create chunk metadata (placeholder for now)
-        chunk_metadata = [{"chunk_idx": idx} for idx in range(len(chunks))]
-        return chunks, chunk_metadata
+        return chunk_text_file(
+            file_path, self.embedding_model, self.max_tokens, self.overlap_tokens, self.chunking
+        )
 
     def create_file_metadata(self, row):
         file_metadata = {
+            "file_id": row["file_id"],
             "date_downloaded": row["date_downloaded"],
             "area_name": row["area"],
             "reference_name": row["subarea"],
@@ -1,26 +1,98 @@
 import os
 import argparse
 import logging
-import openai
+import threading
 from dotenv import load_dotenv, find_dotenv
-from app.scraper.references_list import FURSReferencesList
-from app.scraper.scraper import Scraper
 from app.storage.storage_bucket import (
     download_blob,
-    download_folder,
-    upload_blob,
-    upload_folder_to_bucket,
     check_blob_exists,
     check_folder_exists,
 )
-from app.database.vector_store import VectorStore
-from app.parser.text_parser import FileProcessor, TextProcessor
+from app.storage.sync import sync_folder_from_bucket
+from app.storage.snapshots import publish_snapshot, read_latest_manifest, download_snapshot
+from app.pipeline.scheduler import Stage, StageScheduler
+from app.pipeline.sources import SOURCES, get_source_dir, partition_sources, merge_sources
+from app.pipeline.profiling import StageProfiler
+from app.metrics import metrics
+
+PIPELINE_STATE_NAME = "pipeline_state.json"
+RUN_REPORT_NAME = "run_report.json"
+PROFILES_DIR_NAME = "profiles"
+
+# The scraping, parsing and embedding dependencies (selenium, playwright, marker and torch,
+# langchain, FAISS, openai) are imported inside the stages that use them, so that loading the
+# database only imports the storage modules. Checked by benchmarks/import_time.py.
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 )
 
 
+def get_snapshot_files(metadata_dir, vector_db_path):
+    """Returns the mapping of the snapshot file names to the local files of the database."""
+    from app.parser.dedup import DEDUP_INDEX_NAME
+
+    files = {
+        "references.csv": os.path.join(metadata_dir, "references.csv"),
+        "downloaded_data_index.csv": os.path.join(metadata_dir, "downloaded_data_index.csv"),
+    }
+    if os.path.exists(os.path.join(metadata_dir, DEDUP_INDEX_NAME)):
+        files[DEDUP_INDEX_NAME] = os.path.join(metadata_dir, DEDUP_INDEX_NAME)
+    for local_file in os.listdir(vector_db_path):
+        if os.path.isfile(os.path.join(vector_db_path, local_file)):
+            files[f"vector_database/{local_file}"] = os.path.join(vector_db_path, local_file)
+    return files
+
+
+def get_snapshot_local_path(name, metadata_dir, vector_db_path):
+    """Returns the local path of a snapshot file (inverse of get_snapshot_files)."""
+    if name.startswith("vector_database/"):
+        return os.path.join(vector_db_path, name[len("vector_database/") :])  # noqa: E203
+    return os.path.join(metadata_dir, name)
+
+
+def download_database(bucket_name, metadata_dir, vector_db_path, local=False):
+    """
+    Downloads the latest database snapshot from the storage bucket. Falls back to the legacy
+    layout (vector_database folder and the CSVs in the root of the bucket) if there is no snapshot.
+
+    Returns:
+        bool: True if a database was found in the bucket and downloaded.
+    """
+    os.makedirs(metadata_dir, exist_ok=True)
+    os.makedirs(vector_db_path, exist_ok=True)
+    manifest = read_latest_manifest(bucket_name, local=local)
+    if manifest is not None:
+        download_snapshot(
+            bucket_name,
+            lambda name: get_snapshot_local_path(name, metadata_dir, vector_db_path),
+            local=local,
+            manifest=manifest,
+        )
+        return True
+
+    if (
+        not check_folder_exists(bucket_name, "vector_database", local=local)
+        or not check_blob_exists(bucket_name, "references.csv", local=local)
+        or not check_blob_exists(bucket_name, "downloaded_data_index.csv", local=local)
+    ):
+        return False
+    download_blob(
+        bucket_name,
+        "references.csv",
+        os.path.join(metadata_dir, "references.csv"),
+        local=local,
+    )
+    download_blob(
+        bucket_name,
+        "downloaded_data_index.csv",
+        os.path.join(metadata_dir, "downloaded_data_index.csv"),
+        local=local,
+    )
+    sync_folder_from_bucket(bucket_name, "vector_database", vector_db_path, local=local)
+    return True
+
+
 def load_database(local=False):
     # Read the relevant env variables
     METADATA_DIR = os.getenv("METADATA_DIR")
@@ -29,35 +101,57 @@ def load_database(local=False):
 
     # If the storage bucket does not contain the database, then we need to call the update_database
     # function
-    if (
-        STORAGE_BUCKET_NAME is None
-        or not check_folder_exists(STORAGE_BUCKET_NAME, "vector_database", local=local)
-        or not check_blob_exists(STORAGE_BUCKET_NAME, "references.csv", local=local)
-        or not check_blob_exists(STORAGE_BUCKET_NAME, "downloaded_data_index.csv", local=local)
+    if STORAGE_BUCKET_NAME is None or not download_database(
+        STORAGE_BUCKET_NAME, METADATA_DIR, VECTOR_DB_PATH, local=local
     ):
         logging.info("Database not found in the storage bucket. Updating the database.")
         update_database(local=local)
     else:
-        logging.info("Database found in the storage bucket. Downloading the database.")
-
-        os.makedirs(METADATA_DIR, exist_ok=True)
-        os.makedirs(VECTOR_DB_PATH, exist_ok=True)
-        download_blob(
-            STORAGE_BUCKET_NAME,
-            "references.csv",
-            os.path.join(METADATA_DIR, "references.csv"),
-            local=local,
-        )
-        download_blob(
-            STORAGE_BUCKET_NAME,
-            "references.csv",
-            os.path.join(METADATA_DIR, "downloaded_data_index.csv"),
-            local=local,
-        )
-        download_folder(STORAGE_BUCKET_NAME, "vector_database", VECTOR_DB_PATH, local=local)
+        logging.info("Downloaded the database from the storage bucket.")
+
+
+def update_database(
+    local=False,
+    force_update=False,
+    only=None,
+    from_stage=None,
+    workers=None,
+    prometheus_textfile=None,
+    profile=False,
+):
+    """
+    Runs the stages of the database update (see get_update_stages). The stages finished by an
+    interrupted run are not repeated, unless force_update is set.
+
+    Args:
+        local (bool): Whether running on the local machine.
+        force_update (bool): Ignore the database in the bucket and the interrupted runs.
+        only (list, optional): Run only these stages.
+        from_stage (str, optional): Run this stage and all of the stages after it.
+        workers (dict, optional): The size of the worker pool per stage name.
+        prometheus_textfile (str, optional): Also write the run report in the Prometheus format.
+        profile (bool): Profile every stage, the profiles are written to METADATA_DIR/profiles.
+    """
+    METADATA_DIR = os.getenv("METADATA_DIR")
+    os.makedirs(METADATA_DIR, exist_ok=True)
+
+    logging.info("Updating the database")
+    scheduler = StageScheduler(
+        get_update_stages(local=local, force_update=force_update, workers=workers),
+        state_path=os.path.join(METADATA_DIR, PIPELINE_STATE_NAME),
+        profiler=StageProfiler(os.path.join(METADATA_DIR, PROFILES_DIR_NAME)) if profile else None,
+    )
+    try:
+        return scheduler.run(only=only, from_stage=from_stage, resume=not force_update)
+    finally:
+        # Timings, bytes and tokens per stage, also of the failed runs
+        report_path = os.path.join(METADATA_DIR, RUN_REPORT_NAME)
+        metrics.write_report(report_path, prometheus_path=prometheus_textfile)
+        logging.info(f"Wrote the run report to {report_path}")
 
 
-def update_database(local=False, force_update=False):
+def get_update_stages(local=False, force_update=False, workers=None):
+    """Returns the stages of the database update and their dependencies."""
     # Read the relevant env variables
     ROOT_URL = os.getenv("ROOT_URL")
     METADATA_DIR = os.getenv("METADATA_DIR")
@@ -67,71 +161,144 @@ def update_database(local=False, force_update=False):
     VECTOR_DB_PATH = os.getenv("VECTOR_DB_PATH")
     STORAGE_BUCKET_NAME = os.getenv("STORAGE_BUCKET_NAME")
     EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL")
-    reference_data_path = os.path.join(METADATA_DIR, "references.csv")
-    downloaded_data_index_path = os.path.join(METADATA_DIR, "downloaded_data_index.csv")
 
-    logging.info("Updating the database")
+    def restore():
+        # 1. Load the backup if it exists - we only load the DB if the vector database exists
+        if not force_update and STORAGE_BUCKET_NAME is not None:
+            download_database(STORAGE_BUCKET_NAME, METADATA_DIR, VECTOR_DB_PATH, local=local)
 
-    # 1. Load the backup if it exists - we only load the DB if the vector database exists
-    if (
-        not force_update
-        and STORAGE_BUCKET_NAME is not None
-        and check_folder_exists(STORAGE_BUCKET_NAME, "vector_database", local=local)
-    ):
-        os.makedirs(METADATA_DIR, exist_ok=True)
-        os.makedirs(VECTOR_DB_PATH, exist_ok=True)
-        download_blob(STORAGE_BUCKET_NAME, "references.csv", reference_data_path, local=local)
-        download_blob(
-            STORAGE_BUCKET_NAME,
-            "downloaded_data_index.csv",
-            downloaded_data_index_path,
-            local=local,
-        )
-        download_folder(STORAGE_BUCKET_NAME, "vector_database", VECTOR_DB_PATH, local=local)
-
-    # 2. Update the raw sources list; returns the dataframe containing the new references to scrape
-    logging.info("Updating the raw sources list")
-    reference_data = FURSReferencesList(ROOT_URL, METADATA_DIR, local=local)
-    reference_data.update_references()
-
-    # 3. Scrape the data
-    logging.info("Scraping the data")
-    scraper = Scraper(os.path.join(METADATA_DIR, "references.csv"), RAW_DATA_DIR, local=local)
-    scraper.download_all_references()
-
-    # 4. Parse the raw data
-    logging.info("Converting the raw data")
-    file_processor = FileProcessor(CONVERTED_DATA_DIR, METADATA_DIR)
-    file_processor.convert_all_files()
-
-    logging.info("Chunking the converted data")
-    text_processor = TextProcessor(METADATA_DIR, CONVERTED_DATA_DIR, FILE_CHUNKS_DATA_DIR)
-    text_processor.chunk_all_files()
-
-    # 5. Add the processed data to the vector database
-    logging.info("Adding the processed data to the vector database")
-    vector_store = VectorStore(
-        METADATA_DIR, FILE_CHUNKS_DATA_DIR, VECTOR_DB_PATH, embedding_model=EMBEDDING_MODEL
-    )
-    vector_store.update_or_create_vector_store()
-
-    # 6. Backup the updated vector store to the storage bucket
-    if STORAGE_BUCKET_NAME is not None:
-        logging.info("Uploading vector database to the storage bucket")
-        upload_folder_to_bucket(STORAGE_BUCKET_NAME, VECTOR_DB_PATH, "vector_database", local=local)
-        logging.info(f"Uploading references.csv to the storage bucket {STORAGE_BUCKET_NAME}")
-        upload_blob(
-            STORAGE_BUCKET_NAME,
-            os.path.join(METADATA_DIR, "references.csv"),
-            "references.csv",
-            local=local,
+    def references():
+        from app.scraper.references_list import FURSReferencesList
+
+        # The partitions of an interrupted run hold its progress, bring it into the catalog first
+        merge_sources(METADATA_DIR)
+        # 2. Update the raw sources list
+        logging.info("Updating the raw sources list")
+        reference_data = FURSReferencesList(ROOT_URL, METADATA_DIR, local=local)
+        reference_data.update_references()
+
+    # The links that were already downloaded, shared by the scrapers of all of the sources
+    download_indexes = []
+    download_index_lock = threading.Lock()
+
+    def get_download_index():
+        from app.scraper.download_index import DownloadIndex
+
+        with download_index_lock:
+            if not download_indexes:
+                download_indexes.append(
+                    DownloadIndex(os.path.join(METADATA_DIR, "download_index.json"))
+                )
+            return download_indexes[0]
+
+    def get_scrape(source):
+        def scrape():
+            from app.scraper.scraper import Scraper
+
+            # 3. Scrape the data of the source
+            partition_sources(METADATA_DIR)
+            logging.info(f"Scraping the data of {source}")
+            scraper = Scraper(
+                os.path.join(get_source_dir(METADATA_DIR, source), "references.csv"),
+                RAW_DATA_DIR,
+                local=local,
+                download_index=get_download_index(),
+            )
+            scraper.download_all_references()
+
+        return scrape
+
+    def get_convert(source):
+        def convert(workers=None):
+            from app.parser.text_parser import FileProcessor
+
+            # 4. Parse the raw data of the source, while the other sources are still scraped
+            logging.info(f"Converting the raw data of {source}")
+            file_processor = FileProcessor(
+                CONVERTED_DATA_DIR, get_source_dir(METADATA_DIR, source)
+            )
+            file_processor.convert_all_files(workers=workers)
+
+        return convert
+
+    def merge():
+
+        logging.info("Merging the sources into the catalog")
+        merge_sources(METADATA_DIR)
+
+    def chunk(workers=None):
+        from app.parser.text_parser import TextProcessor
+
+        logging.info("Chunking the converted data")
+        text_processor = TextProcessor(
+            METADATA_DIR, CONVERTED_DATA_DIR, FILE_CHUNKS_DATA_DIR, workers=workers
         )
-        upload_blob(
-            STORAGE_BUCKET_NAME,
-            os.path.join(METADATA_DIR, "references.csv"),
-            "downloaded_data_index.csv",
-            local=local,
+        text_processor.chunk_all_files()
+
+    def deduplicate():
+        from app.parser.dedup import Deduplicator
+
+        logging.info("Detecting the near-duplicate documents and chunks")
+        Deduplicator(METADATA_DIR).update()
+
+    def embed():
+        from app.database.vector_store import VectorStore
+        from app.parser.dedup import Deduplicator
+
+        # 5. Add the processed data to the vector database
+        logging.info("Adding the processed data to the vector database")
+        vector_store = VectorStore(
+            METADATA_DIR,
+            FILE_CHUNKS_DATA_DIR,
+            VECTOR_DB_PATH,
+            embedding_model=EMBEDDING_MODEL,
+            deduplicator=Deduplicator(METADATA_DIR),
         )
+        vector_store.update_or_create_vector_store()
+
+    def publish():
+        # 6. Backup the updated vector store to the storage bucket
+        if STORAGE_BUCKET_NAME is not None:
+            logging.info(f"Publishing the database snapshot to the bucket {STORAGE_BUCKET_NAME}")
+            publish_snapshot(
+                STORAGE_BUCKET_NAME, get_snapshot_files(METADATA_DIR, VECTOR_DB_PATH), local=local
+            )
+
+    workers = workers or {}
+    # Every source is scraped and converted by its own stages, so the sources run in parallel
+    # and a source is converted as soon as it is scraped
+    source_stages = []
+    for source in SOURCES:
+        source_stages += [
+            Stage(f"scrape_{source}", get_scrape(source), depends_on=["references"]),
+            Stage(
+                f"convert_{source}",
+                get_convert(source),
+                depends_on=[f"scrape_{source}"],
+                workers=workers.get(f"convert_{source}", workers.get("convert")),
+            ),
+        ]
+    return [
+        Stage("restore", restore),
+        Stage("references", references, depends_on=["restore"]),
+        *source_stages,
+        Stage("merge", merge, depends_on=[f"convert_{source}" for source in SOURCES]),
+        Stage("chunk", chunk, depends_on=["merge"], workers=workers.get("chunk")),
+        Stage("deduplicate", deduplicate, depends_on=["chunk"]),
+        Stage("embed", embed, depends_on=["deduplicate"]),
+        Stage("publish", publish, depends_on=["embed"]),
+    ]
+
+
+def parse_workers(values):
+    """Parses the --workers STAGE=N arguments into a dict."""
+    workers = {}
+    for value in values or []:
+        stage, _, number = value.partition("=")
+        if not number.isdigit():
+            raise argparse.ArgumentTypeError(f"Expected STAGE=N, got {value}")
+        workers[stage] = int(number)
+    return workers
 
 
 def main():
@@ -142,6 +309,20 @@ def main():
     parser.add_argument(
         "--local", action="store_true", help="For running on local machine. Debugging purposes."
     )
+    parser.add_argument("--only", nargs="+", metavar="STAGE", help="Run only these stages")
+    parser.add_argument("--from", dest="from_stage", metavar="STAGE", help="Run from this stage")
+    parser.add_argument(
+        "--workers",
+        nargs="+",
+        metavar="STAGE=N",
+        help="Worker pool size per stage, e.g. chunk=8 convert=4",
+    )
+    parser.add_argument(
+        "--prometheus-textfile", metavar="PATH", help="Also write the run report for Prometheus"
+    )
+    parser.add_argument(
+        "--profile", action="store_true", help="Profile the time and memory of every stage"
+    )
     args = parser.parse_args()
 
     logging.info("Loading the environment variables")
@@ -149,11 +330,18 @@ def main():
         load_dotenv(".env.local", override=True, verbose=True)
     else:
         load_dotenv(find_dotenv())
-    openai.api_key = os.getenv("OPENAI_API_KEY")
 
     if args.update:
         logging.info("Updating the database")
-        update_database(local=args.local, force_update=args.force)
+        update_database(
+            local=args.local,
+            force_update=args.force,
+            only=args.only,
+            from_stage=args.from_stage,
+            workers=parse_workers(args.workers),
+            prometheus_textfile=args.prometheus_textfile,
+            profile=args.profile,
+        )
     else:
         logging.info("Loading the database")
         load_database(local=args.local)
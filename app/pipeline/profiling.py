@@ -0,0 +1,103 @@
+import os
+import io
+import pstats
+import cProfile
+import logging
+import threading
+import tracemalloc
+from contextlib import contextmanager
+
+"""
+Profiling of the pipeline stages (--profile).
+
+Every stage runs under cProfile, and tracemalloc snapshots are taken when the stage starts and
+finishes. For every stage, <stage>.prof (the pstats dump, e.g. for snakeviz) and <stage>.txt (the
+top functions by cumulative time and the top allocations of the stage) are written to the output
+directory. cProfile only sees the thread of the stage, so the work of the process pools (e.g. the
+chunking workers) shows up as waiting. tracemalloc traces the whole process, so the allocations of
+stages running at the same time are mixed.
+"""
+
+TOP_FUNCTIONS = 40
+TOP_ALLOCATIONS = 25
+TRACEMALLOC_FRAMES = 5
+
+
+class StageProfiler:
+    """
+    Profiles the stages with cProfile and tracemalloc.
+
+    Args:
+        output_dir (str): The directory of the profile dumps and summaries.
+        top_functions (int): The number of functions in the summary.
+        top_allocations (int): The number of allocation sites in the summary.
+    """
+
+    def __init__(self, output_dir, top_functions=TOP_FUNCTIONS, top_allocations=TOP_ALLOCATIONS):
+        self.output_dir = output_dir
+        self.top_functions = top_functions
+        self.top_allocations = top_allocations
+        self._lock = threading.Lock()
+        self._active = 0
+
+    @contextmanager
+    def profile(self, name):
+        """Profiles the block and writes the dumps of the stage <name>."""
+        os.makedirs(self.output_dir, exist_ok=True)
+        with self._lock:
+            if self._active == 0:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(TRACEMALLOC_FRAMES)
+                tracemalloc.reset_peak()
+            self._active += 1
+        start_snapshot = tracemalloc.take_snapshot()
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError as e:
+            # Python 3.12+ allows a single active profiler, i.e. one of the concurrent stages
+            logging.warning(f"Not running cProfile for stage {name}: {e}")
+            profiler = None
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            end_snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            with self._lock:
+                self._active -= 1
+                if self._active == 0:
+                    tracemalloc.stop()
+            self._write(name, profiler, start_snapshot, end_snapshot, peak)
+
+    def _write(self, name, profiler, start_snapshot, end_snapshot, peak):
+        summary_path = os.path.join(self.output_dir, f"{name}.txt")
+        with open(summary_path, "w") as f:
+            if profiler is not None:
+                profiler.dump_stats(os.path.join(self.output_dir, f"{name}.prof"))
+                stream = io.StringIO()
+                stats = pstats.Stats(profiler, stream=stream)
+                stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(self.top_functions)
+                f.write(f"Top {self.top_functions} functions of stage {name} by cumulative time\n")
+                f.write(stream.getvalue())
+
+            f.write(f"\nTop {self.top_allocations} allocation sites of stage {name}\n")
+            f.write(f"Peak traced memory during the stage: {peak / 1024 / 1024:.1f} MiB\n")
+            f.write("Memory still allocated when the stage finished, by allocation site:\n\n")
+            snapshot_filter = [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, __file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            ]
+            differences = end_snapshot.filter_traces(snapshot_filter).compare_to(
+                start_snapshot.filter_traces(snapshot_filter), "traceback"
+            )
+            for difference in differences[: self.top_allocations]:
+                f.write(
+                    f"{difference.size_diff / 1024:+.1f} KiB in {difference.count_diff:+d} blocks "
+                    f"(now {difference.size / 1024:.1f} KiB)\n"
+                )
+                for line in difference.traceback.format(most_recent_first=True):
+                    f.write(f"    {line}\n")
+        logging.info(f"Wrote the profile of stage {name} to {summary_path}")
@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import logging
+import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from app.metrics import metrics
+
+"""
+Small DAG scheduler for the stages of the database update.
+
+Every stage declares the stages it depends on. A stage starts as soon as all of its dependencies
+are finished, so the independent stages run concurrently, each in its own thread (and with its own
+worker pool, see Stage.workers). The finished stages are recorded in a state file, so a run that
+crashed is resumed without repeating the finished stages. Within a stage, the already processed
+documents are skipped by the stage itself (e.g. the is_scraped and processed_filepath columns).
+"""
+
+
+class Stage:
+    """
+    A stage of the pipeline.
+
+    Args:
+        name (str): The name of the stage, used with --only and --from.
+        func (callable): The function running the stage. Called with workers=<workers> if the
+            number of workers is set.
+        depends_on (list): The names of the stages that have to finish first.
+        workers (int, optional): The size of the worker pool of the stage.
+    """
+
+    def __init__(self, name, func, depends_on=(), workers=None):
+        self.name = name
+        self.func = func
+        self.depends_on = list(depends_on)
+        self.workers = workers
+
+    def run(self):
+        if self.workers is not None:
+            return self.func(workers=self.workers)
+        return self.func()
+
+
+class StageScheduler:
+    """
+    Runs the stages in the order of their dependencies.
+
+    Args:
+        stages (list): The Stage objects.
+        state_path (str, optional): The JSON file recording the finished stages of the run. If
+            None, the runs are not resumable.
+        profiler (StageProfiler, optional): Profiles every stage, see app.pipeline.profiling.
+    """
+
+    def __init__(self, stages, state_path=None, profiler=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_path = state_path
+        self.profiler = profiler
+        for stage in stages:
+            for dependency in stage.depends_on:
+                if dependency not in self.stages:
+                    raise ValueError(f"Stage {stage.name} depends on unknown stage {dependency}")
+        self._check_acyclic()
+
+    def _check_acyclic(self):
+        visited, in_progress = set(), set()
+
+        def visit(name):
+            if name in in_progress:
+                raise ValueError(f"The stages have a dependency cycle through {name}")
+            if name in visited:
+                return
+            in_progress.add(name)
+            for dependency in self.stages[name].depends_on:
+                visit(dependency)
+            in_progress.remove(name)
+            visited.add(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def get_downstream(self, name):
+        """Returns the stage and all the stages that (transitively) depend on it."""
+        downstream = {name}
+        changed = True
+        while changed:
+            changed = False
+            for stage in self.stages.values():
+                if stage.name not in downstream and downstream & set(stage.depends_on):
+                    downstream.add(stage.name)
+                    changed = True
+        return downstream
+
+    def select(self, only=None, from_stage=None):
+        """
+        Returns the names of the stages to run.
+
+        Args:
+            only (list, optional): Run only these stages, their dependencies are assumed done.
+            from_stage (str, optional): Run this stage and all of the stages after it.
+        """
+        for name in list(only or []) + ([from_stage] if from_stage else []):
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage {name}. Stages: {', '.join(self.stages)}")
+        selected = set(self.stages)
+        if only:
+            selected &= set(only)
+        if from_stage:
+            selected &= self.get_downstream(from_stage)
+        return selected
+
+    def _load_state(self):
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path, "r") as f:
+            return json.load(f)
+
+    def _save_state(self, state):
+        if self.state_path is None:
+            return
+        with open(self.state_path + ".part", "w") as f:
+            json.dump(state, f, indent=2)
+        os.replace(self.state_path + ".part", self.state_path)
+
+    def run(self, only=None, from_stage=None, resume=True):
+        """
+        Runs the selected stages. With resume, the stages finished by an interrupted run with the
+        same selection are skipped.
+
+        Returns:
+            dict: The state of the run, with the duration of every finished stage.
+
+        Raises:
+            Exception: The error of the first failed stage, once the running stages finished.
+        """
+        selected = self.select(only=only, from_stage=from_stage)
+        selection = sorted(selected)
+        state = self._load_state()
+        if not resume or state is None or state.get("finished") or state["selected"] != selection:
+            state = {
+                "started": datetime.datetime.utcnow().isoformat(),
+                "selected": selection,
+                "completed": {},
+                "finished": None,
+            }
+        else:
+            logging.info(f"Resuming the run, finished stages: {', '.join(state['completed'])}")
+        self._save_state(state)
+
+        done = set(state["completed"]) | (set(self.stages) - selected)
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=max(len(selected), 1)) as executor:
+            while True:
+                if error is None:
+                    for name in self.stages:
+                        stage = self.stages[name]
+                        if name in done or name in running.values():
+                            continue
+                        if all(dependency in done for dependency in stage.depends_on):
+                            logging.info(f"Starting stage {name}")
+                            running[executor.submit(self._run_stage, stage)] = name
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        seconds = future.result()
+                    except Exception as e:
+                        logging.error(f"Stage {name} failed: {e}")
+                        error = error or e
+                        continue
+                    done.add(name)
+                    state["completed"][name] = {
+                        "finished": datetime.datetime.utcnow().isoformat(),
+                        "seconds": seconds,
+                    }
+                    self._save_state(state)
+                    logging.info(f"Finished stage {name} in {seconds:.1f}s")
+
+        if error is not None:
+            raise error
+        state["finished"] = datetime.datetime.utcnow().isoformat()
+        self._save_state(state)
+        return state
+
+    def _run_stage(self, stage):
+        start = time.perf_counter()
+        with metrics.timer(f"stage.{stage.name}"):
+            if self.profiler is None:
+                stage.run()
+            else:
+                with self.profiler.profile(stage.name):
+                    stage.run()
+        return time.perf_counter() - start
@@ -0,0 +1,123 @@
+import os
+import shutil
+import logging
+import threading
+from urllib.parse import urlparse
+
+"""
+Partitions of the reference catalog per source, so that the sources are scraped and converted by
+concurrent stages.
+
+The scraping and the conversion read and rewrite references.csv and downloaded_data_index.csv as
+a whole, so two stages can not work on them at the same time. Every source stage works on its own
+copy of the rows of its source instead (METADATA_DIR/sources/<source>/), which the merge stage
+concatenates back into the catalog files once all of the sources are done. The partitions keep
+the progress of the stages, so an interrupted run resumes with them. pandas is only imported by
+the stages, the pipeline imports this module to build the stages.
+"""
+
+SOURCES_DIR_NAME = "sources"
+CATALOG_FILES = ["references.csv", "downloaded_data_index.csv"]
+# The rows that belong to no other source (FURS pages and files, Uradni list) are scraped by the
+# last source
+SOURCE_HOSTS = {
+    "pisrs": "pisrs.si",
+    "eurlex": "eur-lex.europa.eu",
+}
+SOURCES = list(SOURCE_HOSTS) + ["furs"]
+
+_partition_lock = threading.Lock()
+
+
+def get_source_dir(metadata_dir, source):
+    return os.path.join(metadata_dir, SOURCES_DIR_NAME, source)
+
+
+def get_reference_source(row):
+    """Returns the source of the reference, by the link that the scraper downloads."""
+    details_href = str(row.get("details_href")).split("#")[0]
+    url = details_href
+    if details_href == "nan":
+        url = str(row.get("reference_href_clean", row.get("reference_href"))).split("#")[0]
+    netloc = urlparse(url).netloc
+    for source, host in SOURCE_HOSTS.items():
+        if netloc == host or netloc.endswith("." + host):
+            return source
+    return SOURCES[-1]
+
+
+def _write_csv(df, path):
+    df.to_csv(path + ".part", index=False)
+    os.replace(path + ".part", path)
+
+
+def partition_sources(metadata_dir):
+    """
+    Splits the catalog files into the partitions of the sources. Does nothing if the partitions
+    exist (they hold the progress of an interrupted run). Safe to call from concurrent stages.
+    """
+    import pandas as pd
+
+    sources_dir = os.path.join(metadata_dir, SOURCES_DIR_NAME)
+    with _partition_lock:
+        if os.path.isdir(sources_dir):
+            return
+        references = pd.read_csv(os.path.join(metadata_dir, "references.csv"))
+        reference_sources = references.apply(get_reference_source, axis=1)
+
+        downloaded_data_path = os.path.join(metadata_dir, "downloaded_data_index.csv")
+        downloaded_data = None
+        if os.path.exists(downloaded_data_path):
+            downloaded_data = pd.read_csv(downloaded_data_path)
+            source_by_file_id = dict(zip(references["file_id"].astype(str), reference_sources))
+            downloaded_data_sources = [
+                source_by_file_id.get(str(file_id), SOURCES[-1])
+                for file_id in downloaded_data["file_id"]
+            ]
+
+        tmp_dir = sources_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        for source in SOURCES:
+            source_dir = os.path.join(tmp_dir, source)
+            os.makedirs(source_dir)
+            _write_csv(
+                references[reference_sources == source],
+                os.path.join(source_dir, "references.csv"),
+            )
+            if downloaded_data is not None:
+                _write_csv(
+                    downloaded_data[[s == source for s in downloaded_data_sources]],
+                    os.path.join(source_dir, "downloaded_data_index.csv"),
+                )
+        os.replace(tmp_dir, sources_dir)
+        logging.info(
+            "Partitioned the references by source: "
+            + ", ".join(f"{source}={(reference_sources == source).sum()}" for source in SOURCES)
+        )
+
+
+def merge_sources(metadata_dir):
+    """
+    Concatenates the partitions of the sources back into the catalog files and removes the
+    partitions. Does nothing if there are no partitions. Idempotent until the partitions are
+    removed, so a merge that crashed is repeated.
+    """
+    import pandas as pd
+
+    sources_dir = os.path.join(metadata_dir, SOURCES_DIR_NAME)
+    with _partition_lock:
+        if not os.path.isdir(sources_dir):
+            return
+        for file_name in CATALOG_FILES:
+            parts = [
+                pd.read_csv(os.path.join(sources_dir, source, file_name))
+                for source in SOURCES
+                if os.path.exists(os.path.join(sources_dir, source, file_name))
+            ]
+            if parts:
+                _write_csv(
+                    pd.concat(parts, axis=0, ignore_index=True),
+                    os.path.join(metadata_dir, file_name),
+                )
+        shutil.rmtree(sources_dir)
+        logging.info("Merged the partitions of the sources into the catalog")
@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import aiohttp
+import tqdm
+from concurrent.futures import ThreadPoolExecutor
+from bs4 import BeautifulSoup
+from app.utils import is_url_to_file
+from app.scraper.scraper import HTTP_HEADERS
+
+
+class AsyncFURSCrawler:
+    """
+    Asyncio based discovery of the further references linked from the FURS overview page.
+
+    The linked FURS pages are fetched with bounded concurrency. Every page is handed over to a
+    thread pool for parsing as soon as it arrives, so the parsing of one page overlaps with the
+    fetching of the others.
+
+    Args:
+        furs_root_url (str): The root URL of the FURS website (e.g. https://www.fu.gov.si).
+        is_typical_website (callable): Function soup -> bool. Checks for the FURS page format.
+        parse_references (callable): Function (url_link, soup) -> pandas.DataFrame. Extracts the
+            further references from a typical FURS page.
+        max_concurrency (int): The maximum number of pages fetched at the same time.
+        parse_workers (int): The number of threads used to parse the fetched pages.
+        timeout (int): The timeout in seconds for fetching a single page.
+    """
+
+    def __init__(
+        self,
+        furs_root_url,
+        is_typical_website,
+        parse_references,
+        max_concurrency=8,
+        parse_workers=4,
+        timeout=30,
+    ):
+        self.furs_root_url = furs_root_url
+        self.is_typical_website = is_typical_website
+        self.parse_references = parse_references
+        self.max_concurrency = max_concurrency
+        self.parse_workers = parse_workers
+        self.timeout = timeout
+
+        self.typical_website_links = []
+        self.file_links = []
+        self.other_websites = []
+
+    def run(self, website_links, on_references=None):
+        """
+        Crawls the website links and collects the discovered references.
+
+        Args:
+            website_links (list): The links to classify and crawl.
+            on_references (callable, optional): Called with the DataFrame of the further
+                references of every typical FURS page, as soon as the page is parsed.
+
+        Returns:
+            list: The DataFrames with the further references, one for every typical FURS page.
+        """
+
+        async def collect():
+            further_references = []
+            async for df in self.discover(website_links):
+                if on_references is not None:
+                    on_references(df)
+                further_references.append(df)
+            return further_references
+
+        return asyncio.run(collect())
+
+    async def discover(self, website_links):
+        """
+        Classifies the website links and yields the further references of every typical FURS
+        page as soon as the page is fetched and parsed.
+
+        Args:
+            website_links (list): The links to classify and crawl.
+
+        Yields:
+            pandas.DataFrame: The further references extracted from a typical FURS page.
+        """
+        self.typical_website_links, self.file_links, self.other_websites = [], [], []
+        links_to_fetch = []
+        for url_link in website_links:
+            if not url_link.startswith(self.furs_root_url):
+                self.other_websites.append(url_link)
+            elif is_url_to_file(url_link):
+                self.file_links.append(url_link)
+            else:
+                links_to_fetch.append(url_link)
+
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency)
+        with ThreadPoolExecutor(max_workers=self.parse_workers) as executor:
+            async with aiohttp.ClientSession(
+                headers=HTTP_HEADERS, timeout=timeout, connector=connector
+            ) as session:
+
+                async def fetch_and_parse(url_link):
+                    async with semaphore:
+                        html = await self._fetch(session, url_link)
+                    if html is None:
+                        return url_link, False, None
+                    # Parse in the thread pool, the event loop keeps fetching the other pages
+                    is_typical, df = await loop.run_in_executor(
+                        executor, self._parse_page, url_link, html
+                    )
+                    return url_link, is_typical, df
+
+                tasks = [asyncio.create_task(fetch_and_parse(url)) for url in links_to_fetch]
+                for task in tqdm.tqdm(asyncio.as_completed(tasks), total=len(tasks)):
+                    url_link, is_typical, df = await task
+                    if is_typical:
+                        self.typical_website_links.append(url_link)
+                        if df is not None:
+                            yield df
+                    else:
+                        self.other_websites.append(url_link)
+
+    async def _fetch(self, session, url_link):
+        try:
+            async with session.get(url_link) as response:
+                response.raise_for_status()
+                return await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning(f"Problem getting the website html of URL : {url_link}. Error: {e}")
+            return None
+
+    def _parse_page(self, url_link, html):
+        soup = BeautifulSoup(html, "html.parser")
+        if not self.is_typical_website(soup):
+            return False, None
+        return True, self.parse_references(url_link, soup)
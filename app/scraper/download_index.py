@@ -0,0 +1,157 @@
+import os
+import json
+import tempfile
+import threading
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+# Query parameters that only track the visitor and do not change the served resource
+TRACKING_PARAMS_PREFIXES = ("utm_", "mtm_", "pk_")
+TRACKING_PARAMS = {"fbclid", "gclid", "msclkid", "_ga", "_gl", "mc_cid", "mc_eid", "qid"}
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(url):
+    """
+    Normalizes the URL, so that the different spellings of the same link map to the same key.
+
+    The fragment and the tracking query parameters are removed, the remaining query parameters
+    are sorted and the host is canonicalized (lowercase, without `www.` and the default port).
+    """
+    url = str(url).strip()
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").rstrip(".")
+    if host.startswith("www."):
+        host = host[len("www.") :]  # noqa: E203
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+
+    query = [
+        (key, value)
+        for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key.lower() not in TRACKING_PARAMS
+        and not key.lower().startswith(TRACKING_PARAMS_PREFIXES)
+    ]
+    path = parts.path or "/"
+    return urlunsplit((scheme, host, path, urlencode(sorted(query)), ""))
+
+
+class DownloadIndex:
+    """
+    Thread-safe index of the already downloaded links, keyed by the normalized URL.
+
+    Each entry maps to the tuple (actual_download_link, saved_path). The successful downloads are
+    persisted to a JSON file, so that they are not downloaded again in the next runs. Concurrent
+    workers claim a link before downloading it; the other workers asking for the same link wait
+    for the result instead of downloading it a second time. The failed downloads are not kept, the
+    next reference to the same link tries it again.
+
+    Args:
+        index_path (str): The path of the JSON file where the index is persisted. If None, the
+            index is kept in memory only.
+        save_every (int): Persist the index after every `save_every` new entries.
+    """
+
+    def __init__(self, index_path=None, save_every=50):
+        self.index_path = index_path
+        self.save_every = save_every
+        self._entries = {}
+        self._persisted_keys = set()
+        self._in_progress = {}
+        self._unsaved_count = 0
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+        if index_path is not None and os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                for key, entry in json.load(f).items():
+                    self._entries[key] = tuple(entry)
+                    self._persisted_keys.add(key)
+
+    def __contains__(self, url):
+        return self.get(url) is not None
+
+    def get(self, url):
+        """Returns the (actual_download_link, saved_path) of the URL or None if not downloaded."""
+        key = normalize_url(url)
+        with self._lock:
+            return self._get_valid_entry(key)
+
+    def claim(self, url):
+        """
+        Claims the URL for downloading.
+
+        Returns:
+            tuple: (is_claimed, entry). If is_claimed is True, the caller has to download the URL
+                and report the result with `add`. Otherwise, entry holds the result of the
+                previous download of the URL.
+        """
+        key = normalize_url(url)
+        while True:
+            with self._lock:
+                entry = self._get_valid_entry(key)
+                if entry is not None:
+                    return False, entry
+                event = self._in_progress.get(key)
+                if event is None:
+                    self._in_progress[key] = threading.Event()
+                    return True, None
+            # Another worker is downloading the same URL, wait for its result
+            event.wait()
+
+    def add(self, url, actual_download_link, saved_path, persist=None):
+        """
+        Adds the result of a download to the index and releases the claim on the URL.
+
+        Args:
+            url (str): The downloaded URL.
+            actual_download_link (str): The link that was actually used for the download.
+            saved_path (str): The path of the downloaded file. None, if the download failed.
+            persist (bool, optional): Whether to keep the entry across runs. By default only
+                the entries with a downloaded file are persisted. The entries that are neither
+                persisted nor have a downloaded file (failures) are not kept at all.
+        """
+        key = normalize_url(url)
+        if persist is None:
+            persist = saved_path is not None
+        with self._lock:
+            if saved_path is not None or persist:
+                self._entries[key] = (actual_download_link, saved_path)
+            if persist:
+                self._persisted_keys.add(key)
+                self._unsaved_count += 1
+            event = self._in_progress.pop(key, None)
+            should_save = self._unsaved_count >= self.save_every
+        if event is not None:
+            event.set()
+        if should_save:
+            self.save()
+
+    def save(self):
+        """Persists the index to the JSON file (atomically)."""
+        if self.index_path is None:
+            return
+        # One save at a time, so an older state never replaces a newer one
+        with self._save_lock:
+            with self._lock:
+                data = {key: self._entries[key] for key in self._persisted_keys}
+                self._unsaved_count = 0
+            fd, tmp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.index_path)), suffix=".tmp"
+            )
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.index_path)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+
+    def _get_valid_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] is not None and not os.path.exists(entry[1]):
+            # The downloaded file was removed in the meantime, it needs to be downloaded again
+            del self._entries[key]
+            self._persisted_keys.discard(key)
+            return None
+        return entry
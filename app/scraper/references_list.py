@@ -5,11 +5,25 @@ import uuid
 import tqdm
 from dotenv import load_dotenv
 from app.utils import get_website_html, is_url_to_file, get_chrome_driver
+from app.scraper.async_crawler import AsyncFURSCrawler
+
+FURTHER_REFERENCES_NAME = "further_references.csv"
+FURTHER_REFERENCE_COLUMNS = [
+    "reference_href_clean",
+    "details_section",
+    "details_section_text",
+    "details_href_name",
+    "details_href",
+]
+# The pages of the async crawl that are also rendered with Selenium, to check that the raw HTML
+# has the same links (the async crawler does not run the JavaScript of the pages)
+STATIC_HTML_CHECK_PAGES = 3
 
 
 class FURSReferencesList:
-    def __init__(self, root_url, output_dîr, local=False):
+    def __init__(self, root_url, output_dîr, local=False, use_async_crawler=True):
         self.driver = get_chrome_driver(local=local)
+        self.use_async_crawler = use_async_crawler
         self.furs_root_url = root_url
         self.furs_overview_url = os.path.join(root_url, "podrocja")
         self.output_dir = output_dîr
@@ -124,17 +138,52 @@ class FURSReferencesList:
         """
         logging.info("Getting list of further website links to scrape for more references")
         website_links = self.get_list_of_further_website_links()
-        logging.info("Checking the type of extracted href links")
-        typical_website_links, _, _ = self.check_href_type(website_links)
-
-        logging.info("Extracting further references from the typical websites")
-        further_references = None
-        for url_link in tqdm.tqdm(typical_website_links, position=0, leave=True):
-            df = self.extract_further_references_from_furs_websites(url_link)
-            if further_references is None:
-                further_references = df
-            else:
-                further_references = pd.concat([further_references, df], axis=0)
+
+        # The references of every page are appended to the catalog of the further references
+        # as soon as the page is parsed, so a crawl that crashed resumes from the pages it has
+        # already parsed. The catalog is removed once the references are saved
+        os.makedirs(self.output_dir, exist_ok=True)
+        further_references_path = os.path.join(self.output_dir, FURTHER_REFERENCES_NAME)
+        further_references = self.load_crawled_references(further_references_path)
+        crawled_links = {df["reference_href_clean"].iloc[0] for df in further_references}
+        if crawled_links:
+            logging.info(f"Resuming the crawl, {len(crawled_links)} pages already parsed")
+            website_links = [link for link in website_links if link not in crawled_links]
+
+        def append_references(df):
+            df.to_csv(
+                further_references_path,
+                mode="a",
+                header=not os.path.exists(further_references_path),
+                index=False,
+            )
+
+        if self.use_async_crawler:
+            logging.info("Crawling the typical websites and extracting further references")
+            crawler = AsyncFURSCrawler(
+                self.furs_root_url,
+                self.is_typical_website,
+                self.parse_further_references_from_furs_website,
+            )
+            crawled_references = crawler.run(website_links, on_references=append_references)
+            self.check_static_html(crawled_references)
+            further_references += crawled_references
+        else:
+            logging.info("Checking the type of extracted href links")
+            typical_website_links, _, _ = self.check_href_type(website_links)
+
+            logging.info("Extracting further references from the typical websites")
+            for url_link in tqdm.tqdm(typical_website_links, position=0, leave=True):
+                df = self.extract_further_references_from_furs_websites(url_link)
+                if df is not None:
+                    append_references(df)
+                    further_references.append(df)
+
+        if further_references:
+            further_references = pd.concat(further_references, axis=0)
+        else:
+            logging.warning("No further references found on the linked FURS websites")
+            further_references = pd.DataFrame(columns=FURTHER_REFERENCE_COLUMNS)
 
         # Join the details data with the original data
         self.references_list["reference_href_clean"] = self.references_list["reference_href"].apply(
@@ -143,10 +192,62 @@ class FURSReferencesList:
         self.references_list = pd.merge(
             self.references_list, further_references, on=["reference_href_clean"], how="left"
         )
-        os.makedirs(self.output_dir, exist_ok=True)
         self.references_list.to_csv(self.references_data_path, index=False)
+        if os.path.exists(further_references_path):
+            os.remove(further_references_path)
         return self.references_list
 
+    def load_crawled_references(self, further_references_path):
+        """
+        Loads the further references of the crawl that was interrupted, as one DataFrame per
+        page. The last page is dropped (and crawled again), its rows may be written partially.
+
+        Returns:
+            list: The DataFrames of the parsed pages. Empty, if there is no interrupted crawl.
+        """
+        if not os.path.exists(further_references_path):
+            return []
+        try:
+            crawled = pd.read_csv(further_references_path)
+        except (pd.errors.EmptyDataError, pd.errors.ParserError) as e:
+            logging.warning(f"Could not resume from {further_references_path}: {e}")
+            os.remove(further_references_path)
+            return []
+        pages = [df for _, df in crawled.groupby("reference_href_clean", sort=False)]
+        pages = pages[:-1]
+        # Rewrite the catalog without the dropped page, the crawl appends it again
+        if pages:
+            pd.concat(pages, axis=0).to_csv(further_references_path, index=False)
+        else:
+            os.remove(further_references_path)
+        return pages
+
+    def check_static_html(self, further_references):
+        """
+        Compares the links that the async crawler parsed from the raw HTML of a sample of the
+        pages with the links of the pages rendered by Selenium. The links that the JavaScript of
+        the pages adds are not in the raw HTML.
+
+        Returns:
+            bool: True if the rendered pages have no links that are missing in the raw HTML.
+        """
+        consistent = True
+        pages = [df for df in further_references if not df.empty]
+        for df in pages[:STATIC_HTML_CHECK_PAGES]:
+            url_link = df["reference_href_clean"].iloc[0]
+            rendered = self.extract_further_references_from_furs_websites(url_link)
+            if rendered is None:
+                continue
+            missing_links = set(rendered["details_href"]) - set(df["details_href"])
+            if missing_links:
+                consistent = False
+                logging.warning(
+                    f"The raw HTML of {url_link} is missing {len(missing_links)} links of the "
+                    f"rendered page (e.g. {sorted(missing_links)[0]}), crawl with "
+                    "use_async_crawler=False"
+                )
+        return consistent
+
     def get_list_of_further_website_links(self):
         """
         Retrieves a list of further website links from the references dataframe.
@@ -229,7 +330,20 @@ class FURSReferencesList:
             section title, section text, link text, and link URL.
         """
         soup = get_website_html(url_link, driver=self.driver, close_driver=False)
+        return self.parse_further_references_from_furs_website(url_link, soup)
 
+    def parse_further_references_from_furs_website(self, url_link, soup):
+        """
+        Parses the further references from the HTML of a FURS website.
+
+        Args:
+            url_link (str): The URL link of the website.
+            soup (BeautifulSoup): The HTML content of the website.
+
+        Returns:
+            pandas.DataFrame: A DataFrame containing the extracted website details. None, if the
+            website has no content element.
+        """
         # Find the relevant sections: Opis, Podrobnejši opisi, Zakonodaja, Navodila in Pojasnila
         content_element = soup.find("div", id="content")
         if content_element is None:
@@ -260,16 +374,7 @@ class FURSReferencesList:
                         website_details.append(
                             [url_link, section_title, section_text, link_text, link_href]
                         )
-        df = pd.DataFrame(
-            data=website_details,
-            columns=[
-                "reference_href_clean",
-                "details_section",
-                "details_section_text",
-                "details_href_name",
-                "details_href",
-            ],
-        )
+        df = pd.DataFrame(data=website_details, columns=FURTHER_REFERENCE_COLUMNS)
         return df
 
 
@@ -1,11 +1,16 @@
 import os
 import logging
+import hashlib
 import pandas as pd
 import tqdm
 import requests
 import backoff
 import datetime
+import shutil
+import uuid
 import zipfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from urllib.parse import urlparse
 from urllib.parse import urljoin
@@ -15,7 +20,10 @@ from app.utils import (
     make_title_safe,
     get_chrome_driver,
     get_filetype,
+    readiness_tracker,
 )  # noqa: E402
+from app.scraper.download_index import DownloadIndex
+from app.metrics import metrics
 
 FILE_EXTENSIONS = [
     "docx",
@@ -55,27 +63,140 @@ EURLEX_BASE_URL = "https://eur-lex.europa.eu/legal-content/SL/TXT/?"
 logging.basicConfig(level=logging.INFO)
 
 
-@backoff.on_exception(backoff.expo, ConnectionError, max_tries=10, max_time=20)
+HTTP_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"  # noqa E501
+}
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB buffers when streaming files to disk
+HTTP_POOL_SIZE = 16
+ZIP_EXTRACT_WORKERS = 4
+
+_http_session = None
+
+
+class DownloadIntegrityError(IOError):
+    """Raised when a downloaded file does not match the expected size or hash."""
+
+
+def get_http_session():
+    """
+    Returns the shared requests session. The session keeps the connections alive and pools
+    them, so that consecutive downloads from the same host (e.g. EUR-Lex, PISRS) do not pay
+    for a new TCP/TLS handshake every time.
+    """
+    global _http_session
+    if _http_session is None:
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        session.headers.update(HTTP_HEADERS)
+        _http_session = session
+    return _http_session
+
+
+def _is_permanent_http_error(e):
+    # Do not retry on client errors (e.g. 404), except for rate limiting
+    response = getattr(e, "response", None)
+    if response is None:
+        return False
+    return 400 <= response.status_code < 500 and response.status_code != 429
+
+
+def _get_expected_size(response, resume_from):
+    # With a compressed transfer the Content-Length does not match the number of decoded bytes
+    if response.headers.get("Content-Encoding", "identity") != "identity":
+        return None
+    if response.status_code == 206:
+        # Content-Range: bytes <start>-<end>/<total>
+        total = response.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+        return int(total) if total.isdigit() else None
+    content_length = response.headers.get("Content-Length")
+    return int(content_length) if content_length is not None else None
+
+
+@metrics.timed("download_file")
+@backoff.on_exception(
+    backoff.expo,
+    (requests.exceptions.RequestException, DownloadIntegrityError),
+    max_tries=10,
+    max_time=20,
+    giveup=_is_permanent_http_error,
+)
 def _download_file(url_link, save_path):
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"  # noqa E501
-    }
-    response = requests.get(url_link, headers=headers, timeout=20)  # stream=True,
-    with open(save_path, "wb") as f:
-        for chunk in response.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
+    """
+    Streams the file at url_link to save_path.
+
+    The data is written to a temporary `<save_path>.part` file that is atomically renamed to
+    save_path once the download is complete and its size is verified, so failed or truncated
+    downloads never end up at save_path. If a `.part` file is left over from a previous attempt,
+    the download is resumed with a Range request.
+
+    Args:
+        url_link (str): The URL of the file to download.
+        save_path (str): The path where the file is saved.
+
+    Returns:
+        str: The SHA-256 hex digest of the downloaded file.
+
+    Raises:
+        DownloadIntegrityError: If the file size does not match the Content-Length (after all the
+            retries).
+    """
+    part_path = save_path + ".part"
+    resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={resume_from}-"} if resume_from else {}
+
+    sha256 = hashlib.sha256()
+    session = get_http_session()
+    with session.get(url_link, headers=headers, stream=True, timeout=(10, 60)) as response:
+        if response.status_code == 416:
+            # The partial file does not match the remote file anymore. Start from scratch
+            os.remove(part_path)
+            raise DownloadIntegrityError(f"Could not resume the download of {url_link}")
+        response.raise_for_status()
+
+        if resume_from and response.status_code == 206:
+            mode = "ab"
+            with open(part_path, "rb") as f:
+                for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b""):
+                    sha256.update(chunk)
+        else:
+            mode = "wb"  # The server ignored the Range header, download the whole file
+        expected_size = _get_expected_size(response, resume_from)
+
+        with open(part_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if chunk:
+                    f.write(chunk)
+                    sha256.update(chunk)
+
+    downloaded_size = os.path.getsize(part_path)
+    if expected_size is not None and downloaded_size != expected_size:
+        # Keep the partial file, the next attempt resumes from where this one stopped
+        raise DownloadIntegrityError(
+            f"Truncated download of {url_link}: got {downloaded_size} of {expected_size} bytes"
+        )
+
+    os.replace(part_path, save_path)
+    metrics.count("download_file.bytes", downloaded_size - (resume_from if mode == "ab" else 0))
+    return sha256.hexdigest()
 
 
 class Scraper:
-    def __init__(self, references_data_path, output_dir, local=False):
+    def __init__(self, references_data_path, output_dir, local=False, download_index=None):
         self.driver = get_chrome_driver(local=local)
         self.references_data_path = references_data_path
         self.metadata_dir = os.path.dirname(references_data_path)
         self.references_data = pd.read_csv(references_data_path)
         self.output_dir = output_dir
         self.temp_dir = os.path.join(self.output_dir, "temp")
-        self.already_downloaded_clean_links = []
+        # Index of the already downloaded links (normalized URL -> download info), shared between
+        # the runs and the download workers (and the scrapers of the other sources, if given)
+        self.download_index = download_index or DownloadIndex(
+            os.path.join(self.metadata_dir, "download_index.json")
+        )
 
         # Make sure the output dir exists
         os.makedirs(output_dir, exist_ok=True)
@@ -124,17 +245,14 @@ class Scraper:
             # The order is important.
             # First try to download the details href, and if that is nan, then download the
             # reference href
-            # TODO (juan): Need to be able to handle .zip files. Problem is that they are too many
-            # too much manual work
-            # if get_filetype(details_href_clean) == "zip":
-            #     continue
-            #     self.download_zip_file(
-            #         details_href_clean,
-            #         row["details_href_name"],
-            #         idx,
-            #         idx_to_download_info,
-            #     )
-            if is_url_to_file(details_href_clean):
+            if get_filetype(details_href_clean) == "zip":
+                self.download_zip_file(
+                    details_href_clean,
+                    row["details_href_name"],
+                    idx,
+                    idx_to_download_info,
+                )
+            elif is_url_to_file(details_href_clean):
                 self.download_file(
                     details_href_clean,
                     row["details_href_name"],
@@ -148,6 +266,13 @@ class Scraper:
                     idx,
                     idx_to_download_info,
                 )
+            elif get_filetype(reference_href_clean) == "zip":
+                self.download_zip_file(
+                    reference_href_clean,
+                    row["reference_name"],
+                    idx,
+                    idx_to_download_info,
+                )
             elif is_url_to_file(reference_href_clean):
                 self.download_file(
                     reference_href_clean,
@@ -163,6 +288,11 @@ class Scraper:
                     idx_to_download_info,
                 )
 
+        self.download_index.save()
+        logging.info(f"Website readiness latencies: {readiness_tracker.summary()}")
+        if readiness_tracker.timed_out_urls:
+            logging.warning(f"Websites that hit the timeout: {readiness_tracker.timed_out_urls}")
+
         # Create a clean dataset for all the downloaded data
         self.update_downloaded_data_index()
 
@@ -181,130 +311,203 @@ class Scraper:
         Returns:
             None
         """
-        if url_link in self.already_downloaded_clean_links:
-            actual_download_link_and_paths = [
-                item[1:] for item in idx_to_download_info.values() if item[0] == url_link
-            ]
-            idx_to_download_info[idx] = (url_link, *actual_download_link_and_paths[0])
-            self.update_references_data(idx, url_link, *actual_download_link_and_paths[0])
-            return
-
-        # Determine the file extension type
-        # The file extension will be given by the last part of url_link.
-        # It will either be delineated by a dot or an equal sign
-        file_extension = url_link.split(".")[-1]
-        if "=" in file_extension:
-            file_extension = file_extension.split("=")[-1]
-        if file_extension not in FILE_EXTENSIONS:
-            print("Could not download the file", url_link)
+        is_claimed, previous_download_info = self.download_index.claim(url_link)
+        if not is_claimed:
+            idx_to_download_info[idx] = (url_link, *previous_download_info)
+            self.update_references_data(idx, url_link, *previous_download_info)
             return
 
-        # Download the file
-        saved_path = os.path.join(self.output_dir, make_title_safe(title) + "." + file_extension)
-        if not os.path.exists(saved_path):
-            try:
-                _download_file(url_link, saved_path)
-            except Exception as e:
-                print(f"Could not download the file {url_link}. Error: ", e)
+        download_url_link, saved_path = None, None
+        try:
+            # Determine the file extension type
+            # The file extension will be given by the last part of url_link.
+            # It will either be delineated by a dot or an equal sign
+            file_extension = url_link.split(".")[-1]
+            if "=" in file_extension:
+                file_extension = file_extension.split("=")[-1]
+            if file_extension not in FILE_EXTENSIONS:
+                print("Could not download the file", url_link)
+                return
+
+            # Download the file
+            save_path = os.path.join(
+                self.output_dir, make_title_safe(title) + "." + file_extension
+            )
+            if not os.path.exists(save_path):
+                try:
+                    _download_file(url_link, save_path)
+                except Exception as e:
+                    print(f"Could not download the file {url_link}. Error: ", e)
+            if os.path.exists(save_path):
+                download_url_link, saved_path = url_link, save_path
+        finally:
+            self.download_index.add(url_link, download_url_link, saved_path)
 
-        idx_to_download_info[idx] = (url_link, url_link, saved_path)
-        self.update_references_data(idx, url_link, url_link, saved_path)
-        self.already_downloaded_clean_links.append(url_link)
+        idx_to_download_info[idx] = (url_link, download_url_link, saved_path)
+        self.update_references_data(idx, url_link, download_url_link, saved_path)
         return
 
     def download_zip_file(self, url_link, title, idx, idx_to_download_info):
+        """
+        Downloads a zip archive and adds each of its supported files as a separate reference.
+
+        The members are streamed from the archive directly to the output directory (without
+        extracting the whole archive) by a pool of workers. The rows of the extracted files are
+        added to `references_data` in a single insert and replace the row of the archive.
 
+        Args:
+            url_link (str): The URL link of the zip archive.
+            title (str): The title of the archive.
+            idx (int): The index of the archive in references_data.
+            idx_to_download_info (dict): A dictionary mapping file indices to download information.
+
+        Returns:
+            None
+        """
+        is_claimed, _ = self.download_index.claim(url_link)
+        if not is_claimed:
+            # The members were already added as references, when the archive was first seen
+            self.update_references_data(idx, url_link, None, None)
+            return
+        is_ingested = False
+        try:
+            is_ingested = self._ingest_zip_file(url_link, idx)
+        finally:
+            # A failed archive is not retried within the same run, but it is in the next runs
+            self.download_index.add(url_link, url_link, None, persist=is_ingested)
+        return
+
+    def _ingest_zip_file(self, url_link, idx):
         # Download the zip file
-        zip_filename = os.path.basename(url_link)
-        zip_filepath = os.path.join(self.output_dir, zip_filename)
+        zip_filename = os.path.basename(urlparse(url_link).path)
+        zip_filepath = os.path.join(self.temp_dir, zip_filename)
         try:
             _download_file(url_link, zip_filepath)
         except Exception as e:
             print("Could not download the file", url_link, " Error: ", e)
-            return
-
-        self.update_references_data(idx, url_link, url_link, zip_filepath)
-        self.already_downloaded_clean_links.append(url_link)
+            return False
 
         try:
-            # Extract the zip file
             with zipfile.ZipFile(zip_filepath, "r") as zip_ref:
-                zip_ref.extractall(self.temp_dir)
-        except Exception as e:
+                # TODO (juan) we will not handle the cases where the extracted file is a directory
+                members = [
+                    member
+                    for member in zip_ref.infolist()
+                    if not member.is_dir() and get_filetype(member.filename.lower()) != "unknown"
+                ]
+        except zipfile.BadZipFile as e:
             print("Could not extract the zip data for url: ", url_link, "Error: ", e)
-            return
+            os.remove(zip_filepath)
+            return False
 
-        for extracted_file in zip_ref.namelist():
-            original_path = os.path.join(self.temp_dir, extracted_file)
-            if not os.path.isfile(original_path):
-                # TODO (juan) we will not handle the cases where the extracted file is a directory
-                continue
-            if get_filetype(original_path) == "unknown":
-                continue
-            new_filename = f"{zip_filename.rsplit('.')[0]}_{extracted_file}"
-            new_filename = make_title_safe(new_filename)
-            new_filepath = os.path.join(self.output_dir, new_filename)
-            os.rename(original_path, new_filepath)
+        zip_name = os.path.splitext(zip_filename)[0]
+        with ThreadPoolExecutor(max_workers=ZIP_EXTRACT_WORKERS) as executor:
+            extracted_paths = list(
+                executor.map(
+                    lambda member: self._extract_zip_member(zip_filepath, zip_name, member),
+                    members,
+                )
+            )
+        os.remove(zip_filepath)
 
-            # Create a new row for the DataFrame
-            orig_row = self.references_data.iloc[idx]
+        # Create a new row for every extracted file and replace the row of the zip file
+        orig_row = self.references_data.loc[idx]
+        date_downloaded = datetime.datetime.now().date()
+        new_rows = []
+        for new_filepath in extracted_paths:
+            if new_filepath is None:
+                continue
             new_row = orig_row.copy()
-            new_row["details_href_name"] = new_filename
+            new_row["file_id"] = uuid.uuid4()
+            new_row["details_href_name"] = os.path.basename(new_filepath)
+            new_row["used_download_href"] = url_link
+            new_row["actual_download_link"] = url_link
             new_row["actual_download_location"] = new_filepath
-            new_index = self.references_data.index.max() + 1
-            new_row_df = pd.DataFrame(
-                [new_row], index=[new_index], columns=self.references_data.columns
-            )
-            self.references_data = pd.concat(
-                [self.references_data, new_row_df],
-                ignore_index=False,
-            )
-            self.references_data.to_csv(self.references_data_path, index=False)
-
-        # Delete the original row using the original index
-        self.references_data = self.references_data.drop(idx)
+            new_row["date_downloaded"] = date_downloaded
+            new_row["is_scraped"] = True
+            new_rows.append(new_row)
+        if len(new_rows) == 0:
+            print("No supported files found in the zip archive: ", url_link)
+            self.update_references_data(idx, url_link, None, None)
+            return True
+
+        start_index = self.references_data.index.max() + 1
+        new_rows_df = pd.DataFrame(
+            new_rows,
+            index=range(start_index, start_index + len(new_rows)),
+            columns=self.references_data.columns,
+        )
+        self.references_data = pd.concat([self.references_data.drop(idx), new_rows_df])
         self.references_data.to_csv(self.references_data_path, index=False)
+        return True
+
+    def _extract_zip_member(self, zip_filepath, zip_name, member):
+        # Keep the extension out of make_title_safe, so that it is not cut off. make_title_safe
+        # truncates the long names, so the name ends with a hash of the member (its path, CRC and
+        # size): the file of another member or of another version of the member is never reused
+        member_name, member_extension = os.path.splitext(member.filename)
+        member_hash = hashlib.sha256(
+            f"{member.filename}:{member.CRC}:{member.file_size}".encode("utf-8")
+        ).hexdigest()[:12]
+        new_filename = (
+            make_title_safe(f"{zip_name}_{member_name}")
+            + f"_{member_hash}"
+            + member_extension.lower()
+        )
+        new_filepath = os.path.join(self.output_dir, new_filename)
+        if os.path.exists(new_filepath) and os.path.getsize(new_filepath) == member.file_size:
+            return new_filepath
 
-        os.remove(zip_filepath)
-        # except Exception as e:
-        #     print("Could not extract the zip data for url: ", url_link, "Error: ", e)
-        return
+        # Own part file of the thread, the same member can be extracted by two threads at once
+        part_path = f"{new_filepath}.{threading.get_ident()}.part"
+        try:
+            # Every worker uses its own handle of the archive
+            with zipfile.ZipFile(zip_filepath, "r") as zip_ref:
+                with zip_ref.open(member) as fin, open(part_path, "wb") as fout:
+                    shutil.copyfileobj(fin, fout, DOWNLOAD_CHUNK_SIZE)
+            os.replace(part_path, new_filepath)
+        except Exception as e:
+            print(f"Could not extract {member.filename} from {zip_filepath}. Error: ", e)
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            return None
+        return new_filepath
 
     def download_website(self, url_link, title, idx, idx_to_download_info):
-        if url_link in self.already_downloaded_clean_links:
-            actual_download_link_and_paths = [
-                item[1:] for item in idx_to_download_info.values() if item[0] == url_link
-            ]
-            idx_to_download_info[idx] = (url_link, *actual_download_link_and_paths[0])
-            self.update_references_data(idx, url_link, *actual_download_link_and_paths[0])
+        is_claimed, previous_download_info = self.download_index.claim(url_link)
+        if not is_claimed:
+            idx_to_download_info[idx] = (url_link, *previous_download_info)
+            self.update_references_data(idx, url_link, *previous_download_info)
             return
 
         download_url_link = None
         saved_path = None
-        if "eur-lex.europa.eu" in url_link:
-            download_url_link, saved_path = ScrapeEURLex.download_custom_website(
-                url_link, title, output_dir=self.output_dir, driver=self.driver
-            )
-        elif ".uradni-list.si" in url_link:
-            download_url_link, saved_path = ScrapeUradniList.download_custom_website(
-                url_link, title, output_dir=self.output_dir, driver=self.driver
-            )
-        elif ".pisrs.si" in url_link:
-            download_url_link, saved_path = ScrapePISRS.download_custom_website(
-                url_link, title, output_dir=self.output_dir, driver=self.driver
-            )
-        elif "fu.gov.si" in url_link:
-            download_url_link, saved_path = ScrapeGOVsi.download_custom_website(
-                url_link, title, output_dir=self.output_dir, driver=self.driver
-            )
-        else:
-            # print("Need to download from other website: ", url_link)
-            download_url_link, saved_path = None, None
+        try:
+            if "eur-lex.europa.eu" in url_link:
+                download_url_link, saved_path = ScrapeEURLex.download_custom_website(
+                    url_link, title, output_dir=self.output_dir, driver=self.driver
+                )
+            elif ".uradni-list.si" in url_link:
+                download_url_link, saved_path = ScrapeUradniList.download_custom_website(
+                    url_link, title, output_dir=self.output_dir, driver=self.driver
+                )
+            elif ".pisrs.si" in url_link:
+                download_url_link, saved_path = ScrapePISRS.download_custom_website(
+                    url_link, title, output_dir=self.output_dir, driver=self.driver
+                )
+            elif "fu.gov.si" in url_link:
+                download_url_link, saved_path = ScrapeGOVsi.download_custom_website(
+                    url_link, title, output_dir=self.output_dir, driver=self.driver
+                )
+            else:
+                # print("Need to download from other website: ", url_link)
+                download_url_link, saved_path = None, None
+        finally:
+            self.download_index.add(url_link, download_url_link, saved_path)
 
         # Now update the idx_to_download_info
         idx_to_download_info[idx] = (url_link, download_url_link, saved_path)
         self.update_references_data(idx, url_link, download_url_link, saved_path)
-        self.already_downloaded_clean_links.append(url_link)
         return
 
     def update_references_data(self, idx, url_link, actual_download_link, actual_download_location):
@@ -481,7 +684,7 @@ class ScrapePISRS(Scraper):
         metadata_url = PISRS_METADATA_BASE_URL + resource_id
         try:
 
-            response = requests.get(metadata_url)
+            response = get_http_session().get(metadata_url, timeout=20)
             if response.status_code == 200:
                 data = response.json()
                 # Get the resource title
@@ -0,0 +1,93 @@
+import asyncio
+import logging
+
+"""
+Coalescing of the concurrent queries of the retrieval service.
+
+The queries that arrive within a short window are searched together: one embedding request for
+all of the query texts and one search over the stacked query embeddings (IndexVersion.search_batch).
+The results are handed back to the waiting requests. Under load, the number of embedding requests
+and index searches drops by up to the batch size, while a lone query waits at most max_wait_ms.
+"""
+
+DEFAULT_MAX_BATCH_SIZE = 32
+DEFAULT_MAX_WAIT_MS = 5
+
+
+class QueryBatcher:
+    """
+    Collects the concurrent queries into batches.
+
+    Args:
+        manager (IndexManager): The manager of the served database version. Every batch is
+            searched on the version served when the batch is dispatched.
+        max_batch_size (int): The maximum number of queries in a batch.
+        max_wait_ms (float): How long the first query of a batch waits for more queries.
+    """
+
+    def __init__(
+        self, manager, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS
+    ):
+        self.manager = manager
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._collector = None
+        self._batches = set()
+
+    def start(self):
+        """Starts collecting the batches, on the running event loop."""
+        self._queue = asyncio.Queue()
+        self._collector = asyncio.create_task(self._collect())
+
+    async def stop(self):
+        """Stops collecting, after the dispatched batches are finished."""
+        self._collector.cancel()
+        await asyncio.gather(*self._batches, return_exceptions=True)
+
+    async def search(self, query, k):
+        """
+        Searches the query as part of the next batch.
+
+        Returns:
+            tuple: The version of the database that was searched and the results of the query
+                (see IndexVersion.search).
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((query, k, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Keep collecting the next batch while this one is searched
+            task = asyncio.create_task(self._dispatch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _dispatch(self, batch):
+        index = self.manager.current
+        try:
+            if index is None:
+                raise RuntimeError("The database is not loaded yet")
+            queries, ks = [query for query, _, _ in batch], [k for _, k, _ in batch]
+            results = await asyncio.to_thread(index.search_batch, queries, ks)
+        except Exception as e:
+            logging.error(f"Search of a batch of {len(batch)} queries failed: {e}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, future), query_results in zip(batch, results):
+            if not future.done():  # The request may have been cancelled meanwhile
+                future.set_result((index.version, query_results))
@@ -0,0 +1,231 @@
+import os
+import shutil
+import logging
+import datetime
+import threading
+import numpy as np
+from app.storage.snapshots import read_latest_manifest, download_snapshot
+from app.serving.shared_index import (
+    SharedIndexVersion,
+    export_shared_index,
+    write_current_version,
+    SHARED_DIR_NAME,
+    CURRENT_NAME,
+)
+from app.serving.search import SearchableIndex
+from app.serving.rerank import create_reranker
+from app.database.rerank_features import load_rerank_features
+from app.metrics import metrics
+
+"""
+The database versions held in memory by the retrieval service.
+
+Every snapshot version is downloaded into its own directory (<serving_dir>/<version>/) and loaded
+next to the version that is being served. Only once the new version is loaded and warmed up, the
+served version is swapped, in a single assignment. The requests that already started keep the
+version they started with, so a reload never interrupts or slows down the queries.
+
+With several worker processes, the loader exports every version to the memory-mapped files shared
+by the workers instead (see app.serving.shared_index).
+"""
+
+LOCAL_VERSION = "local"
+VECTOR_DB_NAME = "vector_database"
+
+
+class IndexVersion(SearchableIndex):
+    """
+    A loaded version of the database, searched with the FAISS index (see SearchableIndex).
+
+    Args:
+        version (str): The snapshot version (LOCAL_VERSION for a local database).
+        path (str): The directory of the files of the version.
+        db (FAISS): The FAISS index with its docstore.
+    """
+
+    def __init__(self, version, path, db):
+        self.version = version
+        self.path = path
+        self.db = db
+        self.loaded_at = datetime.datetime.utcnow().isoformat()
+
+    def warm_up(self):
+        """Runs a search, so the index pages are in memory before the first query."""
+        query = np.zeros((1, self.db.index.d), dtype=np.float32)
+        self.db.index.search(query, 1)
+
+    def embed(self, queries):
+        vectors = np.asarray(self.db.embeddings.embed_documents(queries), dtype=np.float32)
+        if getattr(self.db, "_normalize_L2", False):
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+    def search_vectors(self, vectors, k):
+        return self.db.index.search(vectors, k)
+
+    def get_vectors(self, ids):
+        return np.vstack([self.db.index.reconstruct(int(i)) for i in ids])
+
+    def get_chunk(self, i):
+        document = self.db.docstore.search(self.db.index_to_docstore_id[i])
+        return document.page_content, document.metadata
+
+
+def load_faiss(path, embedding_model):
+    """Loads the langchain FAISS store from the directory."""
+    from langchain_openai import OpenAIEmbeddings
+    from langchain_community.vectorstores import FAISS
+
+    return FAISS.load_local(path, OpenAIEmbeddings(model=embedding_model))
+
+
+def load_index_version(version, path, embedding_model, shared_dir=None, rerank_options=None):
+    """
+    Loads the FAISS index of the version from the directory. If shared_dir is set, the index is
+    exported to the shared files in shared_dir and the version is mapped from them. If
+    rerank_options is set, the results are re-ranked with a Reranker created with the options.
+    """
+    with metrics.timer("load_index"):
+        db = load_faiss(path, embedding_model)
+        features = load_rerank_features(path)
+        if shared_dir is None:
+            index = IndexVersion(version, path, db)
+        else:
+            export_shared_index(db, shared_dir, features=features)
+            index = SharedIndexVersion(version, shared_dir, db.embeddings)
+        index.reranker = create_reranker(features, rerank_options, db.index.ntotal)
+        index.warm_up()
+    return index
+
+
+class IndexManager:
+    """
+    Keeps the served version of the database and swaps it for the new versions (double-buffered).
+
+    Args:
+        serving_dir (str): The directory of the downloaded versions.
+        embedding_model (str): The embedding model of the database.
+        bucket_name (str, optional): The bucket with the snapshots. If None, the database in
+            vector_db_path is served and never reloaded.
+        vector_db_path (str, optional): The local database, used without a bucket.
+        local (bool): Whether running on the local machine.
+        shared (bool): Export the versions for the worker processes (SharedIndexFollower).
+        rerank_options (dict, optional): The arguments of the Reranker of the served versions
+            (see app.serving.rerank). None disables the re-ranking.
+        query_cache (QueryCache, optional): The cache of the results of the served versions.
+    """
+
+    def __init__(
+        self,
+        serving_dir,
+        embedding_model,
+        bucket_name=None,
+        vector_db_path=None,
+        local=False,
+        shared=False,
+        rerank_options=None,
+        query_cache=None,
+    ):
+        if bucket_name is None and vector_db_path is None:
+            raise ValueError("Either the bucket or the local vector database path is required")
+        self.serving_dir = serving_dir
+        self.embedding_model = embedding_model
+        self.bucket_name = bucket_name
+        self.vector_db_path = vector_db_path
+        self.local = local
+        self.shared = shared
+        self.rerank_options = rerank_options
+        self.query_cache = query_cache
+        self.current = None
+        self._refresh_lock = threading.Lock()
+
+    @property
+    def can_reload(self):
+        return self.bucket_name is not None
+
+    def _get_shared_dir(self, version):
+        if not self.shared:
+            return None
+        return os.path.join(self.serving_dir, version, SHARED_DIR_NAME)
+
+    def refresh(self):
+        """
+        Loads the latest version, if it is not the served one, and swaps it in.
+
+        Returns:
+            bool: True if a new version is served.
+        """
+        with self._refresh_lock:
+            if self.bucket_name is None:
+                if self.current is not None:
+                    return False
+                return self._swap(
+                    load_index_version(
+                        LOCAL_VERSION,
+                        self.vector_db_path,
+                        self.embedding_model,
+                        shared_dir=self._get_shared_dir(LOCAL_VERSION),
+                        rerank_options=self.rerank_options,
+                    )
+                )
+
+            manifest = read_latest_manifest(self.bucket_name, local=self.local)
+            if manifest is None:
+                logging.warning(f"No database snapshot in the bucket {self.bucket_name}")
+                return False
+            if self.current is not None and manifest["version"] == self.current.version:
+                return False
+
+            version_dir = os.path.join(self.serving_dir, manifest["version"])
+            self._link_current_files(version_dir)
+            download_snapshot(
+                self.bucket_name,
+                lambda name: os.path.join(version_dir, name),
+                local=self.local,
+                manifest=manifest,
+            )
+            index = load_index_version(
+                manifest["version"],
+                os.path.join(version_dir, VECTOR_DB_NAME),
+                self.embedding_model,
+                shared_dir=self._get_shared_dir(manifest["version"]),
+                rerank_options=self.rerank_options,
+            )
+            return self._swap(index)
+
+    def _link_current_files(self, version_dir):
+        # Start the new version from the files of the served one, only the changed files are
+        # downloaded. The downloads replace the links, the files of the served version stay intact
+        if self.current is None or self.current.version == LOCAL_VERSION:
+            return
+        current_dir = os.path.dirname(self.current.path)
+        for root, _, file_names in os.walk(current_dir):
+            for file_name in file_names:
+                source = os.path.join(root, file_name)
+                target = os.path.join(version_dir, os.path.relpath(source, current_dir))
+                if os.path.exists(target):
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                try:
+                    os.link(source, target)
+                except OSError:
+                    shutil.copy2(source, target)
+
+    def _swap(self, index):
+        if self.query_cache is not None:
+            # The results of the previous version are not cached anymore
+            self.query_cache.set_version(index.version)
+            index.query_cache = self.query_cache
+        self.current = index
+        metrics.count("index_reloads")
+        logging.info(f"Serving database version {index.version}")
+        if self.shared:
+            write_current_version(self.serving_dir, index.version)
+        if index.version != LOCAL_VERSION:
+            # The previous version is in memory, the requests using it do not need its files.
+            # Also removes the versions left behind by an earlier run of the service. The
+            # workers keep their maps of the removed shared files until they switch
+            for name in os.listdir(self.serving_dir):
+                if name not in [index.version, CURRENT_NAME]:
+                    shutil.rmtree(os.path.join(self.serving_dir, name), ignore_errors=True)
+        return True
@@ -0,0 +1,145 @@
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+from app.metrics import metrics
+
+"""
+Cache of the results of the repeated queries of the retrieval service.
+
+The users keep asking the same questions (the VAT thresholds, the deadlines of the income tax).
+The cache has two levels:
+
+1. Exact: the normalized text of the query (case, whitespace and the final punctuation are
+   ignored). A hit costs neither the embedding of the query nor the search.
+2. Semantic: the embedding of the query is compared with the embeddings of the cached queries (a
+   small in-memory matrix, searched exhaustively). A hit within the similarity threshold saves the
+   search and the re-ranking.
+
+The entries expire after ttl seconds and the least recently used entries are evicted. The cached
+results belong to one snapshot version, the cache is emptied when the served version changes
+(set_version).
+"""
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL = 3600
+# The cosine similarity of the query embeddings for a semantic hit. High, because the questions
+# differing in one number (a year, an amount) have very similar embeddings
+DEFAULT_SIMILARITY_THRESHOLD = 0.97
+TRAILING_PUNCTUATION = "?!.,;: "
+
+
+def normalize_query(query):
+    """Returns the text of the query used for the exact hits."""
+    query = unicodedata.normalize("NFKC", query)
+    return " ".join(query.lower().split()).rstrip(TRAILING_PUNCTUATION)
+
+
+class QueryCache:
+    """
+    Two-level cache of the search results, see the module docstring. Thread-safe.
+
+    Args:
+        max_entries (int): The maximum number of cached queries.
+        ttl (float): Seconds after which an entry expires.
+        similarity_threshold (float): The minimal cosine similarity of a semantic hit. Above 1
+            disables the semantic level.
+    """
+
+    def __init__(
+        self,
+        max_entries=DEFAULT_MAX_ENTRIES,
+        ttl=DEFAULT_TTL,
+        similarity_threshold=DEFAULT_SIMILARITY_THRESHOLD,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.version = None
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        # (normalized query, k) -> (slot, expires_at, results), in the order of the last use
+        self._entries = OrderedDict()
+        # The unit embeddings of the entries, one row (slot) per entry
+        self._vectors = None
+        self._slot_keys = [None] * self.max_entries
+        self._slot_ks = np.full(self.max_entries, -1, dtype=np.int64)
+        self._free_slots = list(range(self.max_entries - 1, -1, -1))
+
+    def set_version(self, version):
+        """Empties the cache if the version is not the version of the cached results."""
+        with self._lock:
+            if version != self.version:
+                self._clear()
+                self.version = version
+
+    def _remove(self, key):
+        slot, _, _ = self._entries.pop(key)
+        self._slot_keys[slot] = None
+        self._slot_ks[slot] = -1
+        self._free_slots.append(slot)
+
+    def _get_entry(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[1] < now:
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[2]
+
+    def get(self, version, query, k):
+        """
+        Returns the cached results of the query with the same normalized text. None on a miss,
+        or if the results are not of the version.
+        """
+        with self._lock:
+            if version != self.version:
+                return None
+            results = self._get_entry((normalize_query(query), k), time.monotonic())
+        if results is not None:
+            metrics.count("query_cache.exact_hits")
+        return results
+
+    def get_similar(self, version, vector, k):
+        """Returns the cached results of the most similar query within the threshold, or None."""
+        with self._lock:
+            if version != self.version or self._vectors is None or not self._entries:
+                return None
+            vector = np.asarray(vector, dtype=np.float32)
+            similarities = self._vectors @ (vector / (np.linalg.norm(vector) or 1.0))
+            similarities[self._slot_ks != k] = -np.inf
+            # From the most similar, the expired entries are evicted and the next one is tried
+            candidates = np.flatnonzero(similarities >= self.similarity_threshold)
+            now = time.monotonic()
+            results = None
+            for slot in candidates[np.argsort(-similarities[candidates])]:
+                results = self._get_entry(self._slot_keys[slot], now)
+                if results is not None:
+                    break
+        if results is not None:
+            metrics.count("query_cache.semantic_hits")
+        return results
+
+    def put(self, version, query, vector, k, results):
+        """Caches the results of the query. Ignored if the version is not the cached version."""
+        with self._lock:
+            if version != self.version or self.max_entries == 0:
+                return
+            key = (normalize_query(query), k)
+            if key in self._entries:
+                self._remove(key)
+            elif len(self._entries) >= self.max_entries:
+                self._remove(next(iter(self._entries)))  # The least recently used
+            vector = np.asarray(vector, dtype=np.float32)
+            if self._vectors is None:
+                self._vectors = np.zeros((self.max_entries, len(vector)), dtype=np.float32)
+            slot = self._free_slots.pop()
+            self._vectors[slot] = vector / (np.linalg.norm(vector) or 1.0)
+            self._slot_keys[slot] = key
+            self._slot_ks[slot] = k
+            self._entries[key] = (slot, time.monotonic() + self.ttl, results)
@@ -0,0 +1,211 @@
+import logging
+import numpy as np
+from app.metrics import metrics
+
+"""
+Re-ranking of the retrieved chunks.
+
+The nearest chunks of the flat index are often overlapping parts of the same law. The candidates
+(fetch_factor * k nearest chunks) are re-ranked with MMR (maximal marginal relevance), which
+trades the relevance to the query for the diversity of the selected chunks. The selected chunks
+that are adjacent in the same file are then merged into one passage, in the order of the file. The
+passages can finally be scored with a local cross-encoder. The norms and the neighbours of the
+chunks are precomputed when the index is built (app.database.rerank_features), so the re-ranking
+without the cross-encoder takes a few milliseconds.
+"""
+
+DEFAULT_LAMBDA = 0.5
+DEFAULT_FETCH_FACTOR = 4
+# The overlaps of adjacent chunks, between these lengths, are removed when the chunks are merged
+MAX_OVERLAP_CHARS = 4000
+MIN_OVERLAP_CHARS = 32
+
+
+def mmr(query_vector, vectors, norms, k, lambda_mult=DEFAULT_LAMBDA):
+    """
+    Selects k of the candidates with maximal marginal relevance.
+
+    Args:
+        query_vector (numpy.ndarray): The embedding of the query.
+        vectors (numpy.ndarray): The embeddings of the candidates.
+        norms (numpy.ndarray): The L2 norms of the embeddings of the candidates.
+        k (int): The number of candidates to select.
+        lambda_mult (float): 1 selects by the relevance only, 0 by the diversity only.
+
+    Returns:
+        list: The positions of the selected candidates, in the order of selection.
+    """
+    query_norm = np.linalg.norm(query_vector) or 1.0
+    unit_vectors = vectors / np.where(norms == 0, 1.0, norms)[:, None]
+    relevance = unit_vectors @ (query_vector / query_norm)
+    selected = [int(np.argmax(relevance))]
+    max_similarity = unit_vectors @ unit_vectors[selected[0]]
+    while len(selected) < min(k, len(vectors)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        max_similarity = np.maximum(max_similarity, unit_vectors @ unit_vectors[best])
+    return selected
+
+
+def group_adjacent(positions, previous, following):
+    """
+    Groups the positions of the chunks that are adjacent in the same file.
+
+    Args:
+        positions (list): The positions of the chunks in the index, ranked.
+        previous (numpy.ndarray): The position of the preceding chunk of every chunk, or -1.
+        following (numpy.ndarray): The position of the following chunk of every chunk, or -1.
+
+    Returns:
+        list: The groups of positions, in the order of the file, ranked by their best chunk.
+    """
+    remaining = set(positions)
+    groups = []
+    for position in positions:
+        if position not in remaining:
+            continue
+        first = position
+        while previous[first] != -1 and int(previous[first]) in remaining:
+            first = int(previous[first])
+        group = [first]
+        while following[group[-1]] != -1 and int(following[group[-1]]) in remaining:
+            group.append(int(following[group[-1]]))
+        remaining.difference_update(group)
+        groups.append(group)
+    return groups
+
+
+def join_chunks(texts):
+    """Joins the texts of adjacent chunks, without the text repeated in their overlap."""
+    joined = texts[0]
+    for text in texts[1:]:
+        probe = text[:MIN_OVERLAP_CHARS]
+        start = joined.find(probe, max(len(joined) - MAX_OVERLAP_CHARS, 0)) if probe else -1
+        while start != -1 and not text.startswith(joined[start:]):
+            start = joined.find(probe, start + 1)
+        if start != -1:
+            joined = joined[:start] + text
+        else:
+            joined = joined + "\n\n" + text
+    return joined
+
+
+def load_cross_encoder(model_name):
+    """Loads a sentence-transformers cross-encoder on the CPU."""
+    from sentence_transformers import CrossEncoder
+
+    return CrossEncoder(model_name, device="cpu")
+
+
+class Reranker:
+    """
+    Re-ranks the candidates of a search, see the module docstring.
+
+    Args:
+        features (dict): The re-ranking features of the index (load_rerank_features).
+        lambda_mult (float): The MMR trade-off between the relevance and the diversity.
+        fetch_factor (int): The number of candidates, as a multiple of k.
+        merge_adjacent (bool): Whether to merge the adjacent chunks into passages.
+        cross_encoder (CrossEncoder, optional): Scores the (query, passage) pairs.
+    """
+
+    def __init__(
+        self,
+        features,
+        lambda_mult=DEFAULT_LAMBDA,
+        fetch_factor=DEFAULT_FETCH_FACTOR,
+        merge_adjacent=True,
+        cross_encoder=None,
+    ):
+        self.features = features
+        self.lambda_mult = lambda_mult
+        self.fetch_factor = fetch_factor
+        self.merge_adjacent = merge_adjacent
+        self.cross_encoder = cross_encoder
+
+    def get_fetch_k(self, k):
+        return k * self.fetch_factor
+
+    @metrics.timed("rerank")
+    def rerank(self, index, query, query_vector, distances, ids, k):
+        """
+        Re-ranks the candidates of the query.
+
+        Args:
+            index (SearchableIndex): The searched index.
+            query (str): The query text.
+            query_vector (numpy.ndarray): The embedding of the query.
+            distances (numpy.ndarray): The distances of the candidates.
+            ids (numpy.ndarray): The positions of the candidates in the index (-1 for none).
+            k (int): The number of chunks to select.
+
+        Returns:
+            list: The passages, as the results of SearchableIndex.search, with the chunk_idx of
+                the merged chunks in the metadata (merged_chunk_idx).
+        """
+        valid = ids != -1
+        distances, ids = distances[valid], ids[valid]
+        if len(ids) == 0:
+            return []
+        selected = mmr(
+            query_vector,
+            index.get_vectors(ids),
+            self.features["norms"][ids],
+            k,
+            lambda_mult=self.lambda_mult,
+        )
+        positions = [int(ids[i]) for i in selected]
+        distance_by_position = {int(ids[i]): float(distances[i]) for i in selected}
+        if self.merge_adjacent:
+            groups = group_adjacent(positions, self.features["previous"], self.features["next"])
+        else:
+            groups = [[position] for position in positions]
+
+        passages = []
+        for group in groups:
+            chunks = [index.get_chunk(position) for position in group]
+            metadata = dict(chunks[0][1])
+            if len(group) > 1:
+                metadata["merged_chunk_idx"] = [int(self.features["chunk_idx"][p]) for p in group]
+            passages.append(
+                {
+                    "text": join_chunks([text for text, _ in chunks]),
+                    "metadata": metadata,
+                    "score": min(distance_by_position[position] for position in group),
+                }
+            )
+
+        if self.cross_encoder is not None:
+            with metrics.timer("cross_encoder"):
+                scores = self.cross_encoder.predict([(query, p["text"]) for p in passages])
+            for passage, score in zip(passages, scores):
+                passage["rerank_score"] = float(score)
+            passages.sort(key=lambda passage: passage["rerank_score"], reverse=True)
+        return passages
+
+
+def create_reranker(features, options, n_chunks):
+    """
+    Returns the Reranker of the index, None if options is None or if the index has no features
+    or features of another state of the index (an interrupted build saves the index without
+    rewriting the features).
+
+    Args:
+        features (dict): The re-ranking features of the index (load_rerank_features).
+        options (dict): The arguments of the Reranker.
+        n_chunks (int): The number of chunks in the index.
+    """
+    if options is None:
+        return None
+    if features is None:
+        logging.warning("The index has no re-ranking features, serving the plain search results")
+        return None
+    if any(len(values) != n_chunks for values in features.values()):
+        logging.warning(
+            f"The re-ranking features do not match the index ({len(features['norms'])} features, "
+            f"{n_chunks} chunks), serving the plain search results"
+        )
+        return None
+    return Reranker(features, **options)
@@ -0,0 +1,122 @@
+import numpy as np
+from app.metrics import metrics
+
+"""
+The search shared by the in-memory (app.serving.index) and the memory-mapped
+(app.serving.shared_index) database versions. The versions implement the embedding of the queries,
+the vector search and the lookup of the chunks. The search embeds and searches the queries in
+batches and, if the version has a reranker, re-ranks the candidates (see app.serving.rerank). With
+a query cache, the repeated queries are answered from the cache (see app.serving.query_cache).
+"""
+
+DEFAULT_K = 5
+# The queries are searched in batches for the largest k of the batch, so k is bounded
+MAX_K = 100
+
+
+class SearchableIndex:
+    """
+    Base class of the database versions.
+
+    Subclasses set version, path and loaded_at and implement embed, search_vectors, get_vectors and
+    get_chunk.
+    """
+
+    reranker = None
+    query_cache = None
+
+    def embed(self, queries):
+        """Returns the embeddings of the queries, as a float32 numpy array."""
+        raise NotImplementedError
+
+    def search_vectors(self, vectors, k):
+        """
+        Returns the L2 distances and the positions of the k closest chunks of every query
+        embedding, as numpy arrays of shape (n_queries, k), from the closest (-1 for none).
+        """
+        raise NotImplementedError
+
+    def get_vectors(self, ids):
+        """Returns the embeddings of the chunks at the positions."""
+        raise NotImplementedError
+
+    def get_chunk(self, i):
+        """Returns the text and the metadata of the chunk at the position."""
+        raise NotImplementedError
+
+    def search(self, query, k=DEFAULT_K):
+        """
+        Returns the k chunks closest to the query.
+
+        Returns:
+            list: The dicts with the text, the metadata and the distance (score) of the chunks.
+                With a reranker, the re-ranked passages.
+        """
+        return self.search_batch([query], [k])[0]
+
+    def search_batch(self, queries, ks):
+        """
+        Searches several queries at once: the queries are embedded in one request and searched
+        with one search over the matrix of the query embeddings.
+
+        Args:
+            queries (list): The query texts.
+            ks (list): The number of chunks to return for every query.
+
+        Returns:
+            list: The results of every query, see search.
+        """
+        cache = self.query_cache
+        if cache is None:
+            return self._search_batch(queries, ks)
+
+        results = [cache.get(self.version, query, k) for query, k in zip(queries, ks)]
+        misses = [i for i, query_results in enumerate(results) if query_results is None]
+        if not misses:
+            return results
+        vectors = self.embed([queries[i] for i in misses])
+        searched = []
+        for i, vector in zip(misses, vectors):
+            results[i] = cache.get_similar(self.version, vector, ks[i])
+            if results[i] is None:
+                searched.append((i, vector))
+        metrics.count("query_cache.misses", len(searched))
+        if searched:
+            searched_results = self._search_batch(
+                [queries[i] for i, _ in searched],
+                [ks[i] for i, _ in searched],
+                vectors=np.stack([vector for _, vector in searched]),
+            )
+            for (i, vector), query_results in zip(searched, searched_results):
+                cache.put(self.version, queries[i], vector, ks[i], query_results)
+                results[i] = query_results
+        return results
+
+    def _search_batch(self, queries, ks, vectors=None):
+        reranker = self.reranker
+        fetch_ks = ks if reranker is None else [reranker.get_fetch_k(k) for k in ks]
+        with metrics.timer("search_batch"):
+            metrics.observe("search_batch.queries", len(queries))
+            if vectors is None:
+                vectors = self.embed(queries)
+            distances, ids = self.search_vectors(vectors, max(fetch_ks))
+
+        results = []
+        for query, vector, query_distances, query_ids, k, fetch_k in zip(
+            queries, vectors, distances, ids, ks, fetch_ks
+        ):
+            if reranker is not None:
+                results.append(
+                    reranker.rerank(
+                        self, query, vector, query_distances[:fetch_k], query_ids[:fetch_k], k
+                    )
+                )
+                continue
+            query_results = []
+            for distance, i in zip(query_distances[:k], query_ids[:k]):
+                if i == -1:  # Fewer than k chunks in the index
+                    continue
+                text, metadata = self.get_chunk(int(i))
+                query_results.append({"text": text, "metadata": metadata, "score": float(distance)})
+            results.append(query_results)
+        return results
@@ -0,0 +1,339 @@
+import os
+import time
+import asyncio
+import logging
+import argparse
+import threading
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv, find_dotenv
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field
+from app.serving.index import IndexManager
+from app.serving.search import DEFAULT_K, MAX_K
+from app.serving.rerank import load_cross_encoder, DEFAULT_LAMBDA, DEFAULT_FETCH_FACTOR
+from app.serving.batching import QueryBatcher, DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_WAIT_MS
+from app.serving.shared_index import SharedIndexFollower, read_memory_usage
+from app.serving.query_cache import (
+    QueryCache,
+    DEFAULT_MAX_ENTRIES,
+    DEFAULT_TTL,
+    DEFAULT_SIMILARITY_THRESHOLD,
+)
+from app.metrics import metrics, to_prometheus
+
+"""
+Resident retrieval service.
+
+Keeps the database in memory and serves the retrieval over HTTP (TCP or a Unix socket). In the
+background, the LATEST manifest of the bucket is polled and a new snapshot version is loaded next
+to the served one and swapped in once ready (see app.serving.index), so a nightly rebuild is picked
+up without a restart and without a cold start. The concurrent queries are searched in batches
+(see app.serving.batching). The results are re-ranked for diversity and the adjacent chunks of a
+file are merged into passages (see app.serving.rerank), --no-rerank serves the plain results. The
+results of the repeated queries are cached until the version changes (see app.serving.query_cache).
+
+With --workers N, the requests are served by N worker processes. The main process only loads the
+versions and exports them to memory-mapped files, which all of the workers share (see
+app.serving.shared_index):
+
+    python -m app.serving.service --port 8000
+    python -m app.serving.service --unix-socket /run/taxgpt/retrieval.sock
+    python -m app.serving.service --port 8000 --workers 8
+"""
+
+DEFAULT_POLL_INTERVAL = 300
+# The workers only check the version file written by the main process
+WORKER_POLL_INTERVAL = 5
+# The values kept per histogram of the service metrics, so that their memory and the cost of a
+# /metrics scrape do not grow with the traffic
+METRICS_MAX_SAMPLES = 2048
+
+
+class SearchRequest(BaseModel):
+    query: str
+    k: int = Field(DEFAULT_K, ge=1, le=MAX_K)
+
+
+async def poll_for_new_versions(manager, poll_interval):
+    """Reloads the database whenever the bucket has a new snapshot version."""
+    while True:
+        await asyncio.sleep(poll_interval)
+        try:
+            await asyncio.to_thread(manager.refresh)
+        except Exception as e:
+            # Keep serving the current version, retry at the next poll
+            metrics.count("index_reload_errors")
+            logging.error(f"Could not load the new database version: {e}")
+
+
+def poll_for_new_versions_in_thread(manager, poll_interval):
+    """Reloads the database whenever the bucket has a new snapshot version, in a thread."""
+
+    def poll():
+        while True:
+            time.sleep(poll_interval)
+            try:
+                manager.refresh()
+            except Exception as e:
+                metrics.count("index_reload_errors")
+                logging.error(f"Could not load the new database version: {e}")
+
+    thread = threading.Thread(target=poll, daemon=True)
+    thread.start()
+    return thread
+
+
+def create_app(
+    manager,
+    poll_interval=DEFAULT_POLL_INTERVAL,
+    max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+    max_wait_ms=DEFAULT_MAX_WAIT_MS,
+):
+    """
+    Creates the FastAPI app of the service.
+
+    Args:
+        manager (IndexManager or SharedIndexFollower): The manager of the served database
+            version.
+        poll_interval (float): Seconds between the checks for a new version. The polling is
+            disabled if 0 or if the manager cannot reload (no bucket).
+        max_batch_size (int): The maximum number of queries searched together. 1 disables the
+            batching.
+        max_wait_ms (float): How long a query waits for other queries to batch with.
+    """
+    metrics.set_max_samples(METRICS_MAX_SAMPLES)
+    batcher = QueryBatcher(manager, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+
+    @asynccontextmanager
+    async def lifespan(app):
+        await asyncio.to_thread(manager.refresh)
+        poll_task = None
+        if manager.can_reload and poll_interval > 0:
+            poll_task = asyncio.create_task(poll_for_new_versions(manager, poll_interval))
+        batcher.start()
+        yield
+        await batcher.stop()
+        if poll_task is not None:
+            poll_task.cancel()
+
+    app = FastAPI(title="taxGPT retrieval", lifespan=lifespan)
+
+    @app.get("/health")
+    async def health():
+        index = manager.current
+        if index is None:
+            raise HTTPException(status_code=503, detail="The database is not loaded yet")
+        return {"version": index.version, "loaded_at": index.loaded_at}
+
+    @app.post("/search")
+    async def search(request: SearchRequest):
+        if manager.current is None:
+            raise HTTPException(status_code=503, detail="The database is not loaded yet")
+        version, results = await batcher.search(request.query, request.k)
+        return {"version": version, "results": results}
+
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def get_metrics():
+        return to_prometheus(metrics.report())
+
+    @app.get("/memory")
+    async def memory():
+        # The memory of the process (worker) that served the request, in MiB
+        return {"pid": os.getpid(), **read_memory_usage()}
+
+    return app
+
+
+def get_rerank_options(rerank, lambda_mult, fetch_factor, merge_adjacent, cross_encoder_name):
+    """Returns the arguments of the Reranker of the service, None if the re-ranking is disabled."""
+    if not rerank:
+        return None
+    return {
+        "lambda_mult": lambda_mult,
+        "fetch_factor": fetch_factor,
+        "merge_adjacent": merge_adjacent,
+        # Loaded once, shared by all of the versions
+        "cross_encoder": load_cross_encoder(cross_encoder_name) if cross_encoder_name else None,
+    }
+
+
+def get_query_cache(max_entries, ttl, similarity_threshold):
+    """Returns the query cache of the service, None if the cache is disabled (no entries)."""
+    if max_entries <= 0:
+        return None
+    return QueryCache(max_entries=max_entries, ttl=ttl, similarity_threshold=similarity_threshold)
+
+
+def create_worker_app():
+    """Creates the app of a worker process, serving the versions exported by the main process."""
+    rerank_options = get_rerank_options(
+        os.getenv("SERVING_RERANK", "1") == "1",
+        float(os.getenv("SERVING_MMR_LAMBDA", DEFAULT_LAMBDA)),
+        int(os.getenv("SERVING_FETCH_FACTOR", DEFAULT_FETCH_FACTOR)),
+        os.getenv("SERVING_MERGE_ADJACENT", "1") == "1",
+        os.getenv("SERVING_CROSS_ENCODER"),
+    )
+    return create_app(
+        SharedIndexFollower(
+            os.environ["SERVING_DIR"],
+            os.getenv("EMBEDDING_MODEL"),
+            rerank_options=rerank_options,
+            # Every worker caches the queries it served
+            query_cache=get_query_cache(
+                int(os.getenv("SERVING_QUERY_CACHE_SIZE", DEFAULT_MAX_ENTRIES)),
+                float(os.getenv("SERVING_QUERY_CACHE_TTL", DEFAULT_TTL)),
+                float(os.getenv("SERVING_QUERY_CACHE_SIMILARITY", DEFAULT_SIMILARITY_THRESHOLD)),
+            ),
+        ),
+        poll_interval=WORKER_POLL_INTERVAL,
+        max_batch_size=int(os.getenv("SERVING_MAX_BATCH_SIZE", DEFAULT_MAX_BATCH_SIZE)),
+        max_wait_ms=float(os.getenv("SERVING_MAX_WAIT_MS", DEFAULT_MAX_WAIT_MS)),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the retrieval over the database")
+    parser.add_argument("--host", default="127.0.0.1", help="The host to bind to")
+    parser.add_argument("--port", type=int, default=8000, help="The port to bind to")
+    parser.add_argument("--unix-socket", metavar="PATH", help="Bind to a Unix socket instead")
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help="Seconds between the checks for a new database version, 0 disables the reloads",
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        type=int,
+        default=DEFAULT_MAX_BATCH_SIZE,
+        help="Maximum number of concurrent queries searched together, 1 disables the batching",
+    )
+    parser.add_argument(
+        "--max-wait-ms",
+        type=float,
+        default=DEFAULT_MAX_WAIT_MS,
+        help="How long a query waits for other queries to batch with",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of worker processes, sharing one memory-mapped copy of the database",
+    )
+    parser.add_argument(
+        "--no-rerank", action="store_true", help="Serve the nearest chunks, without re-ranking"
+    )
+    parser.add_argument(
+        "--mmr-lambda",
+        type=float,
+        default=DEFAULT_LAMBDA,
+        help="Trade-off of the MMR re-ranking, 1 for the relevance only, 0 for the diversity only",
+    )
+    parser.add_argument(
+        "--fetch-factor",
+        type=int,
+        default=DEFAULT_FETCH_FACTOR,
+        help="Number of the re-ranked candidates, as a multiple of k",
+    )
+    parser.add_argument(
+        "--no-merge-adjacent",
+        action="store_true",
+        help="Do not merge the adjacent chunks of a file into one passage",
+    )
+    parser.add_argument(
+        "--cross-encoder",
+        metavar="MODEL",
+        help="Score the passages with this sentence-transformers cross-encoder, on the CPU",
+    )
+    parser.add_argument(
+        "--query-cache-size",
+        type=int,
+        default=DEFAULT_MAX_ENTRIES,
+        help="Number of the cached queries (per worker), 0 disables the query cache",
+    )
+    parser.add_argument(
+        "--query-cache-ttl",
+        type=float,
+        default=DEFAULT_TTL,
+        help="Seconds after which a cached query expires",
+    )
+    parser.add_argument(
+        "--query-cache-similarity",
+        type=float,
+        default=DEFAULT_SIMILARITY_THRESHOLD,
+        help="Cosine similarity of the queries for a cache hit, above 1 for the exact hits only",
+    )
+    parser.add_argument(
+        "--local", action="store_true", help="For running on local machine. Debugging purposes."
+    )
+    args = parser.parse_args()
+
+    if args.local:
+        load_dotenv(".env.local", override=True, verbose=True)
+    else:
+        load_dotenv(find_dotenv())
+    VECTOR_DB_PATH = os.getenv("VECTOR_DB_PATH")
+    SERVING_DIR = os.getenv("SERVING_DIR") or os.path.join(
+        os.path.dirname(os.path.abspath(VECTOR_DB_PATH)), "serving"
+    )
+    os.makedirs(SERVING_DIR, exist_ok=True)
+    manager = IndexManager(
+        SERVING_DIR,
+        os.getenv("EMBEDDING_MODEL"),
+        bucket_name=os.getenv("STORAGE_BUCKET_NAME"),
+        vector_db_path=VECTOR_DB_PATH,
+        local=args.local,
+        shared=args.workers > 1,
+        rerank_options=get_rerank_options(
+            not args.no_rerank,
+            args.mmr_lambda,
+            args.fetch_factor,
+            not args.no_merge_adjacent,
+            # With workers, the main process does not serve and every worker loads its own model
+            args.cross_encoder if args.workers == 1 else None,
+        ),
+        query_cache=get_query_cache(
+            args.query_cache_size if args.workers == 1 else 0,
+            args.query_cache_ttl,
+            args.query_cache_similarity,
+        ),
+    )
+
+    import uvicorn
+
+    bind = {"uds": args.unix_socket} if args.unix_socket else {"host": args.host, "port": args.port}
+    if args.workers > 1:
+        # Export the database before the workers start, then keep exporting the new versions
+        manager.refresh()
+        if manager.can_reload and args.poll_interval > 0:
+            poll_for_new_versions_in_thread(manager, args.poll_interval)
+        # The worker processes are spawned and read their configuration from the environment
+        os.environ["SERVING_DIR"] = SERVING_DIR
+        os.environ["SERVING_MAX_BATCH_SIZE"] = str(args.max_batch_size)
+        os.environ["SERVING_MAX_WAIT_MS"] = str(args.max_wait_ms)
+        os.environ["SERVING_RERANK"] = "0" if args.no_rerank else "1"
+        os.environ["SERVING_MMR_LAMBDA"] = str(args.mmr_lambda)
+        os.environ["SERVING_FETCH_FACTOR"] = str(args.fetch_factor)
+        os.environ["SERVING_MERGE_ADJACENT"] = "0" if args.no_merge_adjacent else "1"
+        if args.cross_encoder:
+            os.environ["SERVING_CROSS_ENCODER"] = args.cross_encoder
+        os.environ["SERVING_QUERY_CACHE_SIZE"] = str(args.query_cache_size)
+        os.environ["SERVING_QUERY_CACHE_TTL"] = str(args.query_cache_ttl)
+        os.environ["SERVING_QUERY_CACHE_SIMILARITY"] = str(args.query_cache_similarity)
+        uvicorn.run(
+            "app.serving.service:create_worker_app", factory=True, workers=args.workers, **bind
+        )
+        return
+
+    app = create_app(
+        manager,
+        poll_interval=args.poll_interval,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+    )
+    uvicorn.run(app, **bind)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,243 @@
+import os
+import json
+import shutil
+import logging
+import datetime
+import numpy as np
+import pyarrow as pa
+from app.serving.search import SearchableIndex
+from app.serving.rerank import create_reranker
+from app.database.rerank_features import load_rerank_features, RERANK_FEATURES_NAME
+from app.metrics import metrics
+
+"""
+Read-only database files shared by the worker processes of the retrieval service.
+
+The FAISS index and the docstore of a version are exported once, by the loader process, to files
+that the workers memory-map: the embeddings and their squared norms as .npy files and the chunks
+as an Arrow IPC file. All of the workers map the same pages of the page cache, so the memory of
+the database is paid once, however many workers serve it (forked or spawned). The search is the
+exhaustive L2 search of the flat FAISS index, over the mapped embeddings. Only the stores with the
+Euclidean distance are exported. If the store normalizes the embeddings, so does the search.
+"""
+
+SHARED_DIR_NAME = "shared"
+CURRENT_NAME = "CURRENT"
+VECTORS_NAME = "vectors.npy"
+NORMS_NAME = "norms.npy"
+CHUNKS_NAME = "chunks.arrow"
+CONFIG_NAME = "index.json"
+EUCLIDEAN_DISTANCE = "EUCLIDEAN_DISTANCE"
+
+
+def write_shared_index(directory, vectors, texts, metadatas, features=None, normalize_L2=False):
+    """
+    Writes the shared files of a version. The directory is replaced only once all files are
+    written.
+
+    Args:
+        directory (str): The directory of the shared files.
+        vectors (numpy.ndarray): The embeddings, in the order of the index.
+        texts (list): The texts of the chunks.
+        metadatas (list): The metadata dicts of the chunks.
+        features (dict, optional): The re-ranking features of the chunks.
+        normalize_L2 (bool): Whether the embeddings of the queries are normalized, like the
+            embeddings of the chunks.
+    """
+    tmp_directory = directory + ".tmp"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    np.save(os.path.join(tmp_directory, VECTORS_NAME), vectors)
+    np.save(os.path.join(tmp_directory, NORMS_NAME), np.einsum("ij,ij->i", vectors, vectors))
+    table = pa.table(
+        {
+            "text": pa.array(texts, type=pa.string()),
+            "metadata": pa.array(
+                [json.dumps(metadata, ensure_ascii=False) for metadata in metadatas],
+                type=pa.string(),
+            ),
+        }
+    )
+    with pa.OSFile(os.path.join(tmp_directory, CHUNKS_NAME), "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    if features is not None:
+        np.savez(os.path.join(tmp_directory, RERANK_FEATURES_NAME), **features)
+    with open(os.path.join(tmp_directory, CONFIG_NAME), "w") as f:
+        json.dump({"normalize_L2": normalize_L2}, f)
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(tmp_directory, directory)
+
+
+def export_shared_index(db, directory, features=None):
+    """
+    Exports the FAISS index and the docstore of the langchain FAISS store, and the re-ranking
+    features of its chunks, to directory.
+
+    Raises:
+        ValueError: If the store does not search by the Euclidean distance.
+    """
+    strategy = getattr(db, "distance_strategy", EUCLIDEAN_DISTANCE)
+    if getattr(strategy, "value", strategy) != EUCLIDEAN_DISTANCE:
+        raise ValueError(f"Only the Euclidean distance stores can be shared, not {strategy}")
+    with metrics.timer("export_shared_index"):
+        n_chunks = db.index.ntotal
+        documents = [db.docstore.search(db.index_to_docstore_id[i]) for i in range(n_chunks)]
+        write_shared_index(
+            directory,
+            db.index.reconstruct_n(0, n_chunks),
+            [document.page_content for document in documents],
+            [document.metadata for document in documents],
+            features=features,
+            normalize_L2=getattr(db, "_normalize_L2", False),
+        )
+
+
+def write_current_version(serving_dir, version):
+    """Points the workers to the version, see read_current_version."""
+    path = os.path.join(serving_dir, CURRENT_NAME)
+    with open(path + ".part", "w") as f:
+        f.write(version)
+    os.replace(path + ".part", path)
+
+
+def read_current_version(serving_dir):
+    """Returns the version exported by the loader. None, if no version is exported yet."""
+    path = os.path.join(serving_dir, CURRENT_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return f.read().strip()
+
+
+def read_memory_usage():
+    """
+    Returns the memory of the current process in MiB: rss (resident), pss (resident, the shared
+    pages divided between the processes sharing them), uss (private to the process) and shared.
+    Read from /proc, so only on Linux. Empty dict elsewhere.
+    """
+    try:
+        with open("/proc/self/smaps_rollup", "r") as f:
+            lines = f.readlines()
+    except OSError:
+        return {}
+    values = {}
+    for line in lines[1:]:
+        name, value = line.split(":", 1)
+        values[name] = int(value.split()[0]) / 1024  # kB
+    return {
+        "rss": values["Rss"],
+        "pss": values["Pss"],
+        "uss": values["Private_Clean"] + values["Private_Dirty"],
+        "shared": values["Shared_Clean"] + values["Shared_Dirty"],
+    }
+
+
+class SharedIndexVersion(SearchableIndex):
+    """
+    A version of the database, memory-mapped from its shared files (see SearchableIndex).
+
+    Args:
+        version (str): The snapshot version.
+        directory (str): The directory of the shared files.
+        embeddings (Embeddings): The embeddings of the queries.
+    """
+
+    def __init__(self, version, directory, embeddings):
+        self.version = version
+        self.path = directory
+        self.embeddings = embeddings
+        self.vectors = np.asarray(np.load(os.path.join(directory, VECTORS_NAME), mmap_mode="r"))
+        self.norms = np.asarray(np.load(os.path.join(directory, NORMS_NAME), mmap_mode="r"))
+        chunks_file = pa.memory_map(os.path.join(directory, CHUNKS_NAME), "r")
+        self.chunks = pa.ipc.open_file(chunks_file).read_all()  # Zero-copy, backed by the map
+        with open(os.path.join(directory, CONFIG_NAME), "r") as f:
+            self.normalize_L2 = json.load(f)["normalize_L2"]
+        self.loaded_at = datetime.datetime.utcnow().isoformat()
+
+    def warm_up(self):
+        """Runs a search, so the mapped pages are in memory before the first query."""
+        self.search_vectors(np.zeros((1, self.vectors.shape[1]), dtype=np.float32), 1)
+
+    def search_vectors(self, vectors, k):
+        """
+        Exhaustive search of the query embeddings.
+
+        Returns:
+            tuple: The squared L2 distances and the positions of the k closest chunks of every
+                query, as numpy arrays of shape (n_queries, k), from the closest.
+        """
+        k = min(k, len(self.norms))
+        # |x - q|^2 = |x|^2 - 2 x.q + |q|^2, one matrix product for all of the queries
+        distances = self.norms[:, None] - 2 * (self.vectors @ vectors.T)
+        distances += np.einsum("ij,ij->i", vectors, vectors)[None, :]
+        ids = np.argpartition(distances, k - 1, axis=0)[:k].T
+        ids_distances = np.take_along_axis(distances.T, ids, axis=1)
+        order = np.argsort(ids_distances, axis=1)
+        return np.take_along_axis(ids_distances, order, axis=1), np.take_along_axis(ids, order, 1)
+
+    def embed(self, queries):
+        vectors = np.asarray(self.embeddings.embed_documents(queries), dtype=np.float32)
+        if self.normalize_L2:
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors
+
+    def get_vectors(self, ids):
+        return self.vectors[ids]
+
+    def get_chunk(self, i):
+        return (
+            self.chunks.column("text")[i].as_py(),
+            json.loads(self.chunks.column("metadata")[i].as_py()),
+        )
+
+
+class SharedIndexFollower:
+    """
+    Serves the version exported by the loader process, in a worker process. The workers switch
+    to a new version as soon as the loader points to it (refresh).
+
+    Args:
+        serving_dir (str): The serving directory of the loader.
+        embedding_model (str): The embedding model of the database.
+        rerank_options (dict, optional): The arguments of the Reranker of the served versions.
+        query_cache (QueryCache, optional): The cache of the results of the served versions.
+    """
+
+    can_reload = True
+
+    def __init__(self, serving_dir, embedding_model, rerank_options=None, query_cache=None):
+        self.serving_dir = serving_dir
+        self.embedding_model = embedding_model
+        self.rerank_options = rerank_options
+        self.query_cache = query_cache
+        self.current = None
+
+    def refresh(self):
+        """
+        Maps the version exported by the loader, if it is not the served one.
+
+        Returns:
+            bool: True if a new version is served.
+        """
+        from langchain_openai import OpenAIEmbeddings
+
+        version = read_current_version(self.serving_dir)
+        if version is None or (self.current is not None and self.current.version == version):
+            return False
+        directory = os.path.join(self.serving_dir, version, SHARED_DIR_NAME)
+        index = SharedIndexVersion(version, directory, OpenAIEmbeddings(model=self.embedding_model))
+        index.reranker = create_reranker(
+            load_rerank_features(directory), self.rerank_options, len(index.norms)
+        )
+        index.warm_up()
+        if self.query_cache is not None:
+            self.query_cache.set_version(version)
+            index.query_cache = self.query_cache
+        self.current = index
+        logging.info(
+            f"Worker {os.getpid()} serves database version {version}, "
+            f"memory (MiB): {read_memory_usage()}"
+        )
+        return True
@@ -0,0 +1,333 @@
+import io
+import os
+import time
+import shutil
+import struct
+import logging
+import tarfile
+import argparse
+import tempfile
+import zstandard
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from app.storage.storage_bucket import authenticate_gcs
+from app.metrics import metrics
+
+"""
+Single-file compressed archive of the database, for fast cold starts of the serving container.
+
+The archive is a tar stream of the database files (FAISS index, docstore pickle and the metadata
+CSVs), compressed as a sequence of independent zstd frames and followed by a seek table in the
+zstd seekable format (https://github.com/facebook/zstd/tree/dev/contrib/seekable_format). The
+frames can be fetched with ranged reads and decompressed in parallel, while the tar stream is
+extracted in order. The archive can still be decompressed with the plain `zstd -d` tool.
+"""
+
+FRAME_SIZE = 16 * 1024 * 1024  # Uncompressed size of a frame
+COMPRESSION_LEVEL = 3
+MAX_WORKERS = 8
+
+SKIPPABLE_FRAME_MAGIC = 0x184D2A5E
+SEEKABLE_MAGIC = 0x8F92EAB1
+SEEK_TABLE_FOOTER_SIZE = 9
+SEEK_TABLE_CHECKSUM_FLAG = 0x80
+
+
+class _FrameWriter(io.RawIOBase):
+    """Cuts the written data into frames, compresses them in parallel and writes them in order."""
+
+    def __init__(self, fileobj, frame_size, level, executor, max_pending):
+        self.fileobj = fileobj
+        self.frame_size = frame_size
+        self.level = level
+        self.executor = executor
+        self.max_pending = max_pending
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.frames = []  # (compressed_size, decompressed_size)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.buffer.extend(data)
+        while len(self.buffer) >= self.frame_size:
+            self._submit(bytes(self.buffer[: self.frame_size]))  # noqa: E203
+            del self.buffer[: self.frame_size]  # noqa: E203
+        return len(data)
+
+    def finish(self):
+        if self.buffer:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self._write_next()
+
+    def _submit(self, frame):
+        self.pending.append(
+            (self.executor.submit(_compress_frame, frame, self.level), len(frame))
+        )
+        while len(self.pending) > self.max_pending:
+            self._write_next()
+
+    def _write_next(self):
+        future, decompressed_size = self.pending.popleft()
+        compressed = future.result()
+        self.fileobj.write(compressed)
+        self.frames.append((len(compressed), decompressed_size))
+
+
+def _compress_frame(frame, level):
+    return zstandard.ZstdCompressor(level=level).compress(frame)
+
+
+def _seek_table(frames):
+    entries = b"".join(struct.pack("<II", *frame) for frame in frames)
+    footer = struct.pack("<IBI", len(frames), 0, SEEKABLE_MAGIC)
+    return struct.pack("<II", SKIPPABLE_FRAME_MAGIC, len(entries) + len(footer)) + entries + footer
+
+
+def pack_archive(
+    files, archive_path, frame_size=FRAME_SIZE, level=COMPRESSION_LEVEL, workers=MAX_WORKERS
+):
+    """
+    Writes the files into a single seekable zstd compressed tar archive.
+
+    Args:
+        files (dict): Mapping of the name within the archive to the local file path.
+        archive_path (str): The path of the archive to write.
+        frame_size (int): The uncompressed size of a frame.
+        level (int): The zstd compression level.
+        workers (int): The number of threads compressing the frames.
+
+    Returns:
+        list: The (compressed_size, decompressed_size) of every frame.
+    """
+    part_path = archive_path + ".part"
+    with open(part_path, "wb") as fout, ThreadPoolExecutor(max_workers=workers) as executor:
+        writer = _FrameWriter(fout, frame_size, level, executor, max_pending=2 * workers)
+        with tarfile.open(fileobj=writer, mode="w|") as tar:
+            for name, local_path in sorted(files.items()):
+                tar.add(local_path, arcname=name)
+        writer.finish()
+        fout.write(_seek_table(writer.frames))
+    os.replace(part_path, archive_path)
+
+    compressed = sum(frame[0] for frame in writer.frames)
+    decompressed = sum(frame[1] for frame in writer.frames)
+    logging.info(
+        f"Packed {len(files)} files into {archive_path}: {decompressed / 1024 / 1024:.1f} MB -> "
+        f"{compressed / 1024 / 1024:.1f} MB in {len(writer.frames)} frames"
+    )
+    return writer.frames
+
+
+def read_seek_table(read_range, total_size):
+    """
+    Reads the seek table at the end of the archive.
+
+    Args:
+        read_range (callable): Function (start, end) -> bytes, reading the bytes [start, end).
+        total_size (int): The size of the archive in bytes.
+
+    Returns:
+        list: The (offset, compressed_size, decompressed_size) of every frame.
+    """
+    footer = read_range(total_size - SEEK_TABLE_FOOTER_SIZE, total_size)
+    num_frames, descriptor, magic = struct.unpack("<IBI", footer)
+    if magic != SEEKABLE_MAGIC:
+        raise ValueError("The archive does not end with a zstd seek table")
+    entry_size = 12 if descriptor & SEEK_TABLE_CHECKSUM_FLAG else 8
+    table_start = total_size - SEEK_TABLE_FOOTER_SIZE - num_frames * entry_size
+    table = read_range(table_start, total_size - SEEK_TABLE_FOOTER_SIZE)
+
+    frames = []
+    offset = 0
+    for i in range(num_frames):
+        compressed, decompressed = struct.unpack_from("<II", table, i * entry_size)
+        frames.append((offset, compressed, decompressed))
+        offset += compressed
+    return frames
+
+
+def _fetch_and_decompress(read_range, offset, compressed_size, decompressed_size):
+    data = read_range(offset, offset + compressed_size)
+    return zstandard.ZstdDecompressor().decompress(data, max_output_size=decompressed_size)
+
+
+def iter_decompressed_frames(read_range, frames, workers=MAX_WORKERS):
+    """
+    Fetches and decompresses the frames in parallel and yields them in order. At most
+    2 * workers frames are held in memory.
+    """
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for frame in frames:
+            pending.append(executor.submit(_fetch_and_decompress, read_range, *frame))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class _FrameStreamReader(io.RawIOBase):
+    """File-like object reading the concatenated decompressed frames."""
+
+    def __init__(self, frames_iterator):
+        self.frames_iterator = frames_iterator
+        self.current = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self.current) == 0:
+            frame = next(self.frames_iterator, None)
+            if frame is None:
+                return 0
+            self.current = memoryview(frame)
+        size = min(len(buffer), len(self.current))
+        buffer[:size] = self.current[:size]
+        self.current = self.current[size:]
+        return size
+
+
+def unpack_archive(read_range, total_size, get_local_path, workers=MAX_WORKERS, names=None):
+    """
+    Extracts the archive while its frames are being fetched and decompressed. The extracted files
+    are only moved into place once the whole archive is extracted.
+
+    Args:
+        read_range (callable): Function (start, end) -> bytes, reading the bytes [start, end).
+        total_size (int): The size of the archive in bytes.
+        get_local_path (callable): Function that maps the name within the archive to the local
+            file path.
+        workers (int): The number of frames fetched and decompressed at the same time.
+        names (set, optional): Only extract the files with these names. All files if None.
+
+    Returns:
+        list: The names of the extracted files.
+    """
+    frames = read_seek_table(read_range, total_size)
+    reader = io.BufferedReader(
+        _FrameStreamReader(iter_decompressed_frames(read_range, frames, workers=workers)),
+        buffer_size=1024 * 1024,
+    )
+    extracted = []
+    with tarfile.open(fileobj=reader, mode="r|") as tar:
+        for member in tar:
+            if not member.isfile() or (names is not None and member.name not in names):
+                continue
+            local_path = get_local_path(member.name)
+            os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+            with tar.extractfile(member) as fin, open(local_path + ".download", "wb") as fout:
+                shutil.copyfileobj(fin, fout, 1024 * 1024)
+            extracted.append(member.name)
+    for name in extracted:
+        local_path = get_local_path(name)
+        os.replace(local_path + ".download", local_path)
+    return extracted
+
+
+@metrics.timed("gcs_unpack_archive")
+def unpack_archive_from_bucket(
+    bucket_name,
+    blob_name,
+    get_local_path,
+    local=False,
+    generation=None,
+    workers=MAX_WORKERS,
+    names=None,
+):
+    """Streams the archive from the bucket with parallel ranged reads and extracts it."""
+    bucket = authenticate_gcs(local=local).bucket(bucket_name)
+    blob = bucket.get_blob(blob_name, generation=generation)
+    if blob is None:
+        raise FileNotFoundError(f"Archive {blob_name} not found in bucket {bucket_name}")
+    blob_generation = blob.generation
+
+    def read_range(start, end):
+        metrics.count("gcs_unpack_archive.bytes", end - start)
+        return bucket.blob(blob_name, generation=blob_generation).download_as_bytes(
+            start=start, end=end - 1
+        )
+
+    return unpack_archive(read_range, blob.size, get_local_path, workers=workers, names=names)
+
+
+def unpack_local_archive(archive_path, get_local_path, workers=MAX_WORKERS):
+    """Extracts a local archive, decompressing the frames in parallel."""
+
+    def read_range(start, end):
+        with open(archive_path, "rb") as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    return unpack_archive(
+        read_range, os.path.getsize(archive_path), get_local_path, workers=workers
+    )
+
+
+def benchmark_time_to_ready(bucket_name, archive_blob_name, folder_prefix, local=False):
+    """
+    Compares the time to get the database on the local disk with the per-file download of the
+    folder and with the streamed archive.
+
+    Returns:
+        dict: The time in seconds of both methods.
+    """
+    from app.storage.storage_bucket import download_folder
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        start = time.perf_counter()
+        download_folder(bucket_name, folder_prefix, os.path.join(tmp_dir, "per_file"), local=local)
+        results["per_file_download_s"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        unpack_archive_from_bucket(
+            bucket_name,
+            archive_blob_name,
+            lambda name: os.path.join(tmp_dir, "archive", name),
+            local=local,
+        )
+        results["archive_download_s"] = time.perf_counter() - start
+    logging.info(f"Time to ready: {results}")
+    return results
+
+
+if __name__ == "__main__":
+    # Pack the local database and benchmark the time to ready against the per-file download
+    parser = argparse.ArgumentParser(description="Pack and benchmark the database archive")
+    parser.add_argument("--benchmark", action="store_true", help="Upload and benchmark")
+    parser.add_argument("--local", action="store_true", help="For running on local machine.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    _ = load_dotenv(".env.local" if args.local else ".env")
+
+    from app.pipeline.data_pipeline import get_snapshot_files
+    from app.storage.storage_bucket import upload_blob, upload_folder_to_bucket
+
+    METADATA_DIR = os.getenv("METADATA_DIR")
+    VECTOR_DB_PATH = os.getenv("VECTOR_DB_PATH")
+    STORAGE_BUCKET_NAME = os.getenv("STORAGE_BUCKET_NAME")
+
+    archive_path = os.path.join(tempfile.gettempdir(), "database.tar.zst")
+    start = time.perf_counter()
+    pack_archive(get_snapshot_files(METADATA_DIR, VECTOR_DB_PATH), archive_path)
+    logging.info(f"Packed the archive in {time.perf_counter() - start:.1f}s")
+
+    if args.benchmark:
+        upload_folder_to_bucket(
+            STORAGE_BUCKET_NAME, VECTOR_DB_PATH, "benchmark/vector_database", local=args.local
+        )
+        upload_blob(
+            STORAGE_BUCKET_NAME, archive_path, "benchmark/database.tar.zst", local=args.local
+        )
+        benchmark_time_to_ready(
+            STORAGE_BUCKET_NAME,
+            "benchmark/database.tar.zst",
+            "benchmark/vector_database",
+            local=args.local,
+        )
@@ -0,0 +1,131 @@
+import os
+import json
+import shutil
+import logging
+import hashlib
+import threading
+from app.storage.hashes import compute_file_hashes
+
+"""Content-addressed cache of the bucket objects on the local disk of the serving host."""
+
+DEFAULT_MAX_SIZE = 20 * 1024 * 1024 * 1024  # 20 GB
+# The eviction frees the cache down to this fraction of max_size, so that the following puts do not
+# evict (and scan the cache) again
+EVICTION_TARGET = 0.9
+
+
+class BlobCache:
+    """
+    Local disk cache of the downloaded blobs.
+
+    The files are addressed by their content (the MD5 hash and the size, as in the blob
+    metadata), so the same file is found in the cache even if it was re-published under a new
+    snapshot version or blob generation. The files are validated against their MD5 hash before
+    they are used, and the least recently used files are evicted once the cache grows over
+    max_size bytes. The size of the cache is kept as a running total, the cache directory is only
+    scanned on the first put and when files have to be evicted.
+
+    Args:
+        cache_dir (str): The directory of the cache.
+        max_size (int): The maximum size of the cache in bytes.
+        validate (bool): Whether to check the MD5 hash of the cached files before using them.
+    """
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE, validate=True):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.validate = validate
+        self._lock = threading.RLock()
+        self._total_size = None  # Scanned on the first put
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get(self, md5, size, dest_path, generation=None):
+        """
+        Copies the cached file with the given content to dest_path.
+
+        Returns:
+            bool: True if the file was found in the cache and is valid.
+        """
+        if md5 is None:
+            return False
+        cache_path = self._get_cache_path(md5, size)
+        if not os.path.exists(cache_path):
+            return False
+        if os.path.getsize(cache_path) != int(size) or (
+            self.validate and compute_file_hashes(cache_path)[0] != md5
+        ):
+            logging.warning(f"Removing corrupted file {cache_path} from the cache")
+            self._remove(cache_path)
+            return False
+
+        os.makedirs(os.path.dirname(dest_path) or ".", exist_ok=True)
+        # Copy instead of linking, the destination files can be modified in place
+        shutil.copyfile(cache_path, dest_path + ".cache")
+        os.replace(dest_path + ".cache", dest_path)
+        os.utime(cache_path)  # Mark as recently used
+        logging.info(f"Restored {dest_path} from the cache (generation {generation})")
+        return True
+
+    def put(self, md5, size, src_path, generation=None):
+        """Adds the file with the given content to the cache and evicts the old files if needed."""
+        if md5 is None:
+            return
+        cache_path = self._get_cache_path(md5, size)
+        if os.path.exists(cache_path):
+            os.utime(cache_path)
+            return
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{threading.get_ident()}.tmp"
+        shutil.copyfile(src_path, tmp_path)
+        with self._lock:
+            if self._total_size is None:
+                self._total_size = self._scan_size()
+            if not os.path.exists(cache_path):
+                self._total_size += int(size)
+            os.replace(tmp_path, cache_path)
+            with open(cache_path + ".json", "w") as f:
+                json.dump({"md5": md5, "size": int(size), "generation": generation}, f)
+            if self._total_size > self.max_size:
+                self.evict()
+
+    def _scan_size(self):
+        return sum(size for _, size, _ in self._list_cached_files())
+
+    def _list_cached_files(self):
+        cached_files = []
+        for root, _, files in os.walk(self.cache_dir):
+            for file in files:
+                if file.endswith(".json") or file.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, file)
+                stat = os.stat(path)
+                cached_files.append((stat.st_mtime, stat.st_size, path))
+        return cached_files
+
+    def evict(self):
+        """
+        Removes the least recently used files until the cache fits into EVICTION_TARGET of
+        max_size.
+        """
+        with self._lock:
+            cached_files = self._list_cached_files()
+            total_size = sum(size for _, size, _ in cached_files)
+            for _, size, path in sorted(cached_files):
+                if total_size <= self.max_size * EVICTION_TARGET:
+                    break
+                self._remove(path)
+                total_size -= size
+                logging.info(f"Evicted {path} from the cache")
+            self._total_size = total_size
+
+    def _get_cache_path(self, md5, size):
+        key = hashlib.sha256(f"{md5}:{int(size)}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def _remove(self, cache_path):
+        with self._lock:
+            if self._total_size is not None and os.path.exists(cache_path):
+                self._total_size -= os.path.getsize(cache_path)
+            for path in [cache_path, cache_path + ".json"]:
+                if os.path.exists(path):
+                    os.remove(path)
@@ -0,0 +1,21 @@
+import base64
+import hashlib
+import google_crc32c
+
+"""Hashes of the local files, in the same format as the blob metadata in GCS."""
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def compute_file_hashes(path):
+    """Returns the base64 encoded MD5 and CRC32C of the file, in the format used by GCS."""
+    md5 = hashlib.md5()
+    crc32c = google_crc32c.Checksum()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            md5.update(chunk)
+            crc32c.update(chunk)
+    return (
+        base64.b64encode(md5.digest()).decode("utf-8"),
+        base64.b64encode(crc32c.digest()).decode("utf-8"),
+    )
@@ -0,0 +1,343 @@
+import os
+import json
+import logging
+import datetime
+import tempfile
+from google.api_core.exceptions import NotFound
+from app.storage.storage_bucket import authenticate_gcs, get_transfer_manager
+from app.storage.archive import pack_archive, unpack_archive_from_bucket
+from app.storage.hashes import compute_file_hashes
+from app.storage.sync import is_local_file_current
+from app.metrics import metrics
+
+"""
+Versioned snapshots of the database in the bucket.
+
+Every build uploads its files to its own prefix (snapshots/<version>/) and then atomically
+replaces the small LATEST manifest, which lists every file of the snapshot with its hash, size
+and generation. The readers fetch LATEST once and download exactly the listed set of files, so
+they never get an index that does not match its metadata.
+"""
+
+SNAPSHOTS_PREFIX = "snapshots"
+LATEST_MANIFEST = "LATEST"
+KEEP_SNAPSHOTS = 3
+ARCHIVE_NAME = "database.tar.zst"
+# Download the archive instead of the single files, if more than this fraction of the data changed
+ARCHIVE_MIN_STALE_FRACTION = 0.5
+# Pack a new archive instead of copying the previous one, if more than this fraction of the data
+# changed since the previous archive was packed
+ARCHIVE_REBUILD_STALE_FRACTION = 0.2
+
+
+@metrics.timed("publish_snapshot")
+def publish_snapshot(bucket_name, files, local=False, keep=KEEP_SNAPSHOTS, archive=True):
+    """
+    Uploads the files as a new snapshot and makes it the latest one.
+
+    The files that did not change since the previous snapshot are copied within the bucket
+    instead of uploaded again. Besides the single files, the snapshot also contains a compressed
+    archive with all of the files, which is used for the cold starts. The archive of the previous
+    snapshot is copied as well, unless more than ARCHIVE_REBUILD_STALE_FRACTION of the data
+    changed since it was packed. The manifest lists the content of the archive (archive_files),
+    the readers download the files that changed since then as single files.
+
+    Args:
+        bucket_name (str): The name of the bucket.
+        files (dict): Mapping of the file name within the snapshot (e.g.
+            "vector_database/index.faiss") to the local file path.
+        local (bool): Whether running on the local machine.
+        keep (int): The number of snapshots to keep in the bucket.
+        archive (bool): Whether to add the compressed archive of the files to the snapshot.
+
+    Returns:
+        dict: The manifest of the published snapshot.
+
+    Raises:
+        google.api_core.exceptions.PreconditionFailed: If another build published a snapshot in
+            the meantime.
+    """
+    client = authenticate_gcs(local=local)
+    bucket = client.bucket(bucket_name)
+    version = datetime.datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    snapshot_prefix = f"{SNAPSHOTS_PREFIX}/{version}"
+
+    latest_blob = bucket.get_blob(LATEST_MANIFEST)
+    previous_manifest = json.loads(latest_blob.download_as_text()) if latest_blob else {}
+    previous_files = previous_manifest.get("files", {})
+
+    file_hashes = {name: compute_file_hashes(path) for name, path in sorted(files.items())}
+    manifest_files = {}
+    files_to_upload = []
+    archive_files = None
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if archive:
+            archive_files = {name: md5 for name, (md5, _) in file_hashes.items()}
+            if _is_archive_reusable(bucket, previous_manifest, files, archive_files):
+                # Copied below, with the unchanged files
+                archive_files = get_archive_files(previous_manifest)
+                file_hashes[ARCHIVE_NAME] = (previous_files[ARCHIVE_NAME]["md5"], None)
+                files = {**files, ARCHIVE_NAME: None}
+            else:
+                archive_path = os.path.join(tmp_dir, ARCHIVE_NAME)
+                pack_archive(files, archive_path)
+                file_hashes[ARCHIVE_NAME] = compute_file_hashes(archive_path)
+                files = {**files, ARCHIVE_NAME: archive_path}
+
+        for name, (md5, crc32c) in sorted(file_hashes.items()):
+            local_file_path = files[name]
+            blob_name = f"{snapshot_prefix}/{name}"
+            previous = previous_files.get(name)
+            source_blob = None
+            if previous is not None and previous["md5"] == md5:
+                source_blob = bucket.get_blob(previous["blob"], generation=previous["generation"])
+            if source_blob is not None:
+                # Unchanged file, copy it server side
+                new_blob = bucket.copy_blob(source_blob, bucket, blob_name)
+                manifest_files[name] = {
+                    "blob": blob_name,
+                    "md5": md5,
+                    "crc32c": source_blob.crc32c,
+                    "size": source_blob.size,
+                    "generation": new_blob.generation,
+                }
+                continue
+            manifest_files[name] = {
+                "blob": blob_name,
+                "md5": md5,
+                "crc32c": crc32c,
+                "size": os.path.getsize(local_file_path),
+            }
+            files_to_upload.append((local_file_path, blob_name))
+
+        logging.info(
+            f"Publishing snapshot {version}: uploading {len(files_to_upload)} of "
+            f"{len(manifest_files)} files"
+        )
+        get_transfer_manager(bucket_name, local=local).upload_files(files_to_upload)
+    for blob in client.list_blobs(bucket, prefix=snapshot_prefix + "/"):
+        name = blob.name[len(snapshot_prefix) + 1 :]  # noqa: E203
+        if name in manifest_files:
+            manifest_files[name]["generation"] = blob.generation
+
+    # Atomically flip LATEST. Fails if another build replaced it since we read it
+    manifest = {
+        "version": version,
+        "created": datetime.datetime.utcnow().isoformat(),
+        "files": manifest_files,
+    }
+    if archive_files is not None:
+        manifest["archive_files"] = archive_files
+    bucket.blob(LATEST_MANIFEST).upload_from_string(
+        json.dumps(manifest, indent=2),
+        content_type="application/json",
+        if_generation_match=latest_blob.generation if latest_blob else 0,
+    )
+    logging.info(f"Published snapshot {version} to {bucket_name}")
+
+    delete_old_snapshots(bucket_name, keep=keep, local=local)
+    return manifest
+
+
+def get_archive_files(manifest):
+    """
+    Returns the MD5 hashes of the files in the archive of the snapshot, by their name. The
+    snapshots published before the archive_files were listed were archived whole.
+    """
+    if ARCHIVE_NAME not in manifest.get("files", {}):
+        return {}
+    if "archive_files" in manifest:
+        return manifest["archive_files"]
+    return {
+        name: file_entry["md5"]
+        for name, file_entry in manifest["files"].items()
+        if name != ARCHIVE_NAME
+    }
+
+
+def _is_archive_reusable(bucket, previous_manifest, files, file_md5s):
+    """Checks if the archive of the previous snapshot is close enough to the files."""
+    archive_files = get_archive_files(previous_manifest)
+    if not archive_files:
+        return False
+    archive_entry = previous_manifest["files"][ARCHIVE_NAME]
+    if bucket.get_blob(archive_entry["blob"], generation=archive_entry["generation"]) is None:
+        return False
+    sizes = {name: os.path.getsize(path) for name, path in files.items()}
+    stale_size = sum(
+        size for name, size in sizes.items() if archive_files.get(name) != file_md5s[name]
+    )
+    stale_fraction = stale_size / max(sum(sizes.values()), 1)
+    logging.info(f"{stale_fraction:.1%} of the data changed since the archive was packed")
+    return stale_fraction <= ARCHIVE_REBUILD_STALE_FRACTION
+
+
+def read_latest_manifest(bucket_name, local=False):
+    """Returns the manifest of the latest snapshot. None, if no snapshot was published yet."""
+    blob = authenticate_gcs(local=local).bucket(bucket_name).get_blob(LATEST_MANIFEST)
+    if blob is None:
+        return None
+    return json.loads(blob.download_as_text())
+
+
+@metrics.timed("download_snapshot")
+def download_snapshot(bucket_name, get_local_path, local=False, manifest=None, max_attempts=3):
+    """
+    Downloads the files of the latest snapshot in parallel. The local files that are already up
+    to date are not downloaded again. The changed files (from the cache, the archive or the
+    single blobs) are staged next to the local files and only moved into place once all of them
+    are staged, so a failed download leaves the local database at its previous version.
+
+    Args:
+        bucket_name (str): The name of the bucket.
+        get_local_path (callable): Function that maps the file name within the snapshot to the
+            local file path.
+        local (bool): Whether running on the local machine.
+        manifest (dict, optional): The manifest to download. Defaults to the latest manifest.
+        max_attempts (int): How many times to retry, if the snapshot is deleted during the
+            download (e.g. by the cleanup of a newer build).
+
+    Returns:
+        dict: The manifest of the downloaded snapshot. None, if there is no snapshot.
+    """
+    manager = get_transfer_manager(bucket_name, local=local)
+    for attempt in range(max_attempts):
+        if manifest is None:
+            manifest = read_latest_manifest(bucket_name, local=local)
+            if manifest is None:
+                return None
+
+        stale_files = {
+            name: file_entry
+            for name, file_entry in manifest["files"].items()
+            if name != ARCHIVE_NAME and not is_local_file_current(get_local_path(name), file_entry)
+        }
+        try:
+            _stage_snapshot_files(
+                bucket_name, manager, manifest, stale_files, get_local_path, local=local
+            )
+        except (NotFound, FileNotFoundError):
+            _remove_staged_files(stale_files, get_local_path)
+            logging.info(f"Snapshot {manifest['version']} was removed, retrying ({attempt + 1})")
+            manifest = None
+            continue
+        except Exception:
+            _remove_staged_files(stale_files, get_local_path)
+            raise
+        # All of the files are staged, switch the local database to the version at once
+        for name in stale_files:
+            os.replace(_get_staging_path(get_local_path, name), get_local_path(name))
+        return manifest
+
+    raise RuntimeError(f"Could not download a consistent snapshot from {bucket_name}")
+
+
+def _get_staging_path(get_local_path, name):
+    return get_local_path(name) + ".download"
+
+
+def _remove_staged_files(stale_files, get_local_path):
+    for name in stale_files:
+        staging_path = _get_staging_path(get_local_path, name)
+        if os.path.exists(staging_path):
+            os.remove(staging_path)
+
+
+def _stage_snapshot_files(bucket_name, manager, manifest, stale_files, get_local_path, local=False):
+    """
+    Writes the stale files of the snapshot next to their local paths (see _get_staging_path),
+    from the cache, the archive or the single blobs. The local files are not modified, so a
+    failed download leaves the local database at its previous version.
+    """
+
+    def get_staging_path(name):
+        return _get_staging_path(get_local_path, name)
+
+    missing_files = dict(stale_files)
+    if manager.cache is not None:
+        missing_files = {
+            name: file_entry
+            for name, file_entry in missing_files.items()
+            if not manager.cache.get(
+                file_entry["md5"],
+                file_entry["size"],
+                get_staging_path(name),
+                generation=file_entry["generation"],
+            )
+        }
+
+    # The archive can be older than the snapshot, only its files that did not change since are
+    # extracted
+    archive_entry = manifest["files"].get(ARCHIVE_NAME)
+    archive_files = get_archive_files(manifest)
+    archived_files = {
+        name: file_entry
+        for name, file_entry in missing_files.items()
+        if archive_files.get(name) == file_entry["md5"]
+    }
+    archived_size = sum(file_entry["size"] for file_entry in archived_files.values())
+    total_size = sum(
+        file_entry["size"] for name, file_entry in manifest["files"].items() if name != ARCHIVE_NAME
+    )
+    if archive_entry is not None and archived_size > ARCHIVE_MIN_STALE_FRACTION * total_size:
+        logging.info(
+            f"Downloading snapshot {manifest['version']} as an archive, "
+            f"{len(missing_files) - len(archived_files)} files changed since it was packed"
+        )
+        # Only the missing files are extracted, to their staging paths
+        unpack_archive_from_bucket(
+            bucket_name,
+            archive_entry["blob"],
+            get_staging_path,
+            local=local,
+            generation=archive_entry["generation"],
+            names=set(archived_files),
+        )
+        if manager.cache is not None:
+            for name, file_entry in archived_files.items():
+                manager.cache.put(
+                    file_entry["md5"],
+                    file_entry["size"],
+                    get_staging_path(name),
+                    generation=file_entry["generation"],
+                )
+        missing_files = {
+            name: file_entry
+            for name, file_entry in missing_files.items()
+            if name not in archived_files
+        }
+
+    logging.info(
+        f"Downloading snapshot {manifest['version']}: "
+        f"{len(stale_files)} of {len(manifest['files'])} files changed, "
+        f"downloading {len(missing_files)} of them"
+    )
+    bucket = manager.bucket
+    blob_file_pairs = []
+    for name, file_entry in missing_files.items():
+        blob = bucket.get_blob(file_entry["blob"], generation=file_entry["generation"])
+        if blob is None:
+            raise NotFound(f"Blob {file_entry['blob']} not found")
+        blob_file_pairs.append((blob, get_staging_path(name)))
+    manager.download_blobs(blob_file_pairs)
+
+
+def list_snapshot_versions(bucket_name, local=False):
+    """Returns the versions of the snapshots in the bucket, from the oldest to the newest."""
+    client = authenticate_gcs(local=local)
+    blobs = client.list_blobs(bucket_name, prefix=SNAPSHOTS_PREFIX + "/", delimiter="/")
+    list(blobs)  # The prefixes are only populated once the iterator is consumed
+    return sorted(prefix.rstrip("/").split("/")[-1] for prefix in blobs.prefixes)
+
+
+def delete_old_snapshots(bucket_name, keep=KEEP_SNAPSHOTS, local=False):
+    """Deletes all but the `keep` newest snapshots. The latest snapshot is never deleted."""
+    client = authenticate_gcs(local=local)
+    latest = read_latest_manifest(bucket_name, local=local)
+    versions = list_snapshot_versions(bucket_name, local=local)
+    for version in versions[:-keep] if keep > 0 else versions:
+        if latest is not None and version == latest["version"]:
+            continue
+        for blob in client.list_blobs(bucket_name, prefix=f"{SNAPSHOTS_PREFIX}/{version}/"):
+            blob.delete()
+        logging.info(f"Deleted snapshot {version}")
@@ -1,11 +1,61 @@
 import os
+import threading
 from google.cloud import storage
+from google.auth.credentials import AnonymousCredentials
 import google.auth
+from app.storage.transfer_manager import GCSTransferManager
+from app.storage.cache import BlobCache
 
 """Utils for interacting with Google Cloud Storage (GCS)."""
 
+_storage_clients = {}
+_storage_clients_lock = threading.Lock()
+_blob_caches = {}
+_blob_caches_lock = threading.Lock()
+
 
 def authenticate_gcs(local=False):
+    """
+    Returns the storage client. The client is created once and cached, so that all the calls
+    share the same authenticated session and connection pool.
+    """
+    with _storage_clients_lock:
+        if local not in _storage_clients:
+            _storage_clients[local] = _create_storage_client(local=local)
+        return _storage_clients[local]
+
+
+def get_transfer_manager(bucket_name, local=False, **kwargs):
+    """Returns a GCSTransferManager for the bucket, using the cached storage client."""
+    kwargs.setdefault("cache", get_blob_cache())
+    return GCSTransferManager(authenticate_gcs(local=local), bucket_name, **kwargs)
+
+
+def get_blob_cache():
+    """
+    Returns the local disk cache of the bucket objects, configured with the BLOB_CACHE_DIR and
+    BLOB_CACHE_MAX_SIZE_GB environment variables. None, if BLOB_CACHE_DIR is not set. The cache
+    is created once per directory and shared by all of the transfer managers, so its size is
+    scanned once and the eviction is coordinated between them.
+    """
+    cache_dir = os.getenv("BLOB_CACHE_DIR")
+    if not cache_dir:
+        return None
+    max_size = float(os.getenv("BLOB_CACHE_MAX_SIZE_GB", "20")) * 1024 * 1024 * 1024
+    with _blob_caches_lock:
+        cache_dir = os.path.abspath(cache_dir)
+        if cache_dir not in _blob_caches:
+            _blob_caches[cache_dir] = BlobCache(cache_dir, max_size=int(max_size))
+        _blob_caches[cache_dir].max_size = int(max_size)
+        return _blob_caches[cache_dir]
+
+
+def _create_storage_client(local=False):
+    if os.getenv("STORAGE_EMULATOR_HOST"):
+        # Local fake GCS server (e.g. fake-gcs-server), used for testing
+        return storage.Client(
+            credentials=AnonymousCredentials(), project=os.getenv("GOOGLE_CLOUD_PROJECT", "test")
+        )
     if not local:
         client = storage.Client()  # when running on GCP it will automatically authenticate
     else:
@@ -25,64 +75,33 @@ def authenticate_gcs(local=False):
 
 def upload_folder_to_bucket(bucket_name, folder_path, destination_blob_folder, local=False):
     """Uploads a folder and its contents to the bucket, maintaining the folder structure."""
-    storage_client = authenticate_gcs(local=local)
-    bucket = storage_client.bucket(bucket_name)
-
-    for local_file in os.listdir(folder_path):
-        local_file_path = os.path.join(folder_path, local_file)
-
-        # Skip directories, only upload files
-        if os.path.isfile(local_file_path):
-            # Construct the full path for the file within the bucket
-            blob_name = os.path.join(destination_blob_folder, local_file)
-            blob = bucket.blob(blob_name)
-
-            # Upload the file
-            blob.upload_from_filename(local_file_path)
-            print(f"Uploaded {local_file} to {blob_name}.")
+    return get_transfer_manager(bucket_name, local=local).upload_folder(
+        folder_path, destination_blob_folder
+    )
 
 
 def upload_blob(bucket_name, source_file_name, destination_blob_name, local=False):
     """Uploads a file to the bucket."""
-    storage_client = authenticate_gcs(local=local)
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-
-    blob.upload_from_filename(source_file_name)
+    get_transfer_manager(bucket_name, local=local).upload_files(
+        [(source_file_name, destination_blob_name)]
+    )
     print(f"File {source_file_name} uploaded to {destination_blob_name}.")
 
 
 def download_blob(bucket_name, source_blob_name, destination_file_name, local=False):
     """Downloads a blob from the bucket to a local file."""
-    storage_client = authenticate_gcs(local=local)
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(source_blob_name)
-
-    if blob.exists():
-        blob.download_to_filename(destination_file_name)
+    stats = get_transfer_manager(bucket_name, local=local).download_blobs(
+        [(source_blob_name, destination_file_name)]
+    )
+    if stats.files > 0:
         print(f"Blob {source_blob_name} downloaded to {destination_file_name}.")
 
 
 def download_folder(bucket_name, folder_prefix, local_destination_dir, local=False):
     """Downloads all blobs in a folder from the bucket to a local directory."""
-    storage_client = authenticate_gcs(local=local)
-    bucket = storage_client.bucket(bucket_name)
-
-    # Ensure the folder_prefix ends with a '/' to properly match all objects within the folder
-    if not folder_prefix.endswith("/"):
-        folder_prefix += "/"
-
-    blobs = bucket.list_blobs(prefix=folder_prefix)
-    for blob in blobs:
-        # Construct the local filepath to save the downloaded file
-        local_file_path = os.path.join(local_destination_dir, blob.name[len(folder_prefix) :])  # noqa: E203
-
-        # Create any necessary directories for nested objects
-        os.makedirs(os.path.dirname(local_file_path), exist_ok=True)
-
-        # Download the blob to the local_file_path
-        blob.download_to_filename(local_file_path)
-        print(f"Downloaded {blob.name} to {local_file_path}.")
+    return get_transfer_manager(bucket_name, local=local).download_folder(
+        folder_prefix, local_destination_dir
+    )
 
 
 def check_blob_exists(bucket_name, blob_name, local=False):
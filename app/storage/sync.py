@@ -0,0 +1,96 @@
+import os
+import json
+import logging
+from google.api_core.exceptions import NotFound
+from app.storage.storage_bucket import authenticate_gcs, get_transfer_manager
+from app.storage.hashes import compute_file_hashes
+from app.metrics import metrics
+
+"""
+Checksum based sync of a local folder from a folder in the bucket, for the legacy layout (a folder
+with a manifest). The database is published as versioned snapshots, see
+app.storage.snapshots.
+"""
+
+MANIFEST_NAME = "manifest.json"
+
+
+def is_local_file_current(local_file_path, file_entry):
+    """Checks if the local file exists and has the same content as the manifest entry."""
+    if not os.path.exists(local_file_path):
+        return False
+    if os.path.getsize(local_file_path) != file_entry["size"]:
+        return False
+    return compute_file_hashes(local_file_path)[0] == file_entry["md5"]
+
+
+def download_blobs_atomically(manager, blob_file_pairs):
+    """
+    Downloads the blobs next to their local paths and moves them into place only once all of the
+    blobs are downloaded.
+    """
+    download_pairs = [(blob, local_path + ".download") for blob, local_path in blob_file_pairs]
+    stats = manager.download_blobs(download_pairs)
+    for _, local_path in blob_file_pairs:
+        os.replace(local_path + ".download", local_path)
+    return stats
+
+
+def read_manifest(bucket_name, folder_prefix, local=False):
+    """Returns the manifest of the folder in the bucket. None, if the folder has no manifest."""
+    bucket = authenticate_gcs(local=local).bucket(bucket_name)
+    blob = bucket.get_blob(f"{folder_prefix.rstrip('/')}/{MANIFEST_NAME}")
+    if blob is None:
+        return None
+    return json.loads(blob.download_as_text())
+
+
+@metrics.timed("sync_folder_from_bucket")
+def sync_folder_from_bucket(
+    bucket_name, folder_prefix, local_destination_dir, local=False, max_attempts=3
+):
+    """
+    Downloads only the files of the bucket folder that differ from the local files.
+
+    The exact blob generations listed in the manifest are downloaded, so a concurrent upload can
+    not mix the files of two versions. If the uploader replaced a blob in the meantime, the new
+    manifest is read and the sync is retried. The files are only moved into place once all the
+    changed files are downloaded.
+
+    Returns:
+        dict: The manifest of the synced version. None, if the folder has no manifest (in that
+            case the whole folder is downloaded).
+    """
+    bucket = authenticate_gcs(local=local).bucket(bucket_name)
+    manager = get_transfer_manager(bucket_name, local=local)
+    os.makedirs(local_destination_dir, exist_ok=True)
+
+    for attempt in range(max_attempts):
+        manifest = read_manifest(bucket_name, folder_prefix, local=local)
+        if manifest is None:
+            logging.info(f"No manifest found in {bucket_name}/{folder_prefix}, downloading all")
+            manager.download_folder(folder_prefix, local_destination_dir)
+            return None
+
+        blob_file_pairs = []
+        for local_file, file_entry in manifest["files"].items():
+            local_file_path = os.path.join(local_destination_dir, local_file)
+            if is_local_file_current(local_file_path, file_entry):
+                continue
+            blob = bucket.get_blob(file_entry["blob"], generation=file_entry["generation"])
+            if blob is None:
+                break  # The manifest is outdated, a new version is being published
+            blob_file_pairs.append((blob, local_file_path))
+        else:
+            logging.info(
+                f"Syncing {bucket_name}/{folder_prefix} to {local_destination_dir}: "
+                f"{len(blob_file_pairs)} of {len(manifest['files'])} files changed"
+            )
+            try:
+                download_blobs_atomically(manager, blob_file_pairs)
+            except NotFound:
+                continue  # A blob was replaced during the download
+            return manifest
+        logging.info(f"Manifest changed during the sync, retrying (attempt {attempt + 1})")
+
+    raise RuntimeError(f"Could not get a consistent version of {bucket_name}/{folder_prefix}")
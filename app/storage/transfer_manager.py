@@ -0,0 +1,188 @@
+import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+from google.cloud.storage import transfer_manager as gcs_transfer_manager
+from app.metrics import metrics
+
+"""Concurrent uploads and downloads between the local disk and a Google Cloud Storage bucket."""
+
+MAX_WORKERS = 8
+CHUNK_SIZE = 32 * 1024 * 1024  # Multiple of 256 KB, as required by GCS
+LARGE_FILE_THRESHOLD = 64 * 1024 * 1024  # e.g. index.faiss and index.pkl
+
+
+class TransferStats:
+    """Number of files and bytes moved by a transfer and the time it took."""
+
+    def __init__(self, direction):
+        self.direction = direction
+        self.files = 0
+        self.cached_files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    @property
+    def throughput(self):
+        """Throughput in MB/s."""
+        return self.bytes / 1024 / 1024 / self.seconds if self.seconds > 0 else 0.0
+
+    def __repr__(self):
+        return (
+            f"{self.direction}: {self.files} files ({self.cached_files} from the cache), "
+            f"{self.bytes / 1024 / 1024:.1f} MB in {self.seconds:.1f}s "
+            f"({self.throughput:.1f} MB/s)"
+        )
+
+
+class GCSTransferManager:
+    """
+    Moves files between the local disk and a GCS bucket with a pool of threads.
+
+    Files larger than `large_file_threshold` are transferred in chunks: downloads fetch the chunks
+    concurrently with ranged reads, uploads use a chunked (resumable) upload. If a cache is given,
+    it is consulted before every download and filled with the downloaded files.
+
+    Args:
+        client (google.cloud.storage.Client): The storage client. It is shared by all the threads.
+        bucket_name (str): The name of the bucket.
+        max_workers (int): The number of files transferred at the same time.
+        chunk_size (int): The chunk size in bytes for the large files.
+        large_file_threshold (int): The size in bytes from which a file is transferred in chunks.
+        cache (BlobCache, optional): The local disk cache of the downloaded blobs.
+    """
+
+    def __init__(
+        self,
+        client,
+        bucket_name,
+        max_workers=MAX_WORKERS,
+        chunk_size=CHUNK_SIZE,
+        large_file_threshold=LARGE_FILE_THRESHOLD,
+        cache=None,
+    ):
+        self.client = client
+        self.bucket = client.bucket(bucket_name)
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.large_file_threshold = large_file_threshold
+        self.cache = cache
+
+    def upload_files(self, file_blob_pairs):
+        """
+        Uploads the local files to the bucket.
+
+        Args:
+            file_blob_pairs (list): List of (local_file_path, blob_name) tuples.
+
+        Returns:
+            TransferStats: The statistics of the upload.
+        """
+        tasks = [
+            (local_path, blob_name, os.path.getsize(local_path))
+            for local_path, blob_name in file_blob_pairs
+        ]
+        return self._run("Upload", self._upload_one, tasks, sum(task[2] for task in tasks))
+
+    def download_blobs(self, blob_file_pairs):
+        """
+        Downloads the blobs from the bucket. The blobs that do not exist are skipped.
+
+        Args:
+            blob_file_pairs (list): List of (blob_name or Blob, local_file_path) tuples.
+
+        Returns:
+            TransferStats: The statistics of the download.
+        """
+        tasks = [
+            (blob, local_path, blob.size or 0)
+            for blob, local_path in _resolve_blobs(self.bucket, blob_file_pairs)
+        ]
+        return self._run("Download", self._download_one, tasks, sum(task[2] for task in tasks))
+
+    def upload_folder(self, folder_path, destination_blob_folder):
+        """Uploads the files of the folder (not recursive) to the destination folder."""
+        file_blob_pairs = []
+        for local_file in sorted(os.listdir(folder_path)):
+            local_file_path = os.path.join(folder_path, local_file)
+            # Skip directories, only upload files
+            if os.path.isfile(local_file_path):
+                blob_name = os.path.join(destination_blob_folder, local_file)
+                file_blob_pairs.append((local_file_path, blob_name))
+        return self.upload_files(file_blob_pairs)
+
+    def download_folder(self, folder_prefix, local_destination_dir):
+        """Downloads all the blobs within the folder prefix to the local directory."""
+        if not folder_prefix.endswith("/"):
+            folder_prefix += "/"
+        blob_file_pairs = [
+            (blob, os.path.join(local_destination_dir, blob.name[len(folder_prefix) :]))  # noqa: E203
+            for blob in self.client.list_blobs(self.bucket, prefix=folder_prefix)
+            if not blob.name.endswith("/")
+        ]
+        return self.download_blobs(blob_file_pairs)
+
+    def _run(self, direction, transfer_fn, tasks, total_bytes):
+        stats = TransferStats(direction)
+        start = time.perf_counter()
+        with tqdm(total=total_bytes, unit="B", unit_scale=True, desc=direction) as progress:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(transfer_fn, *task): task for task in tasks}
+                for future in as_completed(futures):
+                    from_cache = future.result()  # Re-raise the errors of the transfer
+                    size = futures[future][-1]
+                    stats.files += 1
+                    stats.cached_files += int(bool(from_cache))
+                    stats.bytes += size
+                    progress.update(size)
+        stats.seconds = time.perf_counter() - start
+        logging.info(f"{stats}")
+        return stats
+
+    @metrics.timed("gcs_upload")
+    def _upload_one(self, local_path, blob_name, size):
+        if size >= self.large_file_threshold:
+            blob = self.bucket.blob(blob_name, chunk_size=self.chunk_size)
+        else:
+            blob = self.bucket.blob(blob_name)
+        blob.upload_from_filename(local_path)
+        metrics.count("gcs_upload.bytes", size)
+
+    @metrics.timed("gcs_download")
+    def _download_one(self, blob, local_path, size):
+        os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+        if self.cache is not None and self.cache.get(
+            blob.md5_hash, size, local_path, generation=blob.generation
+        ):
+            metrics.count("gcs_download.cached_bytes", size)
+            return True
+
+        if size >= self.large_file_threshold:
+            gcs_transfer_manager.download_chunks_concurrently(
+                blob,
+                local_path,
+                chunk_size=self.chunk_size,
+                max_workers=self.max_workers,
+                worker_type=gcs_transfer_manager.THREAD,
+            )
+        else:
+            blob.download_to_filename(local_path)
+        metrics.count("gcs_download.bytes", size)
+
+        if self.cache is not None:
+            self.cache.put(blob.md5_hash, size, local_path, generation=blob.generation)
+        return False
+
+
+def _resolve_blobs(bucket, blob_file_pairs):
+    """
+    Resolves the blob names to Blob objects with their metadata (e.g. the size). The blobs that
+    do not exist in the bucket are skipped.
+    """
+    for blob, local_path in blob_file_pairs:
+        if isinstance(blob, str):
+            blob = bucket.get_blob(blob)
+            if blob is None:
+                continue
+        yield blob, local_path
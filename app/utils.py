@@ -3,14 +3,17 @@ from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from bs4 import BeautifulSoup
 import sys
+import time
 import backoff
 import signal
 import logging
+import threading
+from collections import defaultdict
+from urllib.parse import urlparse
 
 from selenium.common.exceptions import WebDriverException, TimeoutException
-from playwright.sync_api import sync_playwright
 from selenium.webdriver.common.by import By
-from selenium.webdriver.support import expected_conditions as EC
+from app.metrics import metrics
 
 FILE_EXTENSIONS = [
     "docx",
@@ -52,37 +55,89 @@ def get_chrome_driver(local=False):
     return driver
 
 
-def wait_for_app_root_or_default(driver, timeout=5, default_wait=10):
+class ReadinessTracker:
+    """
+    Records how long the websites took to become ready (per site and signal) and which of the
+    websites hit the timeout before the readiness signal fired.
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.timeouts = defaultdict(int)
+        self.timed_out_urls = []
+        self._lock = threading.Lock()
+
+    def record(self, url, latency, timed_out=False, signal=None):
+        # The latencies of the signals other than the default readiness signal are kept apart
+        site = urlparse(str(url)).netloc
+        if signal is not None:
+            site = f"{site} ({signal})"
+        with self._lock:
+            self.latencies[site].append(latency)
+            if timed_out:
+                self.timeouts[site] += 1
+                self.timed_out_urls.append(url)
+        if timed_out:
+            signal_name = signal or "ready"
+            logging.warning(f"Website {url} was not ready ({signal_name}) after {latency:.1f}s")
+
+    def summary(self):
+        with self._lock:
+            return {
+                site: {
+                    "count": len(latencies),
+                    "mean_s": sum(latencies) / len(latencies),
+                    "max_s": max(latencies),
+                    "timeouts": self.timeouts[site],
+                }
+                for site, latencies in self.latencies.items()
+            }
+
+
+readiness_tracker = ReadinessTracker()
+
+
+def wait_until_ready(driver, url, condition, timeout=10):
+    """
+    Waits until the condition on the driver is met and records the readiness latency.
+    Returns as soon as the condition is met.
+
+    Returns:
+        bool: True if the website became ready, False if the timeout was hit.
+    """
+    start = time.perf_counter()
     try:
-        # Wait for the <app-root> element to be present in the DOM
-        app_root = WebDriverWait(driver, timeout).until(
-            EC.presence_of_element_located((By.TAG_NAME, "app-root"))
-        )
-        # Once the element is present, check if it has content
-        WebDriverWait(driver, timeout).until(
-            lambda d: app_root.get_attribute("innerHTML").strip() != ""
-        )
+        WebDriverWait(driver, timeout, poll_frequency=0.1).until(condition)
+        timed_out = False
     except TimeoutException:
-        # If the <app-root> element is not found or has no content within the timeout,
-        # apply the default wait
-        print("Waiting for the default period as <app-root> is not populated.")
-        driver.implicitly_wait(default_wait)
+        timed_out = True
+    readiness_tracker.record(url, time.perf_counter() - start, timed_out=timed_out)
+    return not timed_out
+
+
+def _app_root_populated(driver):
+    # The Angular websites (e.g. PISRS) render their content inside the <app-root> element
+    app_roots = driver.find_elements(By.TAG_NAME, "app-root")
+    return len(app_roots) > 0 and app_roots[0].get_attribute("innerHTML").strip() != ""
+
+
+def _document_complete(driver):
+    return driver.execute_script("return document.readyState") == "complete"
 
 
 @backoff.on_exception(
     backoff.expo, (ConnectionError, WebDriverException, TimeoutException), max_tries=5, max_time=20
 )
+@metrics.timed("get_website_html")
 def get_website_html(file_url, driver=None, close_driver=True, wait_app_root=False):
     if driver is None:
         driver = get_chrome_driver(local=False)
     try:
         driver.get(file_url)
         if wait_app_root:
-            wait_for_app_root_or_default(driver)
+            wait_until_ready(driver, file_url, _app_root_populated)
         else:
-            WebDriverWait(driver, 10).until(
-                lambda d: d.execute_script("return document.readyState") == "complete"
-            )
+            wait_until_ready(driver, file_url, _document_complete)
 
         html = driver.page_source
         soup = BeautifulSoup(html, "html.parser")
@@ -143,30 +198,66 @@ def get_filetype(path):
         return "unknown"
 
 
-def get_request_url_from_button_click(website_url, button_html_signature):
+def get_request_url_from_button_click(
+    website_url, button_html_signature, timeout=10000, wait_for_network_idle=False
+):
+    """
+    Clicks the button on the website and returns the URL of the file download request
+    (e.g. https://pisrs.si/api/datoteke/integracije/36058941). The requests are observed from
+    the start of the page load, so a request fired while the page loads counts too, and the
+    function returns as soon as the request is observed. None, if no such request is made within
+    the timeout (in milliseconds).
+
+    With wait_for_network_idle, the page is first waited on until the network is idle (no
+    requests for 500 ms), and the latency of that signal is recorded as well.
+    """
+    # Playwright is only needed for the PISRS downloads, keep it out of the import of app.utils
+    from playwright.sync_api import sync_playwright
+    from playwright.sync_api import TimeoutError as PlaywrightTimeoutError
+
+    def is_file_request(request):
+        return "api/datoteke/" in request.url
+
     with sync_playwright() as playwright:
         browser = playwright.chromium.launch(headless=True)
         page = browser.new_page()
 
         request_urls = []
+        page.on(
+            "request",
+            lambda request: request_urls.append(request.url) if is_file_request(request) else None,
+        )
 
-        # Start capturing network requests
-        def handle_request(request):
-            print("Request made:", request.url)
-            request_urls.append(request.url)
-
-        page.on("request", handle_request)
-
-        page.goto(website_url)
-        page.wait_for_selector(button_html_signature, state="attached")
-        page.click(button_html_signature)  # Selector for the PDF download button
-        page.wait_for_timeout(10000)  # Wait for 5 seconds to capture the request
+        start = time.perf_counter()
+        try:
+            page.goto(website_url, wait_until="domcontentloaded", timeout=timeout)
+            if wait_for_network_idle:
+                idle_start = time.perf_counter()
+                try:
+                    page.wait_for_load_state("networkidle", timeout=timeout)
+                    idle_timed_out = False
+                except PlaywrightTimeoutError:
+                    idle_timed_out = True
+                readiness_tracker.record(
+                    website_url,
+                    time.perf_counter() - idle_start,
+                    timed_out=idle_timed_out,
+                    signal="network idle",
+                )
+            if not request_urls:
+                page.wait_for_selector(button_html_signature, state="attached", timeout=timeout)
+                page.click(button_html_signature)  # Selector for the PDF download button
+            if not request_urls:
+                page.wait_for_event("request", is_file_request, timeout=timeout)
+        except PlaywrightTimeoutError:
+            pass
+        request_url = request_urls[0] if request_urls else None
+        readiness_tracker.record(
+            website_url, time.perf_counter() - start, timed_out=request_url is None
+        )
         browser.close()
 
-    for url in request_urls:
-        # The format of request seems to be: https://pisrs.si/api/datoteke/integracije/36058941
-        if "api/datoteke/" in url:
-            return url
+    return request_url
 
 
 def handler(signum, frame):
@@ -0,0 +1,246 @@
+import os
+import json
+import random
+import zipfile
+import datetime
+import pandas as pd
+
+"""
+Deterministic fixture corpus for the offline benchmarks.
+
+The corpus imitates the sources of the database: FURS pages in the typical format (div#content
+with the Opis / Zakonodaja / Navodila in Pojasnila sections), PISRS law texts (JSON metadata and
+HTML with chapters and articles), EUR-Lex pages, and PDF, docx and xlsx attachments. Some of the
+laws are published twice with small changes, as on the real sources, to exercise the dedup stage.
+"""
+
+AREAS = ["Dohodnina", "Davek na dodano vrednost", "Davek od dohodkov pravnih oseb", "Trošarine"]
+WORDS = (
+    "davčni zavezanec dohodek obdavčitev osnova olajšava stopnja napoved odmera rok plačilo "
+    "dobava blaga storitev oseba rezident nerezident poslovna enota najemnina obresti dividende "
+    "kapitalski dobiček izplačevalec akontacija obračun vračilo člen odstavek zakon pravilnik "
+    "uredba sprememba dopolnitev zavod inšpektor nadzor evidenca račun knjigovodstvo leto mesec"
+).split()
+
+
+def _sentence(rng, n_words):
+    words = [rng.choice(WORDS) for _ in range(n_words)]
+    return " ".join(words).capitalize() + "."
+
+
+def _paragraph(rng):
+    return " ".join(_sentence(rng, rng.randint(8, 25)) for _ in range(rng.randint(2, 6)))
+
+
+def law_html(rng, title, n_chapters=4, articles_per_chapter=6):
+    """HTML of a law in the PISRS format: chapters, articles (členi) and paragraphs."""
+    parts = [f"<html><body><h1>{title}</h1>"]
+    article = 1
+    roman = ["I", "II", "III", "IV", "V", "VI", "VII", "VIII"]
+    for chapter in range(n_chapters):
+        parts.append(f"<p>{roman[chapter % 8]}. {_sentence(rng, 3).upper()[:-1]}</p>")
+        for _ in range(articles_per_chapter):
+            parts.append(f"<p><b>{article}. člen</b></p>")
+            parts.append(f"<p>({_sentence(rng, 3)[:-1].lower()})</p>")
+            for paragraph in range(rng.randint(1, 4)):
+                parts.append(f"<p>({paragraph + 1}) {_paragraph(rng)}</p>")
+            if rng.random() < 0.1:
+                rows = "".join(
+                    f"<tr><td>{rng.randint(0, 99999)}</td><td>{rng.randint(1, 50)} %</td></tr>"
+                    for _ in range(5)
+                )
+                parts.append(f"<table><tr><th>Osnova</th><th>Stopnja</th></tr>{rows}</table>")
+            article += 1
+    parts.append("</body></html>")
+    return "\n".join(parts)
+
+
+def furs_page_html(rng, area, links):
+    """HTML of a FURS page in the typical format, linking to the given (text, href) links."""
+    sections = []
+    for section_title, section_links in [
+        ("Opis", links[: len(links) // 3]),
+        ("Zakonodaja", links[len(links) // 3 : 2 * len(links) // 3]),  # noqa: E203
+        ("Navodila in Pojasnila", links[2 * len(links) // 3 :]),  # noqa: E203
+    ]:
+        items = "".join(f'<li><a href="{href}">{text}</a></li>' for text, href in section_links)
+        sections.append(
+            f'<div><h3><a href="#">{section_title}</a></h3><p>{_paragraph(rng)}</p>'
+            f"<ul>{items}</ul><p>Foto: Bigstock</p></div>"
+        )
+    return (
+        f"<html><body><div id='content'><h1>{area}</h1>{''.join(sections)}</div></body></html>"
+    )
+
+
+def minimal_pdf(text_lines):
+    """A valid single page PDF with the given lines of (ASCII) text."""
+    content = "BT /F1 10 Tf 50 780 Td 12 TL " + " ".join(
+        f"({line.encode('ascii', 'replace').decode()}) '" for line in text_lines[:60]
+    )
+    content += " ET"
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R "
+        "/Resources << /Font << /F1 5 0 R >> >> >>",
+        f"<< /Length {len(content)} >>\nstream\n{content}\nendstream",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    pdf = "%PDF-1.4\n"
+    offsets = []
+    for i, obj in enumerate(objects):
+        offsets.append(len(pdf))
+        pdf += f"{i + 1} 0 obj\n{obj}\nendobj\n"
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n"
+    pdf += "".join(f"{offset:010d} 00000 n \n" for offset in offsets)
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    return pdf.encode("latin-1")
+
+
+def minimal_docx(paragraphs):
+    """The bytes of a minimal docx document with the given paragraphs."""
+    from io import BytesIO
+    from xml.sax.saxutils import escape
+
+    body = "".join(f"<w:p><w:r><w:t>{escape(p)}</w:t></w:r></w:p>" for p in paragraphs)
+    files = {
+        "[Content_Types].xml": (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" '
+            'ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/word/document.xml" ContentType="application/'
+            'vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/></Types>'
+        ),
+        "_rels/.rels": (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+            'relationships/officeDocument" Target="word/document.xml"/></Relationships>'
+        ),
+        "word/document.xml": (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            f"<w:body>{body}</w:body></w:document>"
+        ),
+    }
+    buffer = BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in files.items():
+            zf.writestr(name, data)
+    return buffer.getvalue()
+
+
+def build_corpus(root, scale=1, seed=0):
+    """
+    Writes the fixture corpus into root.
+
+    Args:
+        root (str): The directory served by the local HTTP server.
+        scale (int): Multiplies the number of laws and attachments.
+        seed (int): The seed of the generated text.
+
+    Returns:
+        list: One dict per document, with its area, title, relative path (url_path) and file type.
+    """
+    rng = random.Random(seed)
+    documents = []
+
+    def write(relative_path, data, area, title, file_type):
+        path = os.path.join(root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb" if isinstance(data, bytes) else "w") as f:
+            f.write(data)
+        documents.append(
+            {"area": area, "title": title, "url_path": relative_path, "file_type": file_type}
+        )
+
+    for i in range(10 * scale):
+        area = AREAS[i % len(AREAS)]
+        title = f"Zakon o {rng.choice(WORDS)} {i} (Z{i})"
+        html = law_html(rng, title)
+        write(f"pisrs/{i}.html", html, area, title, "html")
+        write(
+            f"pisrs/{i}.json",
+            json.dumps({"id": i, "naslov": title, "datoteke": [f"/pisrs/{i}.html"]}),
+            area,
+            title,
+            "json",
+        )
+        if i % 3 == 0:
+            # The consolidated version of the law, with small changes
+            changed = html.replace(" zakon ", " zakonik ", 3)
+            write(f"pisrs/{i}_npb.html", changed, area, title + " - NPB", "html")
+    for i in range(4 * scale):
+        area = AREAS[i % len(AREAS)]
+        title = f"Uredba (EU) 2024/{i}"
+        write(f"eurlex/{i}.html", law_html(rng, title, n_chapters=2), area, title, "html")
+    for i in range(3 * scale):
+        area = AREAS[i % len(AREAS)]
+        paragraphs = [_paragraph(rng) for _ in range(20)]
+        write(f"files/navodilo_{i}.pdf", minimal_pdf(paragraphs), area, f"Navodilo {i}", "pdf")
+        write(f"files/pojasnilo_{i}.docx", minimal_docx(paragraphs), area, f"Pojasnilo {i}", "docx")
+        try:
+            table = pd.DataFrame(
+                {"Osnova": [rng.randint(0, 99999) for _ in range(50)], "Stopnja": [22] * 50}
+            )
+            path = os.path.join(root, f"files/lestvica_{i}.xlsx")
+            table.to_excel(path, index=False)
+            documents.append(
+                {
+                    "area": area,
+                    "title": f"Lestvica {i}",
+                    "url_path": f"files/lestvica_{i}.xlsx",
+                    "file_type": "xlsx",
+                }
+            )
+        except ImportError:
+            pass  # openpyxl is not installed
+
+    # The FURS pages of the areas, linking to all of the documents of the area
+    for area_idx, area in enumerate(AREAS):
+        links = [
+            (document["title"], "/" + document["url_path"])
+            for document in documents
+            if document["area"] == area and document["file_type"] != "json"
+        ]
+        write(
+            f"furs/podrocja/{area_idx}/index.html",
+            furs_page_html(rng, area, links),
+            area,
+            area,
+            "furs",
+        )
+    return documents
+
+
+def get_downloaded_data_index(documents, raw_data_dir):
+    """
+    The downloaded_data_index.csv rows of the documents, as written by the scraper, for running
+    the stages after the scraping on the fixture corpus.
+    """
+    rows = []
+    today = datetime.date.today().isoformat()
+    for i, document in enumerate(documents):
+        if document["file_type"] in ["json", "furs"]:
+            continue
+        downloaded_path = os.path.join(raw_data_dir, document["url_path"].replace("/", "_"))
+        rows.append(
+            {
+                "file_id": f"fixture-{i}",
+                "date_downloaded": today,
+                "area": document["area"],
+                "subarea": document["title"],
+                "section": "Zakonodaja",
+                "filename": os.path.basename(document["url_path"]),
+                "raw_filepath": downloaded_path,
+                "file_type": document["file_type"],
+                "downloaded_path": downloaded_path,
+                "processed_filepath": None,
+                "url_path": document["url_path"],
+            }
+        )
+    return pd.DataFrame(rows)
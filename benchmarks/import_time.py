@@ -0,0 +1,84 @@
+import sys
+import json
+import argparse
+import subprocess
+
+"""
+Import time of the pipeline CLI, guarding the lazy imports of the heavy dependencies.
+
+Imports the module in a fresh interpreter with -X importtime and fails if the import takes longer
+than the budget or loads any of the dependencies that only the update stages need:
+
+    python -m benchmarks.import_time
+"""
+
+MODULE = "app.pipeline.data_pipeline"
+BUDGET_SECONDS = 1.0
+FORBIDDEN_MODULES = [
+    "selenium",
+    "playwright",
+    "bs4",
+    "marker",
+    "torch",
+    "langchain_core",
+    "langchain_community",
+    "langchain_openai",
+    "faiss",
+    "openai",
+    "tiktoken",
+    "pandas",
+    "pyarrow",
+]
+TOP_MODULES = 10
+
+
+def measure_import(module=MODULE):
+    """
+    Imports the module in a fresh interpreter.
+
+    Returns:
+        dict: The cumulative import time in seconds, the slowest top-level imports and the
+            forbidden modules that were imported.
+    """
+    code = (
+        f"import sys, json, {module}; "
+        f"print(json.dumps([m for m in {FORBIDDEN_MODULES!r} if m in sys.modules]))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, check=True
+    )
+    # Lines of "import time: <self us> | <cumulative us> | <module name indented by depth>"
+    total, children = 0, []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")  # noqa: E203
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            total += int(cumulative) / 1e6  # The top-level imports include their children
+        elif depth == 1:
+            children.append((name.strip(), int(cumulative) / 1e6))
+    children.sort(key=lambda child: child[1], reverse=True)
+    return {
+        "module": module,
+        "seconds": total,
+        "slowest": dict(children[:TOP_MODULES]),
+        "forbidden_imported": json.loads(result.stdout.strip().splitlines()[-1]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time of the pipeline CLI")
+    parser.add_argument("--budget", type=float, default=BUDGET_SECONDS, help="Seconds")
+    args = parser.parse_args()
+
+    result = measure_import()
+    print(json.dumps(result, indent=2))
+    if result["forbidden_imported"]:
+        sys.exit(f"{MODULE} imports {', '.join(result['forbidden_imported'])}, import them lazily")
+    if result["seconds"] > args.budget:
+        sys.exit(f"Importing {MODULE} took {result['seconds']:.2f}s, the budget is {args.budget}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import datetime
+import subprocess
+from types import SimpleNamespace
+from benchmarks.fixtures import build_corpus, get_downloaded_data_index
+from benchmarks.servers import serve_directory, fake_embeddings_server
+from app.metrics import metrics, percentile
+
+"""
+Offline benchmarks of the ingestion pipeline.
+
+The fixture corpus is served from a local HTTP server, the embeddings come from a deterministic
+fake of the OpenAI API and the bucket is the GCS emulator (STORAGE_EMULATOR_HOST, see the README;
+the storage benchmarks are skipped without it). The results, with the per-stage metrics of the
+run, are written to benchmarks/results/<commit>.json and can be compared between commits:
+
+    python -m benchmarks.run
+    python -m benchmarks.run --compare <commit> <other commit>
+"""
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+BENCHMARKS = [
+    "import_time",
+    "download",
+    "crawl",
+    "update_database",
+    "load_database",
+    "retrieval",
+    "batching",
+]
+N_QUERIES = 200
+
+
+def get_commit():
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def bench_import_time(ctx):
+    from benchmarks.import_time import measure_import
+
+    return measure_import()
+
+
+def bench_download(ctx):
+    from app.scraper.scraper import _download_file
+
+    start = time.perf_counter()
+    total_bytes = 0
+    for row in ctx.downloaded_data.itertuples():
+        os.makedirs(os.path.dirname(row.downloaded_path), exist_ok=True)
+        _download_file(f"{ctx.base_url}/{row.url_path}", row.downloaded_path)
+        total_bytes += os.path.getsize(row.downloaded_path)
+    seconds = time.perf_counter() - start
+    return {
+        "files": len(ctx.downloaded_data),
+        "bytes": total_bytes,
+        "seconds": seconds,
+        "mb_per_s": total_bytes / 1024 / 1024 / seconds,
+    }
+
+
+def bench_crawl(ctx):
+    from app.scraper.async_crawler import AsyncFURSCrawler
+    from app.scraper.references_list import FURSReferencesList
+
+    furs_root_url = ctx.base_url + "/furs"
+    pages = [
+        f"{furs_root_url}/podrocja/{document['url_path'].split('/')[2]}/index.html"
+        for document in ctx.documents
+        if document["file_type"] == "furs"
+    ]
+    # The parsing methods only use the root URL, no need for the Chrome driver of the class
+    references_list = SimpleNamespace(furs_root_url=furs_root_url)
+    crawler = AsyncFURSCrawler(
+        furs_root_url,
+        lambda soup: FURSReferencesList.is_typical_website(references_list, soup),
+        lambda url, soup: FURSReferencesList.parse_further_references_from_furs_website(
+            references_list, url, soup
+        ),
+    )
+    start = time.perf_counter()
+    references = crawler.run(pages)
+    seconds = time.perf_counter() - start
+    return {
+        "pages": len(pages),
+        "references": sum(len(df) for df in references if df is not None),
+        "seconds": seconds,
+        "pages_per_s": len(pages) / seconds,
+    }
+
+
+def bench_update_database(ctx):
+    from app.pipeline.data_pipeline import update_database
+
+    # The stages after the scraping, on the downloaded fixture files
+    ctx.downloaded_data.drop(columns=["url_path"]).to_csv(
+        os.path.join(ctx.metadata_dir, "downloaded_data_index.csv"), index=False
+    )
+    ctx.downloaded_data[["area", "subarea", "file_id"]].to_csv(
+        os.path.join(ctx.metadata_dir, "references.csv"), index=False
+    )
+    start = time.perf_counter()
+    state = update_database(
+        force_update=True, only=["convert", "chunk", "deduplicate", "embed", "publish"]
+    )
+    return {
+        "seconds": time.perf_counter() - start,
+        "stages": {name: stage["seconds"] for name, stage in state["completed"].items()},
+    }
+
+
+def bench_load_database(ctx):
+    from app.pipeline.data_pipeline import download_database
+
+    if not os.getenv("STORAGE_BUCKET_NAME"):
+        raise RuntimeError("Set STORAGE_EMULATOR_HOST to run the storage benchmarks")
+    # The snapshot published by the update_database benchmark. Not load_database, which falls
+    # back to a full update (with the real websites) if the snapshot is missing.
+    shutil.rmtree(os.getenv("VECTOR_DB_PATH"), ignore_errors=True)
+    start = time.perf_counter()
+    if not download_database(
+        os.getenv("STORAGE_BUCKET_NAME"), os.getenv("METADATA_DIR"), os.getenv("VECTOR_DB_PATH")
+    ):
+        raise RuntimeError("No snapshot in the bucket, run the update_database benchmark first")
+    return {"seconds": time.perf_counter() - start}
+
+
+def bench_retrieval(ctx):
+    from langchain_openai import OpenAIEmbeddings
+    from langchain_community.vectorstores import FAISS
+    from benchmarks.fixtures import WORDS
+
+    db = FAISS.load_local(
+        os.getenv("VECTOR_DB_PATH"), OpenAIEmbeddings(model=os.getenv("EMBEDDING_MODEL"))
+    )
+    latencies = []
+    for i in range(N_QUERIES):
+        query = " ".join(WORDS[(i * 7 + j) % len(WORDS)] for j in range(8))
+        start = time.perf_counter()
+        db.similarity_search(query, k=5)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return {
+        "queries": N_QUERIES,
+        "p50_s": percentile(latencies, 0.5),
+        "p95_s": percentile(latencies, 0.95),
+        "queries_per_s": N_QUERIES / sum(latencies),
+    }
+
+
+def bench_batching(ctx):
+    from benchmarks.serving_load import run_load_test
+
+    return run_load_test()
+
+
+def run_benchmarks(selected, scale, work_dir):
+    corpus_dir = os.path.join(work_dir, "corpus")
+    documents = build_corpus(corpus_dir, scale=scale)
+    for name in ["METADATA_DIR", "RAW_DATA_DIR", "CONVERTED_DATA_DIR", "FILE_CHUNKS_DATA_DIR"]:
+        os.environ[name] = os.path.join(work_dir, name.lower())
+        os.makedirs(os.environ[name], exist_ok=True)
+    os.environ["VECTOR_DB_PATH"] = os.path.join(work_dir, "vector_database")
+    os.environ.setdefault("EMBEDDING_MODEL", "text-embedding-3-large")
+    if os.getenv("STORAGE_EMULATOR_HOST"):
+        os.environ.setdefault("STORAGE_BUCKET_NAME", "taxgpt-benchmark")
+        from app.storage.storage_bucket import authenticate_gcs
+
+        client = authenticate_gcs(local=True)
+        if client.lookup_bucket(os.environ["STORAGE_BUCKET_NAME"]) is None:
+            client.create_bucket(os.environ["STORAGE_BUCKET_NAME"])
+    else:
+        os.environ.pop("STORAGE_BUCKET_NAME", None)
+
+    results = {}
+    with serve_directory(corpus_dir) as base_url, fake_embeddings_server() as embeddings_url:
+        os.environ["OPENAI_API_KEY"] = "benchmark"
+        os.environ["OPENAI_BASE_URL"] = embeddings_url  # openai client
+        os.environ["OPENAI_API_BASE"] = embeddings_url  # langchain
+        ctx = SimpleNamespace(
+            base_url=base_url,
+            documents=documents,
+            metadata_dir=os.environ["METADATA_DIR"],
+            downloaded_data=get_downloaded_data_index(documents, os.environ["RAW_DATA_DIR"]),
+        )
+        for name in selected:
+            logging.info(f"Running the {name} benchmark")
+            try:
+                results[name] = globals()[f"bench_{name}"](ctx)
+            except Exception as e:
+                # E.g. the missing converters or the bucket, the other benchmarks still run
+                logging.warning(f"Benchmark {name} failed: {e}")
+                results[name] = {"error": f"{type(e).__name__}: {e}"}
+    return results
+
+
+def compare(old_commit, new_commit):
+    """Prints the seconds of every benchmark of both commits and their ratio."""
+    old, new = [load_results(commit) for commit in [old_commit, new_commit]]
+    print(f"{'benchmark':<40}{old_commit:>14}{new_commit:>14}{'ratio':>8}")
+    for name, old_seconds, new_seconds in iter_seconds(old, new):
+        ratio = f"{new_seconds / old_seconds:.2f}" if old_seconds else "-"
+        print(f"{name:<40}{old_seconds:>14.3f}{new_seconds:>14.3f}{ratio:>8}")
+
+
+def iter_seconds(old, new):
+    for name in BENCHMARKS:
+        old_result, new_result = old["benchmarks"].get(name, {}), new["benchmarks"].get(name, {})
+        if "seconds" in old_result and "seconds" in new_result:
+            yield name, old_result["seconds"], new_result["seconds"]
+        for stage in sorted(set(old_result.get("stages", {})) & set(new_result.get("stages", {}))):
+            yield f"{name}.{stage}", old_result["stages"][stage], new_result["stages"][stage]
+
+
+def load_results(commit):
+    with open(os.path.join(RESULTS_DIR, f"{commit}.json"), "r") as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the ingestion pipeline")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, help="Run only these benchmarks")
+    parser.add_argument("--scale", type=int, default=1, help="Multiplies the size of the corpus")
+    parser.add_argument("--compare", nargs=2, metavar="COMMIT", help="Compare two stored results")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directory")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    work_dir = tempfile.mkdtemp(prefix="taxgpt-benchmark-")
+    metrics.reset()
+    try:
+        results = run_benchmarks(args.only or BENCHMARKS, args.scale, work_dir)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    commit = get_commit()
+    report = {
+        "commit": commit,
+        "date": datetime.datetime.utcnow().isoformat(),
+        "scale": args.scale,
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "benchmarks": results,
+        "metrics": metrics.report(),
+    }
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    results_path = os.path.join(RESULTS_DIR, f"{commit}.json")
+    with open(results_path, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"Wrote the results to {results_path}")
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
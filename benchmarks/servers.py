@@ -0,0 +1,133 @@
+import json
+import time
+import base64
+import hashlib
+import threading
+import functools
+import numpy as np
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler, BaseHTTPRequestHandler
+
+"""Local HTTP servers of the offline benchmarks: the fixture corpus and a fake embeddings API."""
+
+EMBEDDING_DIMENSIONS = 256
+
+
+class _QuietFileHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+@contextmanager
+def _serve(handler, **attributes):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.__dict__.update(attributes)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@contextmanager
+def serve_directory(root):
+    """Serves the directory over HTTP (with Range support for the resumed downloads)."""
+    with _serve(functools.partial(_RangeFileHandler, directory=root)) as base_url:
+        yield base_url
+
+
+class _RangeFileHandler(_QuietFileHandler):
+    def send_head(self):
+        range_header = self.headers.get("Range")
+        if not range_header or not range_header.startswith("bytes="):
+            return super().send_head()
+        path = self.translate_path(self.path)
+        try:
+            f = open(path, "rb")
+        except OSError:
+            self.send_error(404)
+            return None
+        size = f.seek(0, 2)
+        start = int(range_header[len("bytes=") :].split("-")[0])  # noqa: E203
+        if start >= size:
+            f.close()
+            self.send_error(416)
+            return None
+        f.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        return f
+
+
+def fake_embedding(value, dimensions=EMBEDDING_DIMENSIONS):
+    """Deterministic unit vector of the text (or of the token ids)."""
+    seed = int.from_bytes(hashlib.sha256(str(value).encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+class _FakeEmbeddingsHandler(BaseHTTPRequestHandler):
+    """The POST /v1/embeddings endpoint of the OpenAI API, with deterministic embeddings."""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/embeddings"):
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.lock:
+            self.server.stats["requests"] += 1
+        time.sleep(self.server.latency)
+        inputs = request["input"]
+        if isinstance(inputs, str) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        dimensions = request.get("dimensions") or EMBEDDING_DIMENSIONS
+        # The texts are sent as strings (VectorStore.embed_texts) or as token ids (langchain)
+        n_tokens = sum(len(x) if isinstance(x, list) else len(x.split()) for x in inputs)
+        embeddings = [fake_embedding(x, dimensions) for x in inputs]
+        if request.get("encoding_format") == "base64":
+            # The default of the openai client, the float32 values encoded in base64
+            embeddings = [
+                base64.b64encode(np.asarray(e, dtype=np.float32).tobytes()).decode("ascii")
+                for e in embeddings
+            ]
+        body = json.dumps(
+            {
+                "object": "list",
+                "model": request.get("model"),
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": embedding}
+                    for i, embedding in enumerate(embeddings)
+                ],
+                "usage": {"prompt_tokens": n_tokens, "total_tokens": n_tokens},
+            }
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@contextmanager
+def fake_embeddings_server(latency=0, stats=None):
+    """
+    Runs the fake embeddings API. Yields the base URL for the OpenAI client (.../v1).
+
+    Args:
+        latency (float): Seconds added to every request, e.g. the round trip to the real API.
+        stats (dict, optional): Receives the number of requests served ("requests").
+    """
+    stats = stats if stats is not None else {}
+    stats["requests"] = 0
+    with _serve(
+        _FakeEmbeddingsHandler, latency=latency, stats=stats, lock=threading.Lock()
+    ) as base_url:
+        yield base_url + "/v1"
@@ -0,0 +1,142 @@
+import json
+import time
+import random
+import asyncio
+import argparse
+from types import SimpleNamespace
+from benchmarks.fixtures import WORDS
+from benchmarks.servers import fake_embeddings_server, fake_embedding
+from app.serving.batching import QueryBatcher, DEFAULT_MAX_BATCH_SIZE, DEFAULT_MAX_WAIT_MS
+from app.metrics import percentile
+
+"""
+Load test of the query batching of the retrieval service.
+
+Many concurrent clients search an in-memory index of generated chunks, once with every query
+searched on its own (max batch size 1) and once with the query batching. The embeddings come from
+the fake embeddings API, with a delay per request in place of the round trip to the real API:
+
+    python -m benchmarks.serving_load --concurrency 64 --queries 2000
+"""
+
+N_CHUNKS = 20000
+N_QUERIES = 2000
+CONCURRENCY = 64
+API_LATENCY_MS = 50
+K = 5
+
+
+def build_index(embeddings_url, n_chunks=N_CHUNKS, seed=0):
+    """Builds an IndexVersion of n_chunks generated chunks, embedded with the fake embeddings."""
+    from langchain_openai import OpenAIEmbeddings
+    from langchain_community.vectorstores import FAISS
+    from app.serving.index import IndexVersion
+
+    rng = random.Random(seed)
+    texts = [" ".join(rng.choice(WORDS) for _ in range(60)) for _ in range(n_chunks)]
+    embeddings = OpenAIEmbeddings(
+        model="text-embedding-3-large",
+        openai_api_base=embeddings_url,
+        openai_api_key="benchmark",
+        check_embedding_ctx_length=False,  # Send the texts, no tiktoken vocabulary offline
+    )
+    db = FAISS.from_embeddings(
+        [(text, fake_embedding(text)) for text in texts],
+        embeddings,
+        metadatas=[{"file_id": f"file-{i // 20}", "chunk_idx": i % 20} for i in range(n_chunks)],
+    )
+    return IndexVersion("benchmark", None, db)
+
+
+async def _run_clients(index, max_batch_size, max_wait_ms, queries, concurrency):
+    batcher = QueryBatcher(
+        SimpleNamespace(current=index), max_batch_size=max_batch_size, max_wait_ms=max_wait_ms
+    )
+    batcher.start()
+    latencies = []
+    remaining = iter(queries)
+
+    async def client():
+        for query in remaining:  # The clients share the queries
+            start = time.perf_counter()
+            await batcher.search(query, K)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    seconds = time.perf_counter() - start
+    await batcher.stop()
+    latencies.sort()
+    return {
+        "queries_per_s": len(queries) / seconds,
+        "p50_s": percentile(latencies, 0.5),
+        "p95_s": percentile(latencies, 0.95),
+    }
+
+
+def run_load_test(
+    n_queries=N_QUERIES,
+    concurrency=CONCURRENCY,
+    max_batch_size=DEFAULT_MAX_BATCH_SIZE,
+    max_wait_ms=DEFAULT_MAX_WAIT_MS,
+    api_latency_ms=API_LATENCY_MS,
+    n_chunks=N_CHUNKS,
+):
+    """
+    Runs the clients without and with the query batching.
+
+    Returns:
+        dict: The throughput, latency and number of embedding requests of both runs, and the
+            throughput gain of the batching.
+    """
+    rng = random.Random(1)
+    queries = [" ".join(rng.choice(WORDS) for _ in range(10)) for _ in range(n_queries)]
+    stats = {}
+    results = {}
+    with fake_embeddings_server(latency=api_latency_ms / 1000, stats=stats) as embeddings_url:
+        index = build_index(embeddings_url, n_chunks=n_chunks)
+        for mode, batch_size, wait_ms in [
+            ("per_request", 1, 0),
+            ("batched", max_batch_size, max_wait_ms),
+        ]:
+            requests_before = stats["requests"]
+            results[mode] = asyncio.run(
+                _run_clients(index, batch_size, wait_ms, queries, concurrency)
+            )
+            results[mode]["embedding_requests"] = stats["requests"] - requests_before
+    results["throughput_gain"] = (
+        results["batched"]["queries_per_s"] / results["per_request"]["queries_per_s"]
+    )
+    results["config"] = {
+        "queries": n_queries,
+        "concurrency": concurrency,
+        "max_batch_size": max_batch_size,
+        "max_wait_ms": max_wait_ms,
+        "api_latency_ms": api_latency_ms,
+        "chunks": n_chunks,
+    }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the query batching")
+    parser.add_argument("--queries", type=int, default=N_QUERIES)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    parser.add_argument("--max-batch-size", type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=DEFAULT_MAX_WAIT_MS)
+    parser.add_argument("--api-latency-ms", type=float, default=API_LATENCY_MS)
+    parser.add_argument("--chunks", type=int, default=N_CHUNKS)
+    args = parser.parse_args()
+    results = run_load_test(
+        n_queries=args.queries,
+        concurrency=args.concurrency,
+        max_batch_size=args.max_batch_size,
+        max_wait_ms=args.max_wait_ms,
+        api_latency_ms=args.api_latency_ms,
+        n_chunks=args.chunks,
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
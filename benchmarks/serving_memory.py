@@ -0,0 +1,103 @@
+import os
+import json
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+import pyarrow as pa
+from app.serving.shared_index import SharedIndexVersion, write_shared_index, read_memory_usage
+
+"""
+Memory of the worker processes of the retrieval service, with the shared memory-mapped index and
+with a private copy of the index in every worker.
+
+The workers are spawned, load a generated index of n_chunks chunks, run searches and report their
+memory (Linux only, from /proc) while all of them are alive:
+
+    python -m benchmarks.serving_memory --workers 4 --chunks 100000
+"""
+
+N_CHUNKS = 100000
+DIMENSIONS = 1024
+N_WORKERS = 4
+N_SEARCHES = 20
+
+
+def _worker(directory, private, n_searches, reports, done):
+    index = SharedIndexVersion("benchmark", directory, embeddings=None)
+    if private:
+        # What every worker pays when it loads its own copy of the database
+        index.vectors = np.array(index.vectors)
+        index.norms = np.array(index.norms)
+        with pa.OSFile(os.path.join(directory, "chunks.arrow"), "rb") as f:
+            index.chunks = pa.ipc.open_file(f).read_all()
+    index.warm_up()
+    rng = np.random.default_rng(os.getpid())
+    for _ in range(n_searches):
+        distances, ids = index.search_vectors(
+            rng.standard_normal((8, index.vectors.shape[1])).astype(np.float32), 5
+        )
+        [index.chunks.column("text")[int(i)].as_py() for i in ids.ravel()]
+    reports.put(read_memory_usage())
+    done.wait()
+
+
+def measure_workers(directory, n_workers, private, n_searches=N_SEARCHES):
+    """Runs the workers and returns the memory reports of all of them."""
+    context = multiprocessing.get_context("spawn")
+    reports, done = context.Queue(), context.Event()
+    workers = [
+        context.Process(target=_worker, args=(directory, private, n_searches, reports, done))
+        for _ in range(n_workers)
+    ]
+    for worker in workers:
+        worker.start()
+    results = [reports.get() for _ in workers]
+    done.set()
+    for worker in workers:
+        worker.join()
+    return results
+
+
+def run_memory_test(n_workers=N_WORKERS, n_chunks=N_CHUNKS, dimensions=DIMENSIONS):
+    """
+    Measures the memory of the workers with the shared and with the private index.
+
+    Returns:
+        dict: Per mode, the per-worker reports and the total PSS and USS of the workers in MiB.
+    """
+    rng = np.random.default_rng(0)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        directory = os.path.join(tmp_dir, "shared")
+        write_shared_index(
+            directory,
+            rng.standard_normal((n_chunks, dimensions)).astype(np.float32),
+            [f"Besedilo odstavka {i} " * 40 for i in range(n_chunks)],
+            [{"file_id": f"file-{i // 20}", "chunk_idx": i % 20} for i in range(n_chunks)],
+        )
+        results["index_size_mb"] = sum(
+            os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+        ) / (1024 * 1024)
+        for mode, private in [("shared", False), ("private", True)]:
+            reports = measure_workers(directory, n_workers, private)
+            results[mode] = {
+                "workers": reports,
+                "total_pss_mb": sum(report.get("pss", 0) for report in reports),
+                "total_uss_mb": sum(report.get("uss", 0) for report in reports),
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory of the retrieval worker processes")
+    parser.add_argument("--workers", type=int, default=N_WORKERS)
+    parser.add_argument("--chunks", type=int, default=N_CHUNKS)
+    parser.add_argument("--dimensions", type=int, default=DIMENSIONS)
+    args = parser.parse_args()
+    results = run_memory_test(args.workers, args.chunks, args.dimensions)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()